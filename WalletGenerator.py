@@ -3,13 +3,19 @@ from miner import Miner
 from wallet import Wallet
 from transaction import Transaction
 from block import Block
-from queue import Queue, PriorityQueue
+from merkle import verify_proof
+from compact import PartialBlock
+from queue import PriorityQueue
 from threading import Thread, Lock
 import logging
 from network import *
+from profiler import ProfiledLock
+import profiler
 from numpy import argmax
 import time
 import random
+from base64 import b64encode
+import pickle
 
 # n: number of wallet
 # v: initial amount of each wallet
@@ -47,13 +53,12 @@ def Transaction_Generator_Handler(W:dict, T:dict, lock:Lock, net:Networking):
             m = Transaction_Generator(W)
             if m != None:
                 T[m[0].Digest] = m
-                net.broadcast(m[0].to_bytes(), NEW_TRANSACTION)
+                net.broadcast(m[0].to_bytes(compact=True), NEW_TRANSACTION)
 
 # Check if t has reciver address in W and t not in T already,
 # Then add to T
 def New_Transaction_Handler(W:dict, T:dict, DAT:bytes, lock:Lock):
-    t = Transaction()
-    t.from_bytes(DAT)
+    t = Transaction(DAT)
     for receiver in t.Receivers:
         with lock:
             if receiver[1] in W:
@@ -85,7 +90,7 @@ def New_Block_Handler(C:dict, DAT:bytes, lock:Lock):
     b = Block.from_bytes(DAT,tsns=None)
 
     with lock:
-        print('add block', b.prev_hash)
+        print('add block', b64encode(b.prev_hash).decode())
         if b.prev_hash not in C: 
             C[b.prev_hash] = {b.hashcode: b}
             return
@@ -93,15 +98,57 @@ def New_Block_Handler(C:dict, DAT:bytes, lock:Lock):
             C[b.prev_hash][b.hashcode] = b
             return
         return
-    
-def Block_Handler(C:dict, T:dict, pre_b:bytes, lockC:Lock, lockT:Lock):
+
+# Ask the announcing miner for the header of every new block, with the proofs
+# of our pending transactions it holds, instead of the whole block
+def Inventory_Handler(T:dict, addr:tuple, DAT:bytes, lock:Lock, net:Networking):
+    with lock:
+        digests = list(T.keys())
+    for tag, hashcode in pickle.loads(DAT):
+        if tag == NEW_COMPACT_BLOCK or tag == NEW_BLOCK:
+            net.sending(addr[0], pickle.dumps({'block': hashcode, 'digests': digests}), REQUEST_PROOF)
+
+# Check the header's proof of work and the proofs against its merkle root,
+# then add the header to unprocecces list, and keep the proven transactions in P
+def Proof_Handler(C:dict, P:dict, DAT:bytes, lock:Lock):
+    reply = pickle.loads(DAT)
+    b = Block.from_header(reply['header'])
+    if b.hashcode != reply['block'] or not b.validate(strict=False):
+        return
+    proven = [d for d, (index, path) in reply['proofs'].items() if verify_proof(d, index, path, b.merkle_root)]
+    Header_Handler(C, P, b, proven, lock)
+
+# A compact block pushed to us names its transactions by short ids,
+# match them against our pending transactions and follow its header
+def Compact_Block_Handler(C:dict, T:dict, P:dict, DAT:bytes, lockC:Lock, lockT:Lock):
+    partial = PartialBlock(DAT)
+    b = Block.from_header(partial.header)
+    if b.hashcode != partial.hashcode or not b.validate(strict=False):
+        return
+    with lockT:
+        pending = {d: m[0] for d, m in T.items()}
+    partial.fill(pending)
+    proven = [t.Digest for t in partial.transactions if t is not None]
+    Header_Handler(C, P, b, proven, lockC)
+
+# add the header b to unprocecces list, with the transactions it confirms
+def Header_Handler(C:dict, P:dict, b:Block, proven:list, lock:Lock):
+    with lock:
+        P.setdefault(b.hashcode, set()).update(proven)
+        if b.prev_hash not in C:
+            C[b.prev_hash] = {b.hashcode: b}
+        elif b.hashcode not in C[b.prev_hash]:
+            C[b.prev_hash][b.hashcode] = b
+
+# blocks from headers only confirm the transactions proven in P
+def Block_Handler(C:dict, T:dict, pre_b:bytes, lockC:Lock, lockT:Lock, P:dict):
     while True:
         time.sleep(1)
         with lockC:
             print('get block', len(C))
             if len(C) < 1:
                 continue
-            print('get block', pre_b)
+            print('get block', b64encode(pre_b).decode())
             B = list(C[pre_b].values())
             if len(B) == 1:
                 b = B[0]
@@ -111,8 +158,9 @@ def Block_Handler(C:dict, T:dict, pre_b:bytes, lockC:Lock, lockT:Lock):
 
             C.pop(pre_b)
             pre_b = b.hashcode
+            proven = P.pop(b.hashcode, ())
 
-        T_list = b.transactions
+        T_list = b.transactions if b.transactions is not None else proven
         for i in T_list:
             with lockT:
                 print('process T')
@@ -122,7 +170,25 @@ def Block_Handler(C:dict, T:dict, pre_b:bytes, lockC:Lock, lockT:Lock):
                     r.receive(t)
 
 
-            
+
+# Called by the network worker pool for every message tagged above 14
+def Message_Handler(W:dict, T:dict, C:dict, P:dict, lockT:Lock, lockC:Lock, net:Networking):
+    def handle_message(addr, tag, DAT):
+        with profiler.context(TAG_NAMES.get(tag, str(tag))):
+            if tag == NEW_TRANSACTION:
+                New_Transaction_Handler(W, T, DAT, lockT)
+            elif tag == INVALID_TRANSACTION:
+                Invalid_Transaction_Handler(W, T, DAT, lockT)
+            elif tag == NEW_BLOCK:
+                New_Block_Handler(C, DAT, lockC)
+            elif tag == NEW_COMPACT_BLOCK:
+                Compact_Block_Handler(C, T, P, DAT, lockC, lockT)
+            elif tag == INVENTORY:
+                Inventory_Handler(T, addr, DAT, lockT, net)
+            elif tag == RETURN_PROOF:
+                Proof_Handler(C, P, DAT, lockC)
+    return handle_message
+
 
 
 
@@ -138,10 +204,12 @@ if __name__ == "__main__":
 
     # initial wallets and first block
     W, B, T = Wallet_Generator()
-    BUFFER = Queue()
+    lockT = ProfiledLock('lockT'); lockC = ProfiledLock('lockC'); C={}; T={}; P={}
 
-    # initial network
-    net = Networking('10.0.195.172', BUFFER)
+    # initial network, messages are handled by its bounded worker pool, blocks first
+    # announced blocks are confirmed from their header and the proofs of our transactions
+    net = Networking('10.0.195.172')
+    net.handler = Message_Handler(W, T, C, P, lockT, lockC, net)
     net.HOSTs=['10.0.195.216', '10.0.195.116', '10.0.195.231']
     Thread(target=net.listening, daemon=True).start()
 
@@ -149,27 +217,18 @@ if __name__ == "__main__":
     time.sleep(10)
     print("Broadcasting first block")
     print(len(B.to_bytes(tsn_hash_only=False)))
-    print('Main', B.hashcode)
+    print('Main', b64encode(B.hashcode).decode())
     net.broadcast(B.to_bytes(tsn_hash_only=False), FIRST_BLOCK)
 
-    lockT = Lock(); lockC = Lock(); C={}; T={}
+    # kill -USR2 starts the profiler, and again stops it and writes client-profile-<n>-*
+    profiler.install(prefix='client-profile')
     Thread(target=Transaction_Generator_Handler, args=(W, T, lockT, net), daemon=True).start()
     print(B)
-    Thread(target=Block_Handler, args=(C, T, B.hashcode, lockC, lockT), daemon=True).start()
-    start_time = time.time()
+    Thread(target=Block_Handler, args=(C, T, B.hashcode, lockC, lockT, P), daemon=True).start()
     print("looping...")
     while True:
-        if time.time()-start_time >= 20:
-            for w in W:
-                print('pending ', len(list(T.keys())))
-                print(W[w])
-            start_time=time.time()
-        if not BUFFER.empty():
-            addr, tag, DAT = BUFFER.get()
-            if tag == NEW_TRANSACTION:
-                Thread(target=New_Transaction_Handler, args=(W, T, DAT, lockT), daemon=True).start()
-            if tag == INVALID_TRANSACTION:
-                Thread(target=Invalid_Transaction_Handler, args=(W, T, DAT, lockT), daemon=True).start()
-            if tag == NEW_BLOCK:
-                Thread(target=New_Block_Handler, args=(C, DAT, lockC), daemon=True).start()
+        time.sleep(20)
+        for w in W:
+            print('pending ', len(list(T.keys())))
+            print(W[w])
 
@@ -0,0 +1,363 @@
+'''
+bench.py
+benchmarks of the hot paths, with results comparable between runs
+
+Microbenchmarks time one call in a loop, scenarios time a whole run from a
+fresh miner: N wallets, M transactions, a chain of height H. Results are
+per operation, the median over several repeats, and can be written as JSON
+and compared with a previous run, failing when something got slower than
+the threshold allows.
+
+  python bench.py --json baseline.json
+  python bench.py --baseline baseline.json --threshold 0.1
+  python bench.py -k 'transaction.*' -k 'scenario.*'
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+from fnmatch import fnmatch
+from statistics import median
+
+from crypto import double_sha256, merkle_root_generation
+from transaction import Transaction
+from codec import encode_transaction
+from block import Block
+from merkle import MerkleTree, verify_proof
+from miner import Miner
+from WalletGenerator import Wallet_Generator
+
+# name -> (setup, scenario)
+BENCHMARKS = {}
+
+
+# setup(fixture) returns the function to time
+# scenario: setup is called again before every repeat, and the function runs once
+def benchmark(name, scenario=False):
+    def register(setup):
+        BENCHMARKS[name] = (setup, scenario)
+        return setup
+    return register
+
+
+# what the benchmarks run on, built once and shared
+class Fixture:
+    def __init__(self, wallets=20, transactions=200, height=20, seed=0):
+        self.n_wallets = wallets
+        self.n_transactions = transactions
+        self.height = height
+        self.seed = seed
+        self._blocks = None
+
+    # a chain of height blocks over the first block, holding the transactions
+    # built once, since every transaction has to be signed
+    def blocks(self):
+        if self._blocks is None:
+            W, B, _ = Wallet_Generator(self.n_wallets, 100.)
+            # Wallet_Generator reseeds the global generator
+            random.seed(self.seed)
+            wallets = list(W.values())
+            per_block = -(-self.n_transactions // self.height)
+            if per_block >= len(wallets):
+                raise ValueError('a wallet can only send once per block, use more wallets or a higher chain')
+
+            blocks, left = [B], self.n_transactions
+            for _ in range(self.height):
+                senders = random.sample(wallets, min(per_block, left))
+                left -= len(senders)
+                # a sender keeps only its change, so it must not receive in the same block
+                receivers = [w for w in wallets if w not in senders]
+                sent = []
+                for s in senders:
+                    r = random.choice(receivers)
+                    sent.append((s.send(0.25, r.address), s, r))
+                block = Block(blocks[-1].hashcode, [t for t, _, _ in sent])
+                block.mine()
+                blocks.append(block)
+                for t, s, r in sent:
+                    s.confirm(t)
+                    r.receive(t)
+            self._blocks = blocks
+        return self._blocks
+
+    def transactions(self):
+        return [tsn for block in self.blocks()[1:] for tsn in block.transactions]
+
+    # a miner holding the whole chain
+    def miner(self):
+        miner = Miner()
+        blocks = self.blocks()
+        miner.add_first_block(blocks[0].to_bytes(tsn_hash_only=False))
+        for block in blocks[1:]:
+            miner.add_received_block(block.to_bytes(tsn_hash_only=False))
+        if len(miner.chain) != len(blocks):
+            raise RuntimeError('the fixture chain was rejected')
+        return miner
+
+
+# cycle through the items, so every call sees a different one
+def _cycle(items, fn):
+    state = {'i': 0}
+    def run():
+        i = state['i']
+        state['i'] = (i + 1) % len(items)
+        return fn(items[i])
+    return run
+
+
+@benchmark('crypto.double_sha256')
+def bench_double_sha256(fixture):
+    data = os.urandom(256)
+    return lambda: double_sha256(data)
+
+
+@benchmark('crypto.merkle_root_generation')
+def bench_merkle_root(fixture):
+    digests = [tsn.Digest for tsn in fixture.transactions()]
+    return lambda: merkle_root_generation(digests)
+
+
+# a transaction replaced in a block template, only its path is rehashed
+@benchmark('merkle.replace')
+def bench_merkle_replace(fixture):
+    digests = [tsn.Digest for tsn in fixture.transactions()]
+    tree = MerkleTree(digests)
+    return _cycle(list(enumerate(reversed(digests))), lambda item: tree.replace(*item))
+
+
+@benchmark('merkle.proof')
+def bench_merkle_proof(fixture):
+    tree = MerkleTree([tsn.Digest for tsn in fixture.transactions()])
+    return _cycle(tree.leaves, tree.proof)
+
+
+@benchmark('merkle.verify_proof')
+def bench_verify_proof(fixture):
+    tree = MerkleTree([tsn.Digest for tsn in fixture.transactions()])
+    proofs = [(leaf,) + tree.proof(leaf) + (tree.root,) for leaf in tree.leaves]
+    return _cycle(proofs, lambda proof: verify_proof(*proof))
+
+
+@benchmark('transaction.sign')
+def bench_sign(fixture):
+    wallet = next(iter(Wallet_Generator(1, 100.)[0].values()))
+    tsn = wallet.send(1., wallet.address)
+    return lambda: tsn.sign([wallet.key])
+
+
+@benchmark('transaction.verify')
+def bench_verify(fixture):
+    return _cycle(fixture.transactions(), Transaction.verify)
+
+
+# the encoder itself, to_bytes(compact=True) returns the bytes it was built or decoded from
+@benchmark('transaction.to_bytes')
+def bench_to_bytes(fixture):
+    return _cycle(fixture.transactions(), encode_transaction)
+
+
+@benchmark('transaction.to_bytes_legacy')
+def bench_to_bytes_legacy(fixture):
+    return _cycle(fixture.transactions(), Transaction.to_bytes)
+
+
+@benchmark('transaction.from_bytes')
+def bench_from_bytes(fixture):
+    return _cycle([tsn.to_bytes(compact=True) for tsn in fixture.transactions()], Transaction)
+
+
+@benchmark('transaction.from_bytes_legacy')
+def bench_from_bytes_legacy(fixture):
+    return _cycle([tsn.to_bytes() for tsn in fixture.transactions()], Transaction)
+
+
+@benchmark('block.from_bytes')
+def bench_block_from_bytes(fixture):
+    return _cycle([block.to_bytes(tsn_hash_only=False) for block in fixture.blocks()[1:]], Block.from_bytes)
+
+
+# blocks of decoded transactions, which keep the bytes they were decoded from
+@benchmark('block.to_bytes')
+def bench_block_to_bytes(fixture):
+    blocks = [Block.from_bytes(block.to_bytes(tsn_hash_only=False)) for block in fixture.blocks()[1:]]
+    return _cycle(blocks, lambda block: block.to_bytes(tsn_hash_only=False))
+
+
+@benchmark('block.from_bytes_hashes')
+def bench_block_from_bytes_hashes(fixture):
+    blocks = fixture.blocks()[1:]
+    pool = {tsn.Digest: tsn for block in blocks for tsn in block.transactions}
+    return _cycle([block.to_bytes() for block in blocks], lambda data: Block.from_bytes(data, pool))
+
+
+# a fresh nonce search every call, at Block.difficulty
+@benchmark('block.mine')
+def bench_mine(fixture):
+    # copies, mining changes the hash the next block of the fixture links to
+    return _cycle([Block(block.prev_hash, block.transactions) for block in fixture.blocks()[1:]], Block.mine)
+
+
+@benchmark('miner.verify_fund')
+def bench_verify_fund(fixture):
+    miner = fixture.miner()
+    return _cycle(fixture.transactions(), miner.verify_fund)
+
+
+# the transactions of the first block checked and added to the pool of a fresh miner
+@benchmark('scenario.add_transactions', scenario=True)
+def bench_add_transactions(fixture):
+    miner = Miner()
+    miner.add_first_block(fixture.blocks()[0].to_bytes(tsn_hash_only=False))
+    data = [tsn.to_bytes(compact=True) for tsn in fixture.blocks()[1].transactions]
+    def run():
+        for tsn in data:
+            miner.add_transaction(Transaction(tsn))
+    return run
+
+
+# the whole chain received block by block by a fresh miner
+@benchmark('scenario.connect_chain', scenario=True)
+def bench_connect_chain(fixture):
+    blocks = fixture.blocks()
+    miner = Miner()
+    miner.add_first_block(blocks[0].to_bytes(tsn_hash_only=False))
+    data = [block.to_bytes(tsn_hash_only=False) for block in blocks[1:]]
+    def run():
+        for block in data:
+            miner.add_received_block(block)
+    return run
+
+
+# the balances rebuilt from the whole chain, as on restart
+@benchmark('scenario.rebuild_balances', scenario=True)
+def bench_rebuild_balances(fixture):
+    miner = fixture.miner()
+    return lambda: miner.balances.rebuild(miner.chain)
+
+
+# seconds per call of every repeat
+# min_time: a repeat of a microbenchmark calls it as many times as fits
+def measure(setup, scenario, fixture, repeat=5, min_time=0.2):
+    if scenario:
+        times = []
+        for _ in range(repeat):
+            run = setup(fixture)
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        return times, 1
+
+    run = setup(fixture)
+    # warm up, and find how many calls take min_time
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / elapsed) + 1) if elapsed > 0 else number * 10
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        times.append((time.perf_counter() - start) / number)
+    return times, number
+
+
+def run_benchmarks(names, fixture, repeat=5, min_time=0.2, out=sys.stderr):
+    results = {}
+    for name in names:
+        setup, scenario = BENCHMARKS[name]
+        times, number = measure(setup, scenario, fixture, repeat, min_time)
+        results[name] = {'median': median(times), 'min': min(times), 'max': max(times),
+                         'repeat': repeat, 'number': number}
+        print('{:<34}{:>14}'.format(name, format_time(results[name]['median'])), file=out, flush=True)
+    return results
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:.3f} {}'.format(seconds / scale, unit)
+    return '{:.1f} ns'.format(seconds / 1e-9)
+
+
+# names of the benchmarks slower than the baseline by more than threshold
+def compare(results, baseline, threshold=0.1, out=sys.stdout):
+    regressions = []
+    print('{:<34}{:>14}{:>14}{:>9}'.format('benchmark', 'baseline', 'current', 'ratio'), file=out)
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print('{:<34}{:>14}{:>14}'.format(name, '-', format_time(result['median'])), file=out)
+            continue
+        ratio = result['median'] / base['median']
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  slower'
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        print('{:<34}{:>14}{:>14}{:>9.2f}{}'.format(name, format_time(base['median']), format_time(result['median']),
+                                                   ratio, flag), file=out)
+    return regressions
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of the miner.')
+    parser.add_argument('-k', dest='patterns', action='append', help='only the benchmarks matching this pattern, repeatable')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+    parser.add_argument('--wallets', type=int, default=20)
+    parser.add_argument('--transactions', type=int, default=200)
+    parser.add_argument('--height', type=int, default=20)
+    parser.add_argument('--difficulty', type=int, default=1, help='set on Block for every benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per repeat of a microbenchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the results to this file, - for stdout')
+    parser.add_argument('--baseline', help='results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown tolerated before failing')
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if not args.patterns or any(fnmatch(name, p) for p in args.patterns)]
+    if args.list:
+        print('\n'.join(names))
+        sys.exit(0)
+
+    random.seed(args.seed)
+    Block.difficulty = args.difficulty
+    fixture = Fixture(args.wallets, args.transactions, args.height, args.seed)
+    results = run_benchmarks(names, fixture, args.repeat, args.min_time)
+
+    report = {
+        'meta': {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+                 'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+                 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'params': {'wallets': args.wallets, 'transactions': args.transactions, 'height': args.height,
+                            'difficulty': args.difficulty, 'repeat': args.repeat, 'seed': args.seed}},
+        'results': results,
+    }
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('params') != report['meta']['params']:
+            print('warning: the baseline was run with other parameters', file=sys.stderr)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('{} benchmark(s) slower than the baseline: {}'.format(len(regressions), ', '.join(regressions)),
+                  file=sys.stderr)
+            sys.exit(1)
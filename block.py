@@ -6,13 +6,40 @@ import time
 import pickle
 import random
 import logging
-from crypto import merkle_root_generation, check_prefix_b64, double_sha256
+from struct import pack, unpack_from
+from base64 import b64encode
+from crypto import check_prefix, double_sha256
+from merkle import MerkleTree
+from util import n2b
 
 from transaction import Transaction
+from mining import LocalBackend
+import metrics
+
+MINE_SECONDS = metrics.histogram('block_mine_seconds', 'time spent searching a nonce, by result', ('result',))
+HASHES = metrics.counter('block_hashes_total', 'nonces tried')
+HASH_RATE = metrics.gauge('block_hash_rate', 'nonces tried per second by the last search')
+
+
+# raised by Block.from_bytes when transactions of the block are not in the given pool
+# args[0] is the hash of the block, missing the digests of the transactions
+class MissingTransactionsError(ValueError):
+  def __init__(self, hashcode, missing):
+    super().__init__(hashcode)
+    self.hashcode = hashcode
+    self.missing = missing
+
+
+# blocks hold transactions, or only their digests when decoded without a pool
+def _digest(tsn):
+  return tsn if type(tsn) == bytes else tsn.Digest
+
 
 class Block:
   difficulty = 2
   stop_mining = False
+  # proof-of-work backend, see mining.py
+  backend = LocalBackend()
 
   def __init__(self, prev_hash, transactions=None, nonce=0, merkle_root=None, timestamp=time.asctime().encode()):
     self.prev_hash = prev_hash
@@ -21,20 +48,69 @@ class Block:
     self.transactions = transactions
 
     self.hashcode = None
+    self._prefix = None
+    self._prefix_key = None
     self._compute()
     
 
   def _compute(self):
-    tnsn = self.transactions if type(self.transactions[0])==bytes else [t.Digest for t in self.transactions]
-    self.merkle_root = merkle_root_generation(tnsn)
     self.hashcode = self.digest()
 
 
+  # the merkle tree and its root are cached until the transaction list is replaced
+  # (mutating the list in place must be followed by re-assigning it,
+  # or go through add_transaction / replace_transaction)
+  @property
+  def transactions(self):
+    return self._transactions
+
+  @transactions.setter
+  def transactions(self, transactions):
+    self._transactions = transactions
+    self._merkle_root = None
+    self._merkle_tree = None
+
+
+  @property
+  def merkle_tree(self):
+    if self._merkle_tree is None:
+      self._merkle_tree = MerkleTree([_digest(t) for t in self._transactions or ()])
+    return self._merkle_tree
+
+  @property
+  def merkle_root(self):
+    if self._merkle_root is None and self._transactions:
+      self._merkle_root = self.merkle_tree.root
+    return self._merkle_root
+
+
+  # grow a block template, rehashing only the path of the new transaction
+  def add_transaction(self, tsn):
+    tree = self.merkle_tree
+    if self._transactions is None:
+      self._transactions = []
+    self._transactions.append(tsn)
+    tree.add(_digest(tsn))
+    self._merkle_root = tree.root
+
+  def replace_transaction(self, index, tsn):
+    tree = self.merkle_tree
+    self._transactions[index] = tsn
+    tree.replace(index, _digest(tsn))
+    self._merkle_root = tree.root
+
+  # (index, path) proving the transaction is in the block, None if it is not, see merkle.py
+  def proof(self, digest):
+    if self._transactions is None:
+      return None
+    return self.merkle_tree.proof(digest)
+
+
   def __str__(self, block_head_only=True):
     return "Created Time: " + self.timestamp.decode() + \
-           "\nPrevious hash: " + str(self.prev_hash) + \
+           "\nPrevious hash: " + b64encode(self.prev_hash).decode() + \
            "\nNonce: " + str(self.nonce) + \
-           "\nHash: " + str(self.hashcode) + \
+           "\nHash: " + b64encode(self.hashcode).decode() + \
            ('\n' if block_head_only else '\n' + '\n\n'.join([str(tsn) for tsn in self.transactions]))
 
 
@@ -44,34 +120,66 @@ class Block:
     return self.hashcode
 
 
+  # header layout: every field prefixed with its 2-byte length, then the 8-byte nonce
+  # so the nonce always sits at the end and the prefix can be reused across nonces
+  def header_prefix(self):
+    fields = (self.prev_hash, self.timestamp, self.merkle_root or b'')
+    if self._prefix_key != fields:
+      self._prefix = b''.join(pack('>H', len(f)) + f for f in fields)
+      self._prefix_key = fields
+    return self._prefix
+
+
   @staticmethod
   def from_bytes(data, tsns=None):
     data = pickle.loads(data)
 
     # reconstruct transactions
     if 'tsn_hash_list' in data:
-      tsn_hash_list = data['tsn_hash_list'].split(b'|')
-      try: 
-        tsns = tsn_hash_list if (tsns is None) else [tsns[tsn_hash] for tsn_hash in tsn_hash_list]
-      except: raise ValueError(data['hashcode'])
+      tsn_hash_list = data['tsn_hash_list']
+      if tsns is not None:
+        missing = [tsn_hash for tsn_hash in tsn_hash_list if tsn_hash not in tsns]
+        if missing:
+          raise MissingTransactionsError(data['hashcode'], missing)
+        tsns = [tsns[tsn_hash] for tsn_hash in tsn_hash_list]
+      else:
+        tsns = tsn_hash_list
     else:
-      tsns = data['full_tsns'].split(b'|')
+      tsns = data['full_tsns']
+      # legacy text transactions were joined with '|'
+      if type(tsns) == bytes:
+        tsns = tsns.split(b'|')
       tsns = [Transaction(tsn) for tsn in tsns]
     return Block(data['prev_hash'], tsns, data['nonce'], timestamp=data['timestamp'])
 
 
-  def to_bytes(self, block_head_only=False, tsn_hash_only=True):
-    data = {'prev_hash': self.prev_hash, 'nonce': self.nonce, 'timestamp': self.timestamp}
+  # a block without transactions from the bytes of its header, whose hash can be checked
+  @staticmethod
+  def from_header(data):
+    fields, offset = [], 0
+    for _ in range(3):
+      size = unpack_from('>H', data, offset)[0]
+      fields.append(bytes(data[offset + 2:offset + 2 + size]))
+      offset += 2 + size
+    if len(data) != offset + 8:
+      raise ValueError('malformed block header')
+    prev_hash, timestamp, merkle_root = fields
+    block = Block(prev_hash, None, unpack_from('>q', data, offset)[0], timestamp=timestamp)
+    block._merkle_root = merkle_root or None
+    block._compute()
+    return block
 
+
+  def to_bytes(self, block_head_only=False, tsn_hash_only=True):
     if block_head_only:
-      data['merkle'] = self.merkle_root
+      return self.header_prefix() + n2b(self.nonce)
+
+    data = {'prev_hash': self.prev_hash, 'nonce': self.nonce, 'timestamp': self.timestamp}
+    data['hashcode'] = self.hashcode
+    if tsn_hash_only:
+      data['tsn_hash_list'] = [t.Digest for t in self.transactions]
     else:
-      data['hashcode'] = self.hashcode
-      if tsn_hash_only:
-        tsn_hash_list = [t.Digest for t in self.transactions]
-        data['tsn_hash_list'] = b'|'.join(tsn_hash_list)
-      else:
-        data['full_tsns'] = b'|'.join([tsn.to_bytes(nosign=True) for tsn in self.transactions])
+      data['full_tsns'] = [tsn.to_bytes(compact=True) for tsn in self.transactions]
 
     return pickle.dumps(data)
 
@@ -79,14 +187,18 @@ class Block:
   def mine(self):
     logging.debug('Block - start mining now...')
     start = time.time()
-    self.nonce = random.randint(-1e9, 1e9)
-    initial_nonce = self.nonce
-    while not self.stop_mining:
-      if self.validate():
-        logging.debug('Block - mining is done: {} tries in {:.0f}s'.format(self.nonce - initial_nonce, time.time() - start)) 
-        return True
-      self.nonce += 1
-    # self.stop_mining = False
+    self._compute()
+    nonce = self.backend.search(self, self.header_prefix(), random.randint(-10**9, 10**9))
+    elapsed = time.time() - start
+    HASHES.inc(self.backend.tries)
+    MINE_SECONDS.observe(elapsed, ('aborted' if nonce is None else 'found',))
+    if elapsed > 0:
+      HASH_RATE.set(self.backend.tries / elapsed)
+    if nonce is not None:
+      self.nonce = nonce
+      self._compute()
+      logging.debug('Block - mining is done: {} tries in {:.0f}s'.format(self.backend.tries, elapsed))
+      return True
     logging.debug('Block - mining is aborted...')
     return False
 
@@ -94,7 +206,7 @@ class Block:
   def validate(self, prev_hash=None, strict=True):
     if strict:
       self._compute()
-    return check_prefix_b64(self.hashcode, self.difficulty)
+    return check_prefix(self.hashcode, self.difficulty)
 
   def __eq__(self, other):
     if not isinstance(other, Block):
@@ -0,0 +1,247 @@
+'''
+blockstore.py
+append-only storage for the chain
+
+BlockStore keeps blocks, in their full serialized form, in segment files
+on disk, next to a fixed-size index record per height (segment, offset,
+length, block hash). Reads go through mmap and only a few recently used
+blocks are kept decoded, so memory stays flat as the chain grows and
+reopening only has to scan the index. MemoryChain offers the same interface for a chain kept in a list.
+
+A BlockStore can be read from any thread while one thread writes to it:
+the maps are only grown or released under its lock, and blocks are
+decoded outside of it from a copy of their bytes.
+'''
+import os
+import mmap
+from collections import OrderedDict
+from struct import Struct
+from threading import RLock
+
+from block import Block
+
+
+class MemoryChain(list):
+  # lowest height whose block is stored, see snapshot.py
+  base = 0
+
+  def __init__(self, blocks=()):
+    super().__init__()
+    self._heights = {}
+    for block in blocks:
+      self.append(block)
+
+  def append(self, block):
+    self._heights[block.hashcode] = len(self)
+    super().append(block)
+
+  def __delitem__(self, key):
+    start = (key.start or 0) if isinstance(key, slice) else key
+    if start < 0:
+      start += len(self)
+    for block in self[start:]:
+      self._heights.pop(block.hashcode, None)
+    super().__delitem__(slice(start, None))
+
+  def height_of(self, hashcode):
+    return self._heights.get(hashcode)
+
+  def hash_at(self, height):
+    return self[height].hashcode
+
+  def close(self):
+    pass
+
+
+class BlockStore:
+  segment_size = 64 << 20
+  cache_size = 16
+  # segment number, offset, length, hash length, hash
+  _entry = Struct('>IQIB63s')
+  base = 0
+
+  def __init__(self, path):
+    os.makedirs(path, exist_ok=True)
+    self.path = path
+    self._index = open(os.path.join(path, 'index.dat'), 'a+b')
+    self._index_map = None
+    self._segments = {}
+    self._cache = OrderedDict()
+    # guards the maps, the files and the cache
+    self._lock = RLock()
+
+    # drop a record left half-written by a crash
+    size = os.fstat(self._index.fileno()).st_size
+    self._height = size // self._entry.size
+    if size != self._height * self._entry.size:
+      self._index.truncate(self._height * self._entry.size)
+
+    self._heights = {}
+    for height in range(self._height):
+      self._heights[self._read_entry(height)[3]] = height
+
+    if self._height > 0:
+      segment, offset, length, _ = self._read_entry(self._height - 1)
+      self._tail = (segment, offset + length)
+    else:
+      self._tail = (0, 0)
+    self._writer = open(self._segment_path(self._tail[0]), 'ab')
+    self._writer.truncate(self._tail[1])
+
+
+  def _segment_path(self, segment):
+    return os.path.join(self.path, 'blk%05d.dat' % segment)
+
+
+  def _map(self, f, needed, current):
+    if current is not None and len(current) >= needed:
+      return current
+    if current is not None:
+      current.close()
+    f.flush()
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+  def _read_entry(self, height):
+    end = (height + 1) * self._entry.size
+    self._index_map = self._map(self._index, end, self._index_map)
+    segment, offset, length, n, hashcode = self._entry.unpack_from(self._index_map, end - self._entry.size)
+    return segment, offset, length, hashcode[:n]
+
+
+  # the serialized block at height, copied out of the map
+  def _read_data(self, height):
+    segment, offset, length, _ = self._read_entry(height)
+    if segment not in self._segments:
+      self._segments[segment] = (open(self._segment_path(segment), 'rb'), None)
+    f, m = self._segments[segment]
+    if segment == self._tail[0]:
+      self._writer.flush()
+    m = self._map(f, offset + length, m)
+    self._segments[segment] = (f, m)
+    return m[offset:offset + length]
+
+
+  def __len__(self):
+    return self._height
+
+
+  def __iter__(self):
+    for height in range(self._height):
+      yield self[height]
+
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      return [self[height] for height in range(*key.indices(self._height))]
+    with self._lock:
+      if key < 0:
+        key += self._height
+      if not 0 <= key < self._height:
+        raise IndexError('block height out of range')
+      block = self._cache.get(key)
+      if block is not None:
+        self._cache.move_to_end(key)
+        return block
+      data = self._read_data(key)
+
+    block = Block.from_bytes(data)
+    with self._lock:
+      # unless the top of the chain was replaced meanwhile
+      if key < self._height and self.hash_at(key) == block.hashcode:
+        self._cache[key] = block
+        while len(self._cache) > self.cache_size:
+          self._cache.popitem(last=False)
+    return block
+
+
+  def height_of(self, hashcode):
+    return self._heights.get(hashcode)
+
+
+  # read from the index, without decoding the block
+  def hash_at(self, height):
+    with self._lock:
+      if height < 0:
+        height += self._height
+      if not 0 <= height < self._height:
+        raise IndexError('block height out of range')
+      return self._read_entry(height)[3]
+
+
+  def append(self, block):
+    data = block.to_bytes(tsn_hash_only=False)
+    with self._lock:
+      self._append(block, data)
+
+  def _append(self, block, data):
+    segment, offset = self._tail
+    if offset > 0 and offset + len(data) > self.segment_size:
+      self._writer.close()
+      segment, offset = segment + 1, 0
+      self._writer = open(self._segment_path(segment), 'ab')
+
+    # the block goes to disk before the index record that points to it
+    self._writer.write(data)
+    self._writer.flush()
+    self._index.write(self._entry.pack(segment, offset, len(data), len(block.hashcode), block.hashcode))
+    self._index.flush()
+
+    self._tail = (segment, offset + len(data))
+    self._heights[block.hashcode] = self._height
+    self._cache[self._height] = block
+    self._height += 1
+
+
+  # only removing the top of the chain is supported: del store[height:]
+  def __delitem__(self, key):
+    with self._lock:
+      self._delete(key)
+
+  def _delete(self, key):
+    start = (key.start or 0) if isinstance(key, slice) else key
+    if start < 0:
+      start += self._height
+    if start >= self._height:
+      return
+
+    for height in range(start, self._height):
+      self._heights.pop(self._read_entry(height)[3], None)
+      self._cache.pop(height, None)
+    segment, offset, _, _ = self._read_entry(start)
+
+    # unmap everything that is going to shrink
+    self._release(self._index_map)
+    self._index_map = None
+    for s in [s for s in self._segments if s >= segment]:
+      f, m = self._segments.pop(s)
+      self._release(m)
+      f.close()
+
+    self._index.truncate(start * self._entry.size)
+    self._writer.close()
+    for s in range(segment + 1, self._tail[0] + 1):
+      os.remove(self._segment_path(s))
+    self._writer = open(self._segment_path(segment), 'ab')
+    self._writer.truncate(offset)
+
+    self._height = start
+    self._tail = (segment, offset)
+
+
+  @staticmethod
+  def _release(m):
+    if m is not None:
+      m.close()
+
+
+  def close(self):
+    with self._lock:
+      self._release(self._index_map)
+      self._index_map = None
+      for f, m in self._segments.values():
+        self._release(m)
+        f.close()
+      self._segments = {}
+      self._writer.close()
+      self._index.close()
@@ -0,0 +1,107 @@
+'''
+blocktree.py
+every known block, indexed by hash, with the cumulative work of its branch
+
+The miner's chain is the branch ending at the tip with the most work.
+Blocks of other branches are kept here (main chain blocks are read back
+from the chain itself), so a heavier branch can be switched to by
+disconnecting and reconnecting blocks. Blocks whose parent is unknown
+wait in an OrphanPool (see orphans.py) until it arrives.
+'''
+from block import Block
+
+
+# expected number of hashes behind a block
+def block_work(block):
+  return 2 ** (8 * block.difficulty)
+
+
+class BlockNode:
+  __slots__ = ('hashcode', 'prev_hash', 'height', 'work', 'block')
+
+  def __init__(self, hashcode, prev_hash, height, work, block=None):
+    self.hashcode = hashcode
+    self.prev_hash = prev_hash
+    self.height = height
+    self.work = work
+    # only kept while the block is off the main chain
+    self.block = block
+
+
+class BlockTree:
+  # side branches forking further below the tip than this are forgotten
+  max_fork_depth = 1000
+
+  def __init__(self):
+    self.nodes = {}
+    self.children = {}
+    self.side = set()
+
+
+  def __contains__(self, hashcode):
+    return hashcode in self.nodes
+
+  def get(self, hashcode):
+    return self.nodes.get(hashcode)
+
+
+  # index the blocks of a chain, reading only their hashes
+  def rebuild(self, chain):
+    self.__init__()
+    if len(chain) == 0:
+      return
+    # difficulty is the same for every block
+    work = block_work(Block)
+    prev_hash = b''
+    for height in range(len(chain)):
+      hashcode = chain.hash_at(height)
+      self._insert(BlockNode(hashcode, prev_hash, height, work * (height + 1)))
+      prev_hash = hashcode
+
+
+  def _insert(self, node):
+    self.nodes[node.hashcode] = node
+    self.children.setdefault(node.prev_hash, set()).add(node.hashcode)
+
+
+  # add a block whose parent is known, off the main chain until connected
+  def add(self, block):
+    parent = self.nodes.get(block.prev_hash)
+    if parent is None:
+      height, work = 0, block_work(block)
+    else:
+      height, work = parent.height + 1, parent.work + block_work(block)
+    node = BlockNode(block.hashcode, block.prev_hash, height, work, block)
+    self._insert(node)
+    self.side.add(node.hashcode)
+    return node
+
+
+  def set_main(self, hashcode):
+    node = self.nodes[hashcode]
+    node.block = None
+    self.side.discard(hashcode)
+
+
+  def set_side(self, block):
+    self.nodes[block.hashcode].block = block
+    self.side.add(block.hashcode)
+
+
+  # forget a block and everything built on it
+  def remove(self, hashcode):
+    stack = [hashcode]
+    while stack:
+      h = stack.pop()
+      node = self.nodes.pop(h, None)
+      if node is None:
+        continue
+      self.side.discard(h)
+      self.children.get(node.prev_hash, set()).discard(h)
+      stack.extend(self.children.pop(h, ()))
+
+
+  def prune(self, tip_height):
+    for h in [h for h in self.side if self.nodes[h].height < tip_height - self.max_fork_depth]:
+      self.remove(h)
+
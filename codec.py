@@ -0,0 +1,210 @@
+'''
+codec.py
+compact binary encoding of transactions
+
+Layout (version 1):
+  magic (1 byte, 0x00) | version (1 byte) | digest (32 bytes)
+  timestamp length (varint) | timestamp
+  number of senders (varint) | per sender: has digest (1 byte) [digest (32 bytes)] | address (64 bytes)
+  number of receivers (varint) | per receiver: amount in 1e-8 units (varint) | address (64 bytes)
+  number of signatures (varint) | signatures (64 bytes each)
+
+Digests are raw bytes everywhere. Keys and signatures travel as raw bytes
+and are turned back into the base64 form the rest of the code uses, so a
+transaction has the same digest whichever format it was encoded in. The
+legacy text format never starts with 0x00, which is how the two are told
+apart.
+
+That only holds for transactions check_transaction accepts: amounts that
+are non-negative floats exact in 1e-8 units, and keys, signatures and
+digests of their fixed size, in canonical base64. Transactions are checked
+when parsed from the legacy format and when admitted, so nothing else
+reaches the encoder.
+'''
+import math
+from base64 import b64decode
+from binascii import a2b_base64, b2a_base64
+
+MAGIC = 0
+VERSION = 1
+DIGEST_SIZE = 32
+KEY_SIZE = 64
+SIGNATURE_SIZE = 64
+AMOUNT_SCALE = 10**8
+# largest amount in units, so an amount always fits a signed 64 bit integer
+MAX_UNITS = 2**63 - 1
+
+
+def is_compact(data):
+  return len(data) > 1 and data[0] == MAGIC
+
+
+# digest of an encoded transaction, read without decoding the rest
+def peek_digest(data):
+  if is_compact(data):
+    return bytes(data[2:2 + DIGEST_SIZE])
+  return b64decode(data[:data.index(b'\n')])
+
+
+_HEADER = bytes((MAGIC, VERSION))
+
+# one-byte varints, the common case for counts and lengths
+_SMALL = [bytes((n,)) for n in range(0x80)]
+
+def encode_varint(n):
+  if n < 0x80:
+    if n < 0:
+      raise ValueError('varint must not be negative')
+    return _SMALL[n]
+  out = bytearray()
+  while n >= 0x80:
+    out.append((n & 0x7f) | 0x80)
+    n >>= 7
+  out.append(n)
+  return bytes(out)
+
+
+# return (value, next offset)
+def decode_varint(view, offset):
+  n = shift = 0
+  while True:
+    b = view[offset]
+    offset += 1
+    n |= (b & 0x7f) << shift
+    if b < 0x80:
+      return n, offset
+    shift += 7
+
+
+def _fixed(value, size, raw=False):
+  if not raw:
+    value = a2b_base64(value)
+  if len(value) != size:
+    raise ValueError('expected {} bytes, got {}'.format(size, len(value)))
+  return value
+
+
+# the raw bytes of a base64 value, which must encode exactly size bytes and be written
+# the way b2a_base64 writes them, or decoding would not give the value back
+def _canonical(value, size):
+  raw = _fixed(value, size)
+  if b2a_base64(raw, newline=False) != value:
+    raise ValueError('non canonical base64')
+  return raw
+
+
+# amount as a whole number of 1e-8 units, for amounts that come back unchanged from it
+def amount_units(amount):
+  if type(amount) is not float or not math.isfinite(amount * AMOUNT_SCALE) or math.copysign(1., amount) < 0:
+    raise ValueError('amount must be a non-negative float, got {!r}'.format(amount))
+  units = round(amount * AMOUNT_SCALE)
+  if units > MAX_UNITS:
+    raise ValueError('amount {!r} is too large'.format(amount))
+  if units / AMOUNT_SCALE != amount:
+    raise ValueError('amount {!r} is not a whole number of 1e-8 units'.format(amount))
+  return units
+
+
+def encode_amount(amount):
+  return encode_varint(amount_units(amount))
+
+
+# raise ValueError unless tsn goes through the compact format unchanged
+def check_transaction(tsn):
+  try:
+    _check_transaction(tsn)
+  except TypeError:
+    raise ValueError('malformed transaction fields')
+
+def _check_transaction(tsn):
+  _fixed(tsn.Digest, DIGEST_SIZE, raw=True)
+  if type(tsn.Timestamp) is not bytes:
+    raise ValueError('timestamp must be bytes')
+  for digest, address in tsn.Senders:
+    if digest:
+      _fixed(digest, DIGEST_SIZE, raw=True)
+    _canonical(address, KEY_SIZE)
+  for amount, address in tsn.Receivers:
+    amount_units(amount)
+    _canonical(address, KEY_SIZE)
+  for sig in tsn.Signatures:
+    _canonical(sig, SIGNATURE_SIZE)
+
+
+def encode_transaction(tsn):
+  senders, receivers, signatures = tsn.Senders, tsn.Receivers, tsn.Signatures
+  out = [_HEADER, _fixed(tsn.Digest, DIGEST_SIZE, raw=True),
+         encode_varint(len(tsn.Timestamp)), tsn.Timestamp, encode_varint(len(senders))]
+  # _fixed is inlined for keys and signatures, this runs for every transaction we build
+  append = out.append
+  for digest, address in senders:
+    append(b'\x01' + _fixed(digest, DIGEST_SIZE, raw=True) if digest else b'\x00')
+    key = a2b_base64(address)
+    if len(key) != KEY_SIZE:
+      raise ValueError('expected {} bytes, got {}'.format(KEY_SIZE, len(key)))
+    append(key)
+
+  append(encode_varint(len(receivers)))
+  for amount, address in receivers:
+    append(encode_varint(amount_units(amount)))
+    key = a2b_base64(address)
+    if len(key) != KEY_SIZE:
+      raise ValueError('expected {} bytes, got {}'.format(KEY_SIZE, len(key)))
+    append(key)
+
+  append(encode_varint(len(signatures)))
+  for sig in signatures:
+    sig = a2b_base64(sig)
+    if len(sig) != SIGNATURE_SIZE:
+      raise ValueError('expected {} bytes, got {}'.format(SIGNATURE_SIZE, len(sig)))
+    append(sig)
+  return b''.join(out)
+
+
+# fill the fields of tsn from data, reading through a memoryview without intermediate copies
+def decode_transaction(data, tsn):
+  try:
+    return _decode_transaction(memoryview(data), tsn)
+  except IndexError:
+    raise ValueError('truncated transaction')
+
+def _decode_transaction(view, tsn):
+  if view[0] != MAGIC or view[1] != VERSION:
+    raise ValueError('unsupported transaction encoding')
+  offset = 2
+
+  def take(size):
+    nonlocal offset
+    chunk = view[offset:offset + size]
+    if len(chunk) != size:
+      raise ValueError('truncated transaction')
+    offset += size
+    return chunk
+
+  tsn.Digest = bytes(take(DIGEST_SIZE))
+  size, offset = decode_varint(view, offset)
+  tsn.Timestamp = bytes(take(size))
+
+  n, offset = decode_varint(view, offset)
+  senders = []
+  for _ in range(n):
+    digest = bytes(take(DIGEST_SIZE)) if take(1)[0] else b''
+    senders.append([digest, b2a_base64(take(KEY_SIZE), newline=False)])
+  tsn.Senders = senders
+
+  n, offset = decode_varint(view, offset)
+  receivers = []
+  for _ in range(n):
+    units, offset = decode_varint(view, offset)
+    amount = units / AMOUNT_SCALE
+    # only what encode_amount writes, so the transaction encodes back to the same bytes
+    if units > MAX_UNITS or round(amount * AMOUNT_SCALE) != units:
+      raise ValueError('non-canonical amount')
+    receivers.append([amount, b2a_base64(take(KEY_SIZE), newline=False)])
+  tsn.Receivers = receivers
+
+  n, offset = decode_varint(view, offset)
+  tsn.Signatures = [b2a_base64(take(SIGNATURE_SIZE), newline=False) for _ in range(n)]
+  if offset != len(view):
+    raise ValueError('trailing bytes after transaction')
+  return tsn
@@ -0,0 +1,97 @@
+'''
+compact.py
+compact block relay
+
+A compact block carries the header of a block and a 6-byte short id per
+transaction instead of its digest. Short ids are keyed by the header and a
+random salt chosen by the sender, so nobody can craft transactions whose
+ids collide on every link. The receiver matches them against its own pool
+and asks the sender, by position, for the transactions it doesn't have.
+A block rebuilt from a colliding id doesn't hash to the announced hash,
+and is fetched in full instead.
+'''
+import os
+import pickle
+from hashlib import blake2b
+
+from block import Block
+
+SHORT_ID_SIZE = 6
+SALT_SIZE = 8
+
+
+def short_id_key(header, salt):
+  return blake2b(header + salt, digest_size=16).digest()
+
+
+def short_id(key, digest):
+  return blake2b(digest, key=key, digest_size=SHORT_ID_SIZE).digest()
+
+
+def encode_compact_block(block, salt=None):
+  salt = os.urandom(SALT_SIZE) if salt is None else salt
+  key = short_id_key(block.to_bytes(block_head_only=True), salt)
+  data = {'prev_hash': block.prev_hash, 'nonce': block.nonce, 'timestamp': block.timestamp,
+          'merkle_root': block.merkle_root, 'hashcode': block.hashcode, 'salt': salt,
+          'short_ids': b''.join(short_id(key, tsn.Digest) for tsn in block.transactions)}
+  return pickle.dumps(data)
+
+
+# a compact block being rebuilt, transactions not found yet are None
+class PartialBlock:
+  # expires: time after which the block is given up
+  def __init__(self, data, source=None, expires=0):
+    data = pickle.loads(data)
+    self.prev_hash = data['prev_hash']
+    self.nonce = data['nonce']
+    self.timestamp = data['timestamp']
+    self.hashcode = data['hashcode']
+    # the merkle root belongs to the header the ids are keyed by
+    header = Block(self.prev_hash, None, self.nonce, timestamp=self.timestamp)
+    header._merkle_root = data['merkle_root']
+    self.header = header.to_bytes(block_head_only=True)
+    self.key = short_id_key(self.header, data['salt'])
+
+    ids = data['short_ids']
+    self.short_ids = [bytes(ids[i:i + SHORT_ID_SIZE]) for i in range(0, len(ids), SHORT_ID_SIZE)]
+    self.transactions = [None] * len(self.short_ids)
+    self.source = source
+    self.expires = expires
+
+
+  # take what we can from pool, return the positions still missing
+  def fill(self, pool):
+    wanted = {}
+    for index, sid in enumerate(self.short_ids):
+      wanted.setdefault(sid, []).append(index)
+
+    # a short id shared by two pool transactions can't be resolved, leave it missing
+    found, ambiguous = {}, set()
+    for tsn in pool.values():
+      sid = short_id(self.key, tsn.Digest)
+      if sid in wanted:
+        if sid in found:
+          ambiguous.add(sid)
+        found[sid] = tsn
+    for sid, tsn in found.items():
+      if sid not in ambiguous:
+        for index in wanted[sid]:
+          self.transactions[index] = tsn
+    return self.missing()
+
+
+  def missing(self):
+    return [index for index, tsn in enumerate(self.transactions) if tsn is None]
+
+
+  # fill the given positions, return the positions still missing
+  def fill_missing(self, indexes, tsns):
+    for index, tsn in zip(indexes, tsns):
+      if 0 <= index < len(self.transactions):
+        self.transactions[index] = tsn
+    return self.missing()
+
+
+  # the full block, check its hash against self.hashcode
+  def to_block(self):
+    return Block(self.prev_hash, list(self.transactions), self.nonce, timestamp=self.timestamp)
@@ -3,14 +3,14 @@ crypto.py
 handling double sha256 hash and elipstic curve encryption
 
 All input format: bytestring
-HashFormat: bytestring
+HashFormat: raw 32-byte digest (base64 only for display and the legacy text format)
 Encryption Key Format: base64 bytestring
 
 '''
 
 from fastecdsa import curve, keys, ecdsa, point
 from hashlib import sha256
-from base64 import b64encode, b64decode
+from base64 import b64decode
 from util import *
 
 '''
@@ -21,28 +21,25 @@ from util import *
 #return hash in 32 bytes
 def double_sha256(m):
   d = sha256(m)
-  d = sha256(d.digest())
-  return b64encode(d.digest())
+  return sha256(d.digest()).digest()
 
-#T is the list of digest of all transaction in the block
-#n is the len of T
+#T is the list of digest of all transaction in the block, left unchanged
 #return the merkel root (size 32) of transaction list T
+#an odd digest at the end of a level is hashed alone, see merkle.py for the whole tree
 def merkle_root_generation(T):
-  n = len(T)
-  if n == 0:
+  if len(T) == 0:
     return None
-  elif n == 1:
-    return T[0]
-  else:
-    if n%2 != 0:
-      T.append(b'')
-    T = [double_sha256(i+j) for i, j in zip(T[::2], T[1::2])]
-    return merkle_root_generation (T)
+  while len(T) > 1:
+    T = [double_sha256(T[i] + (T[i+1] if i+1 < len(T) else b'')) for i in range(0, len(T), 2)]
+  return T[0]
 
-#get n-bytes prefix of message m converted to number
+#check that the n-bytes prefix of digest m is zero
+def check_prefix(m, n):
+  return not any(m[:n])
+
+#same, for a base64 digest
 def check_prefix_b64(m, n):
-  m = b64decode(m)
-  return int.from_bytes(m[:n], 'big') == 0
+  return check_prefix(b64decode(m), n)
 
 #concate nonce number n (size s bytes) to m
 def add_nonce(m, n, s):
@@ -57,7 +54,7 @@ def get_nonce(m, n):
     s+=1
     for i in range(2**(s*8)):
       temp = add_nonce(m, i, s)
-      if check_prefix_b64(double_sha256(temp), n):
+      if check_prefix(double_sha256(temp), n):
         next = False
         break
   return i, s
@@ -76,8 +73,11 @@ def get_keypair():
 def sign(m, PR):
   return u2a(ecdsa.sign(m, a2i(PR)))
 
+#errors raised by verify on a malformed signature or key
+VERIFY_ERRORS = (ValueError, ecdsa.EcdsaError)
+
 #verify a signature sig with m and public key PU (base64 bytes)
 def verify(sig, m, PU):
   x, y = a2u(PU)
-  PU = point.Point(x, y)
+  PU = point.Point(x, y, curve.P256)
   return ecdsa.verify(a2u(sig), m, PU)
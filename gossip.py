@@ -0,0 +1,133 @@
+'''
+gossip.py
+announce / request relay of transactions and blocks
+
+Instead of pushing every payload to every peer, a node announces the hash
+of a new item (INVENTORY) to the peers not known to have it, and peers ask
+(GET_DATA) only for the items they haven't seen. Payloads are then sent
+with their usual tag. Seen hashes are kept in bounded LRU caches, one for
+the node and one per peer, so duplicates are dropped before anything is
+downloaded or deserialized.
+'''
+from collections import OrderedDict
+from threading import Lock
+import pickle
+import time
+
+from network import INVENTORY, GET_DATA
+import metrics
+
+FETCH_SECONDS = metrics.histogram('gossip_fetch_seconds', 'time from asking a peer for an announced item to receiving it')
+
+
+# bounded set of recently seen keys, least recently used evicted first
+class SeenCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.keys = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    # return True if key was not seen yet
+    def add(self, key):
+        if key in self.keys:
+            self.keys.move_to_end(key)
+            return False
+        self.keys[key] = None
+        if len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+        return True
+
+
+class Gossip:
+    max_seen = 100000
+    max_peer_seen = 10000
+    # payloads kept to answer GET_DATA
+    max_stored = 5000
+    # seconds before an unanswered GET_DATA can go to another peer
+    request_timeout = 10
+    # source of the current time
+    clock = time.time
+
+    def __init__(self, network):
+        self.network = network
+        self.seen = SeenCache(self.max_seen)
+        self.peer_seen = {}
+        # hash -> (tag, payload)
+        self.stored = OrderedDict()
+        # hash -> time of the GET_DATA in flight
+        self.requested = {}
+        self.lock = Lock()
+
+    def _peer(self, host):
+        cache = self.peer_seen.get(host)
+        if cache is None:
+            cache = self.peer_seen[host] = SeenCache(self.max_peer_seen)
+        return cache
+
+    # announce a new item to every peer not known to have it
+    # exclude: hosts that sent it to us
+    def announce(self, tag, hashcode, payload, exclude=[]):
+        with self.lock:
+            self.seen.add(hashcode)
+            self.requested.pop(hashcode, None)
+            self.stored[hashcode] = (tag, payload)
+            self.stored.move_to_end(hashcode)
+            while len(self.stored) > self.max_stored:
+                self.stored.popitem(last=False)
+            hosts = [host for host in self.network.HOSTs
+                     if host not in exclude and self._peer(host).add(hashcode)]
+        inventory = pickle.dumps([(tag, hashcode)])
+        for host in hosts:
+            self.network.sending(host, inventory, INVENTORY)
+
+    # note an item received from host
+    # return False if it was seen already, and should be dropped
+    def receive(self, host, hashcode):
+        with self.lock:
+            self._peer(host).add(hashcode)
+            requested = self.requested.pop(hashcode, None)
+            if requested is not None:
+                FETCH_SECONDS.observe(self.clock() - requested)
+            return hashcode not in self.seen
+
+    # mark an item as processed, whether it was valid or not
+    def mark_seen(self, hashcode):
+        with self.lock:
+            self.seen.add(hashcode)
+
+    # ask host for the announced items we lack, and aren't already waiting for
+    def receive_inventory(self, host, data):
+        now = self.clock()
+        wanted = []
+        with self.lock:
+            if len(self.requested) > self.max_stored:
+                self.requested = {h: t for h, t in self.requested.items() if now - t < self.request_timeout}
+            peer = self._peer(host)
+            for tag, hashcode in pickle.loads(data):
+                peer.add(hashcode)
+                if hashcode in self.seen:
+                    continue
+                if hashcode in self.requested and now - self.requested[hashcode] < self.request_timeout:
+                    continue
+                self.requested[hashcode] = now
+                wanted.append(hashcode)
+        if wanted:
+            self.network.sending(host, pickle.dumps(wanted), GET_DATA)
+
+    # send host the requested items we still have
+    def serve(self, host, data):
+        found = []
+        with self.lock:
+            peer = self._peer(host)
+            for hashcode in pickle.loads(data):
+                item = self.stored.get(hashcode)
+                if item is not None:
+                    peer.add(hashcode)
+                    found.append(item)
+        for tag, payload in found:
+            self.network.sending(host, payload, tag)
@@ -0,0 +1,210 @@
+'''
+ibd.py
+headers-first block download
+
+The headers following our chain are downloaded first from one peer, and
+each is checked for proof of work and linked to the previous one. Block
+bodies are then fetched in windows of consecutive blocks, spread over
+every peer, while more headers are still arriving. Bodies are checked
+against their header hash and connected in order as soon as the next one
+is in, so downloading, verifying and connecting overlap.
+'''
+import time
+import pickle
+import logging
+import itertools
+from threading import Lock
+
+from block import Block
+from EventHook import EventHook
+
+
+# the blocks of a reply to REQUEST_BODIES
+def decode_bodies(data):
+  return [Block.from_bytes(raw) for raw in pickle.loads(data)['blocks']]
+
+
+class BlockDownload:
+  window = 16                 # blocks per body request
+  max_requests_per_peer = 2
+  max_ahead = 1024            # bodies fetched beyond the last connected block
+  request_timeout = 30        # seconds before a window is asked from another peer
+  # source of the current time
+  clock = time.time
+
+  def __init__(self, miner):
+    self.miner = miner
+    self.active = False
+    self.hashes = []
+    self.lock = Lock()
+    self.connect_lock = Lock()
+    self._ids = itertools.count()
+
+    # fired as (locator, host) to ask host for the headers following locator
+    self.on_headers_requested_listeners = EventHook()
+    # fired as (hashes, host) to ask host for these blocks
+    self.on_bodies_requested_listeners = EventHook()
+
+
+  def _reset(self):
+    # hashes of the blocks to download, in chain order
+    self.hashes = []
+    # hashcode -> position in hashes
+    self.index = {}
+    # position -> downloaded block
+    self.bodies = {}
+    # request id -> (host, positions, time sent); position -> request id
+    self.requests = {}
+    self.assigned = {}
+    # next position to connect
+    self.connected = 0
+    self.headers_done = False
+
+
+  # start downloading from host, where the headers come from
+  def start(self, host):
+    with self.lock:
+      self._reset()
+      self.active = True
+    logging.info('IBD - downloading headers from {}'.format(host))
+    self.miner.start_download()
+    self.on_headers_requested_listeners.fire(self.miner.get_locator(), host)
+
+
+  # headers sent back by host, then ask everyone in hosts for the bodies
+  def add_headers(self, host, data, hosts):
+    data = pickle.loads(data)
+    with self.lock:
+      if not self.active:
+        return
+      for raw in data['headers']:
+        try: header = Block.from_header(raw)
+        except ValueError:
+          header = None
+        if header is not None and header.hashcode in self.index:
+          continue
+        # like sync, the first block is assumed correct
+        if header is None or not self._links(header) or not (header.prev_hash == b'' or header.validate(strict=False)):
+          logging.error('IBD - invalid header from {}, not asking it for more'.format(host))
+          data['headers'] = []
+          break
+        self.index[header.hashcode] = len(self.hashes)
+        self.hashes.append(header.hashcode)
+
+      last = self.hashes[-1] if self.hashes else None
+      more = len(data['headers']) >= self.miner.max_headers
+      self.headers_done = not more
+    if more:
+      # continue after the last header, or from our chain if it forked below it
+      self.on_headers_requested_listeners.fire([last] + self.miner.get_locator(), host)
+    self._connect()
+    self._schedule(hosts)
+
+
+  # the first header must follow a block we know of, the others the previous header
+  def _links(self, header):
+    if self.hashes:
+      return header.prev_hash == self.hashes[-1]
+    if len(self.miner.chain) == 0:
+      return header.prev_hash == b''
+    return header.prev_hash in self.miner.tree
+
+
+  # bodies sent back by host, connect what is in order and keep the windows full
+  # blocks that are not part of this download are ignored
+  def add_bodies(self, host, blocks, hosts):
+    with self.lock:
+      if not self.active:
+        return
+      for block in blocks:
+        position = self.index.get(block.hashcode)
+        # the hash covers the transactions through the merkle root
+        if position is None or position < self.connected:
+          continue
+        self.bodies[position] = block
+        request = self.assigned.pop(position, None)
+        if request in self.requests and not any(p in self.assigned for p in self.requests[request][1]):
+          del self.requests[request]
+    self._connect()
+    self._schedule(hosts)
+
+
+  # connect the consecutive bodies following the last connected one
+  def _connect(self):
+    with self.connect_lock:
+      while True:
+        with self.lock:
+          if not self.active:
+            return
+          run = []
+          while self.connected + len(run) in self.bodies:
+            run.append(self.bodies.pop(self.connected + len(run)))
+          finished = not run and self.headers_done and self.connected >= len(self.hashes)
+        if finished:
+          logging.info('IBD - download finished, {} blocks'.format(self.connected))
+          self.stop()
+          self._finish()
+          return
+        if not run:
+          return
+        if not self._apply(run):
+          logging.error('IBD - invalid block downloaded')
+          self.stop()
+          self._fail()
+          return
+        with self.lock:
+          self.connected += len(run)
+
+
+  # what is done with the blocks, in order, return False at the first invalid one
+  def _apply(self, blocks):
+    return self.miner.connect_blocks(blocks)
+
+  def _finish(self):
+    self.miner.finish_download()
+
+  # falling back to the locator sync
+  def _fail(self):
+    self.miner.trigger_sync()
+
+
+  # hand out the missing windows ahead of the last connected block to peers with room
+  def _schedule(self, hosts):
+    now = self.clock()
+    sends = []
+    with self.lock:
+      if not self.active or not hosts:
+        return
+      for request, (_, positions, sent) in list(self.requests.items()):
+        if now - sent > self.request_timeout:
+          del self.requests[request]
+          for position in positions:
+            if self.assigned.get(position) == request:
+              del self.assigned[position]
+
+      load = {host: 0 for host in hosts}
+      for host, _, _ in self.requests.values():
+        if host in load:
+          load[host] += 1
+
+      end = min(len(self.hashes), self.connected + self.max_ahead)
+      missing = [p for p in range(self.connected, end) if p not in self.bodies and p not in self.assigned]
+      for start in range(0, len(missing), self.window):
+        host = min(load, key=load.get)
+        if load[host] >= self.max_requests_per_peer:
+          break
+        positions = missing[start:start + self.window]
+        request = next(self._ids)
+        self.requests[request] = (host, positions, now)
+        for position in positions:
+          self.assigned[position] = request
+        load[host] += 1
+        sends.append(([self.hashes[p] for p in positions], host))
+
+    for hashes, host in sends:
+      self.on_bodies_requested_listeners.fire(hashes, host)
+
+
+  def stop(self):
+    with self.lock:
+      self.active = False
@@ -0,0 +1,123 @@
+'''
+ledger.py
+maintaining the address -> balance state of the chain incrementally
+'''
+import os
+import pickle
+from collections import ChainMap
+
+class BalanceIndex:
+  # undo records kept in a checkpoint, as deep as a reorg can go (see BlockTree.max_fork_depth)
+  max_undo = 1000
+
+  # a wallet spends its whole balance whenever it sends a transaction
+  # (the change comes back as one of the receivers), so the balance of an address
+  # is reset by each transaction it signs and increased by each output it receives
+  # unlike the chain scan this replaces, which never matched senders and summed every
+  # receipt, a send drops what the sender received earlier in the same block, as its
+  # wallet only counts receipts once their block is confirmed
+  def __init__(self):
+    self.balances = {}
+    # one undo record per connected block: {address: balance before the block}
+    self.undo = []
+    # height of the first block with an undo record, above a snapshot
+    self.base = 0
+
+
+  def __len__(self):
+    return self.base + len(self.undo)
+
+
+  def balance(self, address):
+    return self.balances.get(address, 0)
+
+
+  def connect(self, block):
+    changed = {}
+    for tsn in block.transactions:
+      self._apply(tsn, changed)
+    self.undo.append(changed)
+
+
+  # a scratch index on top of this one, to check the transactions of a block one after
+  # the other, each against the balances the ones before it leave; this one is untouched
+  def overlay(self):
+    scratch = BalanceIndex()
+    scratch.balances = ChainMap({}, self.balances)
+    return scratch
+
+
+  # apply a single transaction, without an undo record
+  def apply(self, tsn):
+    self._apply(tsn, {})
+
+
+  def disconnect(self):
+    changed = self.undo.pop()
+    for address, balance in changed.items():
+      if balance is None:
+        self.balances.pop(address, None)
+      else:
+        self.balances[address] = balance
+
+
+  # undo blocks until the index matches a chain of the given height
+  def rollback(self, height):
+    if height < self.base:
+      raise ValueError('cannot roll back below the snapshot at height {}'.format(self.base))
+    while len(self) > height:
+      self.disconnect()
+
+
+  # balances: the state below chain.base, taken from a snapshot
+  def rebuild(self, chain, balances=None):
+    self.balances = dict(balances or {})
+    self.undo = []
+    self.base = chain.base
+    for block in chain:
+      self.connect(block)
+
+
+  # write the balances at the tip of chain to path, with the undo records of the last blocks
+  # written to a temporary file first, so a crash leaves the previous checkpoint
+  def save(self, path, chain):
+    height = len(self)
+    data = {'height': height, 'hashcode': chain.hash_at(height - 1) if height else b'',
+            'balances': self.balances, 'undo': self.undo[-self.max_undo:]}
+    with open(path + '.tmp', 'wb') as f:
+      pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+  # rebuild from the checkpoint at path, replaying only the blocks of chain above it
+  # return False, leaving the index unchanged, if there is none or it is not on chain
+  def load(self, path, chain):
+    try:
+      with open(path, 'rb') as f:
+        data = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+      return False
+    height = data['height']
+    if not max(chain.base, 1) <= height <= len(chain) or chain.hash_at(height - 1) != data['hashcode']:
+      return False
+
+    self.balances = data['balances']
+    self.undo = data['undo']
+    self.base = height - len(self.undo)
+    for h in range(height, len(chain)):
+      self.connect(chain[h])
+    return True
+
+
+  def _apply(self, tsn, changed):
+    for address in set(sender[1] for sender in tsn.Senders):
+      if address not in changed:
+        changed[address] = self.balances.get(address)
+      self.balances[address] = 0.
+
+    for amount, address in tsn.Receivers:
+      if address not in changed:
+        changed[address] = self.balances.get(address)
+      self.balances[address] = self.balances.get(address, 0) + amount
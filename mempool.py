@@ -0,0 +1,163 @@
+'''
+mempool.py
+pool of verified transactions waiting for a block
+
+Transactions are ordered by a priority index (arrival order, or fee then
+arrival order), so building a block template only touches the k best
+entries. The pool is capped in bytes and evicts its worst entries when
+full. A send spends the whole balance of its sender (see ledger.py), so
+the pool refuses a transaction from a sender that a pooled transaction
+already spends from, whatever input digests the two name.
+'''
+import heapq
+import itertools
+from threading import RLock
+
+
+class Mempool:
+  AGE = 'age'
+  FEE = 'fee'
+
+  # max_bytes: cap on the compact size of all pooled transactions
+  # policy: AGE (oldest first) or FEE (highest fee first, then oldest)
+  def __init__(self, max_bytes=64 << 20, policy=AGE):
+    self.max_bytes = max_bytes
+    self.policy = policy
+    self.size = 0
+    # digest -> (tsn, fee, seq, size)
+    self._entries = {}
+    # best first and worst first; removed entries are skipped lazily
+    self._best = []
+    self._worst = []
+    # sender address -> digest of the pooled transaction spending from it
+    self._spends = {}
+    self._seq = itertools.count()
+    self._lock = RLock()
+
+
+  def _key(self, fee, seq):
+    return (-fee, seq) if self.policy == self.FEE else (seq,)
+
+
+  @staticmethod
+  def _inputs(tsn):
+    return set(address for _, address in tsn.Senders)
+
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, digest):
+    return digest in self._entries
+
+  def __getitem__(self, digest):
+    return self._entries[digest][0]
+
+  def __iter__(self):
+    return iter(list(self._entries))
+
+  def get(self, digest, default=None):
+    entry = self._entries.get(digest)
+    return default if entry is None else entry[0]
+
+  def values(self):
+    with self._lock:
+      return [entry[0] for entry in self._entries.values()]
+
+  def items(self):
+    with self._lock:
+      return [(digest, entry[0]) for digest, entry in self._entries.items()]
+
+
+  # digests of pooled transactions spending from any sender of tsn
+  def conflicts(self, tsn):
+    with self._lock:
+      found = set(self._spends.get(i) for i in self._inputs(tsn))
+      found.discard(None)
+      found.discard(tsn.Digest)
+      return found
+
+
+  # return True if tsn is now in the pool
+  # tsn is refused unless it is well formed, so it can be sized and relayed
+  def add(self, tsn, fee=0):
+    if not tsn.well_formed():
+      return False
+    with self._lock:
+      if tsn.Digest in self._entries or self.conflicts(tsn):
+        return False
+
+      size = len(tsn.to_bytes(compact=True))
+      seq = next(self._seq)
+      key = self._key(fee, seq)
+      # make room by evicting entries ranked below the newcomer
+      while self.size + size > self.max_bytes:
+        worst = self._peek(self._worst, worst=True)
+        if worst is None or self._key(*self._entries[worst][1:3]) < key:
+          return False
+        self.pop(worst)
+
+      self._entries[tsn.Digest] = (tsn, fee, seq, size)
+      self.size += size
+      for i in self._inputs(tsn):
+        self._spends[i] = tsn.Digest
+      heapq.heappush(self._best, (key, tsn.Digest))
+      heapq.heappush(self._worst, (tuple(-k for k in key), tsn.Digest))
+      return True
+
+
+  def pop(self, digest, default=None):
+    with self._lock:
+      entry = self._entries.pop(digest, None)
+      if entry is None:
+        return default
+      tsn, _, _, size = entry
+      self.size -= size
+      for i in self._inputs(tsn):
+        if self._spends.get(i) == digest:
+          del self._spends[i]
+      self._compact()
+      return tsn
+
+
+  # drop pooled transactions made invalid by tsn being included in a block
+  def remove_conflicts(self, tsn):
+    with self._lock:
+      for digest in self.conflicts(tsn):
+        self.pop(digest)
+
+
+  # the k best transactions, in O(k log n)
+  def select(self, k):
+    with self._lock:
+      chosen = []
+      while self._best and len(chosen) < k:
+        key, digest = heapq.heappop(self._best)
+        entry = self._entries.get(digest)
+        if entry is not None and self._key(entry[1], entry[2]) == key:
+          chosen.append((key, digest))
+      for item in chosen:
+        heapq.heappush(self._best, item)
+      return [self._entries[digest][0] for _, digest in chosen]
+
+
+  # top of heap, dropping entries of transactions that left (or left and came back)
+  def _peek(self, heap, worst=False):
+    while heap:
+      key, digest = heap[0]
+      entry = self._entries.get(digest)
+      if entry is not None:
+        current = self._key(entry[1], entry[2])
+        if key == (tuple(-k for k in current) if worst else current):
+          return digest
+      heapq.heappop(heap)
+    return None
+
+
+  # rebuild the heaps once they are mostly stale entries
+  def _compact(self):
+    if len(self._best) > 2 * len(self._entries) + 64:
+      self._best = [(self._key(fee, seq), digest) for digest, (_, fee, seq, _) in self._entries.items()]
+      self._worst = [(tuple(-k for k in key), digest) for key, digest in self._best]
+      heapq.heapify(self._best)
+      heapq.heapify(self._worst)
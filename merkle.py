@@ -0,0 +1,102 @@
+'''
+merkle.py
+merkle tree of the transactions of a block, with inclusion proofs
+
+The tree keeps every level, from the digests of the transactions up to the
+root, so a transaction added or replaced only rehashes its path to the root,
+and the path of any transaction can be handed out as a proof. Nodes are
+paired as in crypto.merkle_root_generation: an odd node at the end of a
+level is hashed alone, and a single digest is its own root.
+
+A light client holding a header checks a transaction with the proof alone:
+
+  index, path = tree.proof(digest)
+  verify_proof(digest, index, path, header_merkle_root)
+'''
+from crypto import double_sha256
+
+
+class MerkleTree:
+  def __init__(self, leaves=()):
+    # levels[0] holds the leaves, the last level the root
+    self.levels = [list(leaves)]
+    level = self.levels[0]
+    while len(level) > 1:
+      level = [_parent(level, i) for i in range(0, len(level), 2)]
+      self.levels.append(level)
+
+  def __len__(self):
+    return len(self.levels[0])
+
+  @property
+  def root(self):
+    return self.levels[-1][0] if self.levels[0] else None
+
+  @property
+  def leaves(self):
+    return self.levels[0]
+
+
+  def add(self, leaf):
+    self.levels[0].append(leaf)
+    self._update(len(self.levels[0]) - 1)
+
+  def replace(self, index, leaf):
+    self.levels[0][index] = leaf
+    self._update(index)
+
+  # rehash the path from the leaf at index to the root
+  def _update(self, index):
+    levels = self.levels
+    k = 0
+    while len(levels[k]) > 1:
+      index -= index % 2
+      node = _parent(levels[k], index)
+      index //= 2
+      if k + 1 == len(levels):
+        levels.append([])
+      parent = levels[k + 1]
+      # a level grows by at most one node when a leaf is added
+      if index < len(parent):
+        parent[index] = node
+      else:
+        parent.append(node)
+      k += 1
+    del levels[k + 1:]
+
+
+  # position of leaf and the siblings on its path to the root, b'' for an odd node hashed alone
+  # None if leaf is not in the tree
+  def proof(self, leaf):
+    try:
+      index = self.levels[0].index(leaf)
+    except ValueError:
+      return None
+    path, i = [], index
+    for level in self.levels[:-1]:
+      sibling = i ^ 1
+      path.append(level[sibling] if sibling < len(level) else b'')
+      i //= 2
+    return index, path
+
+
+# hash of the node at index (even) and its sibling
+def _parent(level, index):
+  return double_sha256(level[index] + (level[index + 1] if index + 1 < len(level) else b''))
+
+
+# check that leaf sits at index under root, given its path from MerkleTree.proof
+def verify_proof(leaf, index, path, root):
+  if index < 0 or index >> len(path):
+    return False
+  node = leaf
+  for sibling in path:
+    # a node hashed alone ends its level, so it is never a right child
+    if index & 1:
+      if not sibling:
+        return False
+      node = double_sha256(sibling + node)
+    else:
+      node = double_sha256(node + sibling)
+    index >>= 1
+  return node == root
@@ -0,0 +1,242 @@
+'''
+metrics.py
+counters, gauges and histograms, served as text over HTTP
+
+Metrics are declared once at module level and updated on the hot paths.
+They cost a single attribute check until the registry is enabled, by
+enable() or serve(). serve() exposes them in the Prometheus text format:
+
+  curl http://127.0.0.1:9100/metrics
+'''
+import time
+import logging
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, from a cached signature check to a slow nonce search
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+
+class Metric:
+  kind = None
+
+  # labels: names of the labels, whose values are given on every update
+  def __init__(self, registry, name, help, labels):
+    self.registry = registry
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    # label values -> value
+    self.values = {}
+    self.lock = Lock()
+
+  def _format(self, labels, suffix='', extra=()):
+    pairs = list(zip(self.labels, labels)) + list(extra)
+    if not pairs:
+      return self.name + suffix
+    return '{}{}{{{}}}'.format(self.name, suffix, ','.join('{}="{}"'.format(k, v) for k, v in pairs))
+
+  def render(self):
+    lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+    with self.lock:
+      values = list(self.values.items())
+    lines.extend('{} {}'.format(self._format(labels), value) for labels, value in values)
+    return lines
+
+
+class Counter(Metric):
+  kind = 'counter'
+
+  def inc(self, amount=1, labels=()):
+    if not self.registry.enabled:
+      return
+    with self.lock:
+      self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+  kind = 'gauge'
+
+  def __init__(self, registry, name, help, labels):
+    Metric.__init__(self, registry, name, help, labels)
+    # label values -> function called when rendering
+    self.functions = {}
+
+  def set(self, value, labels=()):
+    if not self.registry.enabled:
+      return
+    with self.lock:
+      self.values[labels] = value
+
+  def inc(self, amount=1, labels=()):
+    if not self.registry.enabled:
+      return
+    with self.lock:
+      self.values[labels] = self.values.get(labels, 0) + amount
+
+  def dec(self, amount=1, labels=()):
+    self.inc(-amount, labels)
+
+  # read the value from fn when rendering, which costs nothing on the hot path
+  def set_function(self, fn, labels=()):
+    with self.lock:
+      self.functions[labels] = fn
+
+  def render(self):
+    with self.lock:
+      functions = list(self.functions.items())
+    for labels, fn in functions:
+      try: value = fn()
+      except Exception:
+        logging.exception('Metrics - failed to read {}'.format(self.name))
+        continue
+      with self.lock:
+        self.values[labels] = value
+    return Metric.render(self)
+
+
+class Histogram(Metric):
+  kind = 'histogram'
+
+  def __init__(self, registry, name, help, labels, buckets=BUCKETS):
+    Metric.__init__(self, registry, name, help, labels)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value, labels=()):
+    if not self.registry.enabled:
+      return
+    index = bisect_left(self.buckets, value)
+    with self.lock:
+      counts = self.values.get(labels)
+      if counts is None:
+        # one count per bucket, one above the last bucket, and the sum
+        counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.]
+      counts[index] += 1
+      counts[-1] += value
+
+  # time a block of code
+  def time(self, labels=()):
+    return _Timer(self, labels)
+
+  def render(self):
+    lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+    with self.lock:
+      values = [(labels, list(counts)) for labels, counts in self.values.items()]
+    for labels, counts in values:
+      total = 0
+      for bound, count in zip(self.buckets + ('+Inf',), counts):
+        total += count
+        lines.append('{} {}'.format(self._format(labels, '_bucket', [('le', bound)]), total))
+      lines.append('{} {}'.format(self._format(labels, '_sum'), counts[-1]))
+      lines.append('{} {}'.format(self._format(labels, '_count'), total))
+    return lines
+
+
+class _Timer:
+  __slots__ = ('histogram', 'labels', 'start')
+
+  def __init__(self, histogram, labels):
+    self.histogram = histogram
+    self.labels = labels
+
+  def __enter__(self):
+    self.start = time.perf_counter() if self.histogram.registry.enabled else None
+    return self
+
+  def __exit__(self, *exc):
+    if self.start is not None:
+      self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+class Registry:
+  def __init__(self):
+    self.enabled = False
+    # name -> metric, in the order they were declared
+    self.metrics = {}
+    self.lock = Lock()
+    self.server = None
+
+  def _get(self, cls, name, help, labels, *args):
+    with self.lock:
+      metric = self.metrics.get(name)
+      if metric is None:
+        metric = self.metrics[name] = cls(self, name, help, labels, *args)
+      elif type(metric) is not cls:
+        raise ValueError('metric {} already declared as a {}'.format(name, metric.kind))
+      return metric
+
+  def counter(self, name, help='', labels=()):
+    return self._get(Counter, name, help, labels)
+
+  def gauge(self, name, help='', labels=()):
+    return self._get(Gauge, name, help, labels)
+
+  def histogram(self, name, help='', labels=(), buckets=BUCKETS):
+    return self._get(Histogram, name, help, labels, buckets)
+
+
+  def render(self):
+    with self.lock:
+      metrics = list(self.metrics.values())
+    return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+  # enable the registry and serve it at http://address:port/metrics from a daemon thread
+  def serve(self, port=9100, address='127.0.0.1'):
+    registry = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+          self.send_error(404)
+          return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        logging.debug('Metrics - ' + format % args)
+
+    self.enabled = True
+    self.server = ThreadingHTTPServer((address, port), Handler)
+    Thread(target=self.server.serve_forever, daemon=True).start()
+    logging.info('Metrics - serving on {}:{}'.format(address, port))
+    return self.server
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+serve = REGISTRY.serve
+
+
+def enable():
+  REGISTRY.enabled = True
+
+def disable():
+  REGISTRY.enabled = False
+
+def enabled():
+  return REGISTRY.enabled
+
+
+# time every call of the decorated function into histogram
+def timed(histogram, labels=()):
+  def decorate(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+      if not histogram.registry.enabled:
+        return fn(*args, **kwargs)
+      start = time.perf_counter()
+      try:
+        return fn(*args, **kwargs)
+      finally:
+        histogram.observe(time.perf_counter() - start, labels)
+    return wrapper
+  return decorate
@@ -3,214 +3,700 @@ miner.py
 '''
 from enum import Enum
 
+import os
 import time
-import random
 import logging
 import pickle
+from base64 import b64encode
+from collections import ChainMap, OrderedDict, namedtuple
+from contextlib import contextmanager
 
-from threading import Lock, RLock
+from threading import RLock, Event, Condition
 
 from transaction import Transaction
-from block import Block
+from block import Block, MissingTransactionsError
+from ledger import BalanceIndex
+from blockstore import BlockStore, MemoryChain
+from blocktree import BlockTree
+from orphans import OrphanPool
+from compact import PartialBlock
+from snapshot import Snapshot, SnapshotChain
+from mempool import Mempool
+from verifier import SignatureVerifier
 from EventHook import EventHook
+import metrics
+from profiler import ProfiledLock
 
 class Status(Enum):
   INVALID = 0
   VALID = 1
   DUPLICATE = 2
+  ORPHAN = 3
+
+ADD_TRANSACTION_SECONDS = metrics.histogram('miner_add_transaction_seconds', 'time to admit a transaction to the pool')
+TRANSACTIONS = metrics.counter('miner_transactions_total', 'transactions received, by status', ('status',))
+RECEIVE_BLOCK_SECONDS = metrics.histogram('miner_receive_block_seconds', 'time to handle a received block, by format', ('format',))
+BLOCKS = metrics.counter('miner_blocks_received_total', 'blocks received, by status', ('status',))
+SYNC_SECONDS = metrics.histogram('miner_sync_batch_seconds', 'time to apply a batch of synced blocks')
+SYNC_BLOCKS = metrics.counter('miner_synced_blocks_total', 'blocks received by sync')
+REORGS = metrics.counter('miner_reorgs_total', 'switches to another branch')
+CHAIN_HEIGHT = metrics.gauge('miner_chain_height', 'blocks in our chain')
+POOL_SIZE = metrics.gauge('miner_pool_transactions', 'transactions in the pool')
+ORPHANS = metrics.gauge('miner_orphan_blocks', 'blocks waiting for a parent or transactions')
+
+# our chain as seen by readers, replaced as a whole whenever the chain changes
+# height is -1 and hashcode b'' while the chain is empty
+ChainTip = namedtuple('ChainTip', ('version', 'height', 'hashcode', 'work'))
 
 class Miner:
   block_capacity = 5
   min_sync_interval = 30      # seconds
+  sync_timeout = 60           # seconds without a sync reply before asking again
+  sync_batch_size = 50        # blocks returned per sync request
+  max_locator_size = 32
+  max_headers = 2000          # headers returned per request
+  clock = time.time
+  max_fetch_depth = 8         # orphans in a row fetched one parent at a time, before syncing instead
+  checkpoint_interval = 100   # blocks between two balance checkpoints of a stored chain
 
   # The general rule is as follows
-  # 1. if the miner needs to be synced
-  #   + no mining is allowed, current task will also be cancelled
-  #   + newly received block must wait, unless we are already handling it
+  # 1. if the miner needs to be synced, no mining is allowed
   # 2. if the newly received block is valid, the mining task will be aborted, even if it's done
-  chain_lock = Lock()
-  sync_lock = Lock()
-
-  def __init__(self):
-    self.chain = []
-    self.tsn_pool = {}
+  #
+  # Locks belong to each miner:
+  # - chain_lock makes a single writer of the chain, the tree, the balances and the parked blocks
+  #   replies to peers hold it while picking blocks, and encode them after releasing it
+  #   it is reentrant, the writer reads our locator when it triggers a sync
+  # - pool_lock is held by admission around its fund check and pool insertion, and by the writer
+  #   around its balance and pool updates, always after chain_lock
+  # signatures are checked before taking either, so admission runs alongside block validation
+  # readers that only need our tip use self.tip, without any lock
+
+  # data_dir: keep the chain in a BlockStore there instead of in memory
+  # pool: Mempool to use, one ordered by arrival by default
+  # clock: source of the current time, time.time by default
+  def __init__(self, verifier=None, data_dir=None, pool=None, clock=None):
+    if clock is not None:
+      self.clock = clock
+    self.chain_lock = ProfiledLock('chain_lock', RLock())
+    self.pool_lock = ProfiledLock('pool_lock')
+    self.tip = ChainTip(0, -1, b'', 0)
+    self.data_dir = data_dir
+    self.chain = BlockStore(data_dir) if data_dir else MemoryChain()
+    # the chain was started from this snapshot, see snapshot.py
+    self.snapshot = None
+    self.snapshot_verified = False
+    if data_dir and os.path.exists(self._snapshot_path()):
+      self.snapshot = Snapshot.read(self._snapshot_path())
+      self.chain = SnapshotChain(self.snapshot, self.chain)
+    self.balances = BalanceIndex()
+    self.tree = BlockTree()
+    self._rebuild_state()
+    self.orphans = OrphanPool(clock=self.clock)
+    # compact blocks waiting for transactions, by hash
+    self.partial_blocks = OrderedDict()
+    self.verifier = verifier or SignatureVerifier()
+    self.tsn_pool = pool if pool is not None else Mempool()
     self.new_block = None
+    # last block template that was never published, its merkle tree is reused by the next one
+    self.template = None
 
     self.pending_blocks = []
     self.invalid = []
 
     self.need_to_sync = False
-    self.last_sync = time.time()
-
+    self.synced = Event()
+    self.synced.set()
+    self.last_sync = self.clock()
+    # last block received while syncing, on a branch we may not have switched to yet
+    self.sync_cursor = None
+    # notified whenever the pool, the chain or the sync state changes
+    self.work_changed = Condition()
+
+    # fired with every block we mined, or received and resumed after waiting, to be relayed
     self.on_block_added_listeners = EventHook()
+    # fired with our locator whenever blocks should be requested from a peer
+    self.on_sync_requested_listeners = EventHook()
+    # fired as (hashcode, digests, source) for transactions a received block is waiting for
+    self.on_transactions_requested_listeners = EventHook()
+    # fired as (hashcode, source) for the unknown parent of a received block
+    self.on_block_requested_listeners = EventHook()
+    # fired as (hashcode, indexes, source) for transactions a compact block is waiting for
+    self.on_block_transactions_requested_listeners = EventHook()
+
+    CHAIN_HEIGHT.set_function(lambda: self.tip.height + 1)
+    POOL_SIZE.set_function(lambda: len(self.tsn_pool))
+    ORPHANS.set_function(lambda: len(self.orphans) + len(self.partial_blocks))
 
 
   def to_bytes(self):
-    data = {'chain': self.chain, 'pool': self.tsn_pool}
+    data = {'chain': list(self.chain), 'pool': self.tsn_pool.values()}
     return pickle.dumps(data)
 
 
   def restore(self, data):
     data = pickle.loads(data)
-    self.chain = data['chain']
-    self.tsn_pool = data['pool']
+    del self.chain[self.chain.base:]
+    for block in data['chain']:
+      self.chain.append(block)
+    self._rebuild_state()
+    for tsn in list(self.tsn_pool.values()):
+      self.tsn_pool.pop(tsn.Digest)
+    for tsn in data['pool']:
+      self.tsn_pool.add(tsn, self._fee(tsn))
+
+
+  # a stored chain restarts from its balance checkpoint, replaying only the blocks above it
+  def _rebuild_state(self):
+    with self.pool_lock:
+      if not (self.data_dir and self.balances.load(self._balances_path(), self.chain)):
+        self.balances.rebuild(self.chain, self.snapshot.balances if self.snapshot else None)
+    self.tree.rebuild(self.chain)
+    self._update_tip()
+
+
+  # publish a new tip to readers, after the chain and balances changed
+  def _update_tip(self):
+    if len(self.chain) == 0:
+      self.tip = ChainTip(self.tip.version + 1, -1, b'', 0)
+      return
+    hashcode = self.chain.hash_at(-1)
+    node = self.tree.get(hashcode)
+    self.tip = ChainTip(self.tip.version + 1, len(self.chain) - 1, hashcode, node.work if node is not None else 0)
+
+
+  def _snapshot_path(self):
+    return os.path.join(self.data_dir, 'snapshot.dat')
+
+  def _balances_path(self):
+    return os.path.join(self.data_dir, 'balances.dat')
+
+
+  # write the balance checkpoint of a stored chain, also done every checkpoint_interval blocks
+  def checkpoint(self):
+    if self.data_dir:
+      with self.chain_lock:
+        self.balances.save(self._balances_path(), self.chain)
+
+
+  # reply to a snapshot request: our balance state at our tip, or None if we have no chain
+  def get_snapshot(self):
+    with self.chain_lock:
+      if len(self.chain) == 0:
+        return None
+      return Snapshot.from_miner(self).to_bytes()
+
+
+  # start a new node from a peer's snapshot, instead of replaying every block
+  # return False if it can't be used
+  def load_snapshot(self, data):
+    try: snapshot = Snapshot.from_bytes(data)
+    except ValueError:
+      logging.exception('Miner - unusable snapshot')
+      return False
 
+    with self.chain_lock:
+      if len(self.chain) > 0:
+        return False
+      if self.data_dir:
+        snapshot.write(self._snapshot_path())
+      self.snapshot = snapshot
+      self.snapshot_verified = False
+      self.chain = SnapshotChain(snapshot, self.chain)
+      self._rebuild_state()
+      logging.info('Miner - started from a snapshot at height {}'.format(snapshot.height))
+      self._notify_work()
+    return True
+
+
+  # called once the blocks below the snapshot were downloaded and replayed
+  def finish_history_check(self, ok):
+    with self.chain_lock:
+      if ok:
+        logging.info('Miner - history below the snapshot verified')
+        self.snapshot_verified = True
+        return
 
-  def get_ledger_size(self):
-    return len(self.to_bytes())
+      # the snapshot was wrong: start over from an empty chain
+      logging.error('Miner - history does not match the snapshot, syncing from scratch')
+      top = self.chain.top
+      del top[:]
+      self.chain = top
+      self.snapshot = None
+      if self.data_dir:
+        os.remove(self._snapshot_path())
+      self._rebuild_state()
+    self.trigger_sync()
 
 
   def trigger_sync(self):
     self.need_to_sync = True
+    self.synced.clear()
+    self.last_sync = self.clock()
+    self.on_sync_requested_listeners.fire(self.get_locator())
+    # let the mining loop pick up the retry deadline
+    self._notify_work()
+
+
+  # hashes of our tip and of a sparse list of its ancestors, ending with the first block
+  # the step doubles after the first 10 entries, so the list stays short on a tall chain
+  # while syncing, the last block received comes first so the peer continues from there
+  def get_locator(self):
+    locator = []
+    with self.chain_lock:
+      if self.sync_cursor in self.tree and self.chain.height_of(self.sync_cursor) is None:
+        locator.append(self.sync_cursor)
+      height, step = len(self.chain) - 1, 1
+      while height > 0 and len(locator) < self.max_locator_size - 1:
+        locator.append(self.chain.hash_at(height))
+        if len(locator) >= 10:
+          step *= 2
+        height -= step
+      if len(self.chain) > 0:
+        locator.append(self.chain.hash_at(0))
+    return locator
+
+
+  # height following the most recent locator hash on our chain
+  def _locate(self, locator):
+    for hashcode in locator:
+      height = self.chain.height_of(hashcode)
+      if height is not None:
+        return height + 1
+    return 0
+
+
+  # reply to a sync request: the blocks following the most recent locator hash we know
+  def get_blocks(self, data):
+    locator = pickle.loads(data)
+    with self.chain_lock:
+      start = max(self._locate(locator), self.chain.base)
+      blocks, height = self.chain[start:start + self.sync_batch_size], len(self.chain)
+    blocks = [block.to_bytes(tsn_hash_only=False) for block in blocks]
+    return pickle.dumps({'height': height, 'blocks': blocks})
+
+
+  # reply to a headers request: the headers following the most recent locator hash we know
+  def get_headers(self, data):
+    locator = pickle.loads(data)
+    with self.chain_lock:
+      start = max(self._locate(locator), self.chain.base)
+      blocks, height = self.chain[start:start + self.max_headers], len(self.chain)
+    headers = [block.to_bytes(block_head_only=True) for block in blocks]
+    return pickle.dumps({'height': height, 'headers': headers})
+
+
+  # reply to a request for block bodies by hash, skipping the ones we don't know
+  def get_bodies(self, data):
+    hashcodes = pickle.loads(data)[:self.sync_batch_size]
+    with self.chain_lock:
+      blocks = [self._find_block(hashcode) for hashcode in hashcodes]
+    return pickle.dumps({'blocks': [block.to_bytes(tsn_hash_only=False) for block in blocks if block is not None]})
+
+
+  # a block we know of, on any branch, or None
+  # callers hold chain_lock, so the height still points at the block
+  def _find_block(self, hashcode):
+    height = self.chain.height_of(hashcode)
+    if height is not None:
+      # blocks below a snapshot are only known by hash
+      return self.chain[height] if height >= self.chain.base else None
+    node = self.tree.get(hashcode)
+    return node.block if node is not None else None
+
+
+  # reply to a request for the parent of an orphan: the full block, or None if unknown
+  def get_block(self, hashcode):
+    with self.chain_lock:
+      block = self._find_block(hashcode)
+    return block.to_bytes(tsn_hash_only=False) if block is not None else None
+
+
+  # reply to a request for the transactions a block is waiting for
+  # they are looked up in our pool, then in the block itself
+  def get_transactions(self, data):
+    data = pickle.loads(data)
+    found = {}
+    for digest in data['digests']:
+      tsn = self.tsn_pool.get(digest)
+      if tsn is not None:
+        found[digest] = tsn
+    if len(found) < len(data['digests']):
+      with self.chain_lock:
+        block = self._find_block(data['block'])
+      if block is not None:
+        found.update((tsn.Digest, tsn) for tsn in block.transactions if tsn.Digest in data['digests'])
+    return pickle.dumps([tsn.to_bytes(compact=True) for tsn in found.values()])
+
 
+  # reply to a light client: the header of a block and the inclusion proofs of the
+  # asked transactions it holds, see merkle.py; None if the block is unknown
+  def get_proofs(self, data):
+    data = pickle.loads(data)
+    with self.chain_lock:
+      block = self._find_block(data['block'])
+      height = self.chain.height_of(data['block'])
+    if block is None:
+      return None
+    proofs = {}
+    for digest in data['digests']:
+      proof = block.proof(digest)
+      if proof is not None:
+        proofs[digest] = proof
+    return pickle.dumps({'block': data['block'], 'header': block.to_bytes(block_head_only=True),
+                         'height': height, 'proofs': proofs})
+
+
+  # reply to a request for transactions of a compact block, by position in the block
+  def get_block_transactions(self, data):
+    data = pickle.loads(data)
+    with self.chain_lock:
+      block = self._find_block(data['block'])
+    if block is None:
+      return None
+    indexes = [i for i in data['indexes'] if 0 <= i < len(block.transactions)]
+    tsns = [block.transactions[i].to_bytes(compact=True) for i in indexes]
+    return pickle.dumps({'block': data['block'], 'indexes': indexes, 'tsns': tsns})
 
+
+  # apply one batch returned by a peer's get_blocks
+  # return True if the next batch should be requested from the same peer
+  @metrics.timed(SYNC_SECONDS)
   def sync_data(self, data):
     data = pickle.loads(data)
-    chain = data['chain']
-    pool = data['pool']
-    
-    # wait for all chain-related operations to complete
-    self.chain_lock.acquire()
+    blocks = [Block.from_bytes(block) for block in data['blocks']]
+    SYNC_BLOCKS.inc(len(blocks))
 
-    # suspend adding new blocks
-    if self.need_to_sync and not self.sync_lock.locked():
-      self.sync_lock.acquire()
+    # verify the signatures of the whole batch at once, before holding any lock
+    self.verifier.verify_many([tsn for block in blocks for tsn in block.transactions])
 
-    # abort mining
-    self._intercept_mining()
+    with self.chain_lock:
+      if not self._connect_run(blocks):
+        # the peer is of no use, keep syncing with someone else
+        return False
 
+      more = False
+      if len(blocks) > 0:
+        self.sync_cursor = blocks[-1].hashcode
+        more = self.tree.get(self.sync_cursor).height + 1 < data['height']
+
+      if not more:
+        # we are as far as this peer
+        self._end_sync()
+      return more
+
+
+  # hold back mining and received blocks while downloading blocks ourselves (see ibd.py)
+  def start_download(self):
+    self.need_to_sync = True
+    self.synced.clear()
+    self.last_sync = self.clock()
+    self._notify_work()
+
+
+  # connect consecutive downloaded blocks, return False at the first unusable one
+  def connect_blocks(self, blocks):
+    # verify the signatures of the whole run at once, before holding any lock
+    self.verifier.verify_many([tsn for block in blocks for tsn in block.transactions])
+
+    with self.chain_lock:
+      # progress keeps the sync retry away
+      self.last_sync = self.clock()
+      return self._connect_run(blocks)
+
+
+  def finish_download(self):
+    with self.chain_lock:
+      self._end_sync()
+
+
+  def _connect_run(self, blocks):
     # we need to assume the first block is correct now
-    # we will verify this in the next sync
-    if len(self.chain) == 0:
-      self.chain.append(chain[0])
+    if len(self.chain) == 0 and len(blocks) > 0:
+      self._append_chain(blocks[0])
 
-    diff = len(chain) - len(self.chain)
-    # if it's even behind us or doesn't match our latest block
-    if diff < 0 or self.chain[0] != chain[0] or self.chain[-1] != chain[len(self.chain)-1]:
-      return False
-    elif diff > 0:
-      initial_size = len(self.chain)
-      # append each block to chain
-      for block in chain[len(self.chain):]:
-        # if something is not right
-        if not self._handle_received_block(block):
-          # restore initial chain
-          self.chain = self.chain[:initial_size]
-          return False
-      
-      # all blocks are added to chain
-      # now to the pool
-      self.tsn_pool.update(pool)
+    for block in blocks:
+      if self._handle_received_block(block) in (Status.INVALID, Status.ORPHAN):
+        logging.debug('Miner - unusable block in downloaded run')
+        return False
+    return True
 
-      return False
 
-    # it is the same as us, then sync is complete
+  def _end_sync(self):
     self.need_to_sync = False
-    self.sync_lock.release()
-    return True
+    self.sync_cursor = None
+    self.synced.set()
+    self._notify_work()
 
 
+  @metrics.timed(ADD_TRANSACTION_SECONDS)
   def add_transaction(self, tsn):
+    # parked blocks take the transaction whether or not it fits our pool
+    if tsn.Digest in self.orphans.by_tsn:
+      self._resolve_transactions([tsn])
     if tsn.Digest in self.tsn_pool:
-      logging.debug('Miner - duplicated transaction: ' + tsn.Digest.decode())
-      return Status.DUPLICATE
-    if tsn.verify() and self.verify_fund(tsn):
-      self.tsn_pool[tsn.Digest] = tsn
-      logging.debug('Miner - one transaction added. Pool now has {} transactions'.format(len(self.tsn_pool)))
-      return Status.VALID
+      logging.debug('Miner - duplicated transaction: ' + b64encode(tsn.Digest).decode())
+      status = Status.DUPLICATE
     else:
-      logging.debug('Miner - invalid transaction: ' + tsn.Digest.decode() + str(tsn.verify()) + str(self.verify_fund(tsn)))
-      return Status.INVALID
+      # transactions built locally were not checked by a parser
+      verified = tsn.well_formed() and self.verifier.verify_many([tsn])[0]
+      # balances don't change while the fund check and the insertion run
+      with self.pool_lock:
+        funded = verified and self.verify_fund(tsn)
+        # the pool refuses double spends of pooled inputs
+        added = funded and self.tsn_pool.add(tsn, self._fee(tsn))
+      if added:
+        logging.debug('Miner - one transaction added. Pool now has {} transactions'.format(len(self.tsn_pool)))
+        self._notify_work()
+        status = Status.VALID
+      else:
+        logging.debug('Miner - invalid transaction: ' + b64encode(tsn.Digest).decode() + ' ' + str(verified) + ' ' + str(funded))
+        status = Status.INVALID
+    TRANSACTIONS.inc(labels=(status.name,))
+    return status
 
 
   def add_first_block(self, data):
-    self.chain_lock.acquire()
-    # make sure chain is empty
-    if len(self.chain) == 0:
-      self._intercept_mining()
-      # reconstruct
-      block = Block.from_bytes(data, self.tsn_pool)
-      if block is not None:
-        self._append_chain(block)
-        logging.debug('Miner - First block added')
-    self.chain_lock.release()
+    with self.chain_lock:
+      # make sure chain is empty
+      if len(self.chain) == 0:
+        self._intercept_mining()
+        # reconstruct
+        block = Block.from_bytes(data, self.tsn_pool)
+        if block is not None:
+          self._append_chain(block)
+          logging.debug('Miner - First block added')
 
 
 
-  def add_received_block(self, data):
+  # source: address of the peer the block came from, asked first for what the block is missing
+  @metrics.timed(RECEIVE_BLOCK_SECONDS, ('full',))
+  def add_received_block(self, data, source=None):
     logging.debug('Miner - receiving block from others')
 
-    self.chain_lock.acquire()
+    with self._acquire_chain():
+      status, block = self._add_block_data(data, self.tsn_pool, source)
 
-    # if syncing
-    if self.need_to_sync:
-      # allow sync to continue
-      self.chain_lock.release()
-      # then wait for it to complete
-      self.sync_lock.acquire()
-      self.sync_lock.release()
-      self.chain_lock.acquire()
+    # it's okay to continue mining now
 
-    # reconstruct block
-    try: block = Block.from_bytes(data, self.tsn_pool)
-    except Exception as e:
+    BLOCKS.inc(labels=(status.name,))
+    return status, block
+
+
+  # rebuild a compact block from our pool, and ask its sender for what is missing
+  @metrics.timed(RECEIVE_BLOCK_SECONDS, ('compact',))
+  def add_compact_block(self, data, source=None):
+    logging.debug('Miner - receiving compact block from others')
+    try: partial = PartialBlock(data, source, self.clock() + self.orphans.ttl)
+    except Exception:
+      logging.exception('Miner - malformed compact block')
+      return Status.INVALID, None
+
+    with self._acquire_chain():
+      hashcode = partial.hashcode
+      if hashcode in self.tree or hashcode in self.orphans or hashcode in self.partial_blocks:
+        status, block = Status.DUPLICATE, None
+      elif partial.fill(self.tsn_pool):
+        # one round trip for the transactions we don't have
+        logging.debug('Miner - compact block waiting for {} transactions'.format(len(partial.missing())))
+        self.partial_blocks[hashcode] = partial
+        while len(self.partial_blocks) > self.orphans.max_blocks:
+          self.partial_blocks.popitem(last=False)
+        self.on_block_transactions_requested_listeners.fire(hashcode, partial.missing(), source)
+        status, block = Status.ORPHAN, None
+      else:
+        status, block = self._add_partial_block(partial)
+
+    BLOCKS.inc(labels=(status.name,))
+    return status, block
+
+
+  # transactions sent back for a compact block, return (status, block) like add_received_block
+  def add_block_transactions(self, data):
+    data = pickle.loads(data)
+    with self.chain_lock:
+      partial = self.partial_blocks.get(data['block'])
+      if partial is None:
+        return Status.DUPLICATE, None
+      tsns = [Transaction(tsn) for tsn in data['tsns']]
+      if partial.fill_missing(data['indexes'], tsns):
+        logging.debug('Miner - compact block still incomplete, requesting it in full')
+        del self.partial_blocks[data['block']]
+        self.on_block_requested_listeners.fire(partial.hashcode, partial.source)
+        return Status.ORPHAN, None
+      del self.partial_blocks[data['block']]
+      return self._add_partial_block(partial)
+
+
+  def _add_partial_block(self, partial):
+    block = partial.to_block()
+    if block.hashcode != partial.hashcode:
+      # a short id matched the wrong transaction
+      logging.debug('Miner - compact block does not match its hash, requesting it in full')
+      self.on_block_requested_listeners.fire(partial.hashcode, partial.source)
+      return Status.ORPHAN, None
+    return self._handle_received_block(block, partial.source), block
+
+
+  # hold the chain lock for the with block, after dropping what waited too long
+  # blocks received while syncing are handled right away, parked until the sync reaches their parent
+  @contextmanager
+  def _acquire_chain(self):
+    with self.chain_lock:
+      self.orphans.expire()
+      now = self.clock()
+      while self.partial_blocks and next(iter(self.partial_blocks.values())).expires <= now:
+        self.partial_blocks.popitem(last=False)
+      yield
+
+
+  # reconstruct a block from the transactions in tsns, park it if some are missing
+  def _add_block_data(self, data, tsns, source):
+    try: block = Block.from_bytes(data, tsns)
+    except MissingTransactionsError as e:
       # check if it's a duplicate
-      hashcode = str(e)
-      if any(str(b.hashcode) == hashcode for b in self.chain):
-        logging.debug('Miner - duplicated block: ' + hashcode)
-        self.chain_lock.release()
+      if e.hashcode in self.tree or e.hashcode in self.orphans:
+        logging.debug('Miner - duplicated block: ' + b64encode(e.hashcode).decode())
         return Status.DUPLICATE, None
-      # otherwise, request sync, then recheck it after sync
-      logging.debug('Miner - missing transactions. Requesting sync...')
-      self.trigger_sync()
-      self.chain_lock.release()
-      return self.add_received_block(data)
+      # wait for just the missing transactions, instead of syncing
+      logging.debug('Miner - block waiting for {} transactions'.format(len(e.missing)))
+      self.orphans.add_data(e.hashcode, data, e.missing, source)
+      self.on_transactions_requested_listeners.fire(e.hashcode, e.missing, source)
+      return Status.ORPHAN, None
+    except Exception:
+      logging.exception('Miner - malformed block')
+      return Status.INVALID, None
 
     # attempt to add this block
-    done = self._handle_received_block(block)
+    return self._handle_received_block(block, source), block
 
-    # it's okay to continue mining now
-    self.chain_lock.release()
 
-    # if sync is required, recheck it after sync
-    if not done and self.need_to_sync:
-      logging.debug('Miner - mismatch block. Requesting sync...')
-      return self.add_received_block(data)
+  # transactions sent back for blocks waiting in the orphan pool
+  def add_missing_transactions(self, data):
+    self._resolve_transactions([Transaction(tsn) for tsn in pickle.loads(data)])
+
 
-    return Status.VALID if done else Status.INVALID, block
+  # resume the parked blocks which were only waiting for these transactions
+  def _resolve_transactions(self, tsns):
+    with self.chain_lock:
+      ready = [entry for tsn in tsns for entry in self.orphans.resolve(tsn)]
+      for entry in ready:
+        status, block = self._add_block_data(entry.data, ChainMap(entry.found, self.tsn_pool), entry.source)
+        if status == Status.VALID:
+          # it was not relayed while parked
+          self.on_block_added_listeners.fire(block)
 
 
-  def _handle_received_block(self, block):    
-    done = False
+  def _handle_received_block(self, block, source=None):
+    if block.hashcode in self.tree or block.hashcode in self.orphans:
+      return Status.DUPLICATE
     # validation
-    if block.validate():
-      # if it's a new block
-      if block.prev_hash == self.chain[-1].hashcode:
-        # append it to chain
-        if self._verify_block(block):
-          self._intercept_mining()
+    if not block.validate():
+      return Status.INVALID
+
+    # okay, the block doesn't fit any branch we know, keep it until its parent shows up
+    if block.prev_hash not in self.tree:
+      entry = self.orphans.add_block(block, source)
+      if entry.depth <= self.max_fetch_depth and block.prev_hash not in self.orphans:
+        logging.debug('Miner - orphan block, requesting its parent')
+        self.on_block_requested_listeners.fire(block.prev_hash, source)
+      elif not self.need_to_sync and self.clock() - self.last_sync > self.min_sync_interval:
+        # too far behind to fetch blocks one by one
+        logging.debug('Miner - not matching previous blocks. Initiating syncing...')
+        self.trigger_sync()
+      else:
+        logging.debug('Miner - orphan block')
+      return Status.ORPHAN
+
+    status = self._accept_block(block)
+
+    # then the orphans that were waiting for it
+    pending = self.orphans.pop_children(block.hashcode) if status == Status.VALID else []
+    while pending:
+      orphan = pending.pop()
+      if orphan.hashcode not in self.tree and self._accept_block(orphan) == Status.VALID:
+        pending.extend(self.orphans.pop_children(orphan.hashcode))
+
+    return status
+
+
+  # add a block to the tree, and switch to its branch if it now has the most work
+  def _accept_block(self, block):
+    node = self.tree.add(block)
+    if node.work <= self._tip_work():
+      logging.debug('Miner - block added to a side branch at height {}'.format(node.height))
+      return Status.VALID
+    return Status.VALID if self._reorganize(node) else Status.INVALID
+
+
+  def _tip_work(self):
+    return self.tip.work
+
+
+  # disconnect our blocks down to the fork point, then connect the branch ending at node
+  def _reorganize(self, node):
+    branch = []
+    while self.chain.height_of(node.hashcode) is None:
+      branch.append(node)
+      node = self.tree.get(node.prev_hash)
+      if node is None:
+        return False
+    fork = node.height + 1
+    if fork < self.chain.base:
+      logging.debug('Miner - branch forks below our snapshot, ignored')
+      return False
+
+    self._intercept_mining()
+    removed = self._truncate_chain(fork)
+    # add back those transactions of the disconnected blocks
+    with self.pool_lock:
+      for block in removed:
+        for tsn in block.transactions:
+          self.tsn_pool.add(tsn, self._fee(tsn))
+
+    for node in reversed(branch):
+      if not self._connect_block(node.block):
+        logging.debug('Miner - invalid block in new branch, keeping our chain')
+        self.tree.remove(node.hashcode)
+        connected = self._truncate_chain(fork)
+        for block in removed:
           self._append_chain(block)
-          done = True
-      # or maybe potential of divergence
-      elif block.prev_hash == self.chain[-2].hashcode:
-        self._handle_divergence(block)
-        done = True
-      # okay, the block obviously doesn't fit our current chain
-      elif not self.need_to_sync:
-        if time.time() - self.last_sync > self.min_sync_interval:
-          logging.debug('Miner - not matching previous blocks. Initiating syncing...')
-          self.trigger_sync()
-        else:
-          logging.debug('Miner - invalid block')
-
-    return done, block
+        # the branch blocks connected meanwhile took their transactions out of the pool
+        on_chain = set(tsn.Digest for block in removed for tsn in block.transactions)
+        with self.pool_lock:
+          for block in connected:
+            for tsn in block.transactions:
+              if tsn.Digest not in on_chain and self.verify_fund(tsn):
+                self.tsn_pool.add(tsn, self._fee(tsn))
+        return False
+
+    if len(removed) > 0:
+      REORGS.inc()
+      logging.debug('Miner - reorganization: {} blocks disconnected, {} connected'.format(len(removed), len(branch)))
+    return True
+
+
+  # append a block on top of our tip if it is valid
+  def _connect_block(self, block):
+    if len(self.chain) > 0 and block.prev_hash != self.chain.hash_at(-1):
+      return False
+    if not block.validate() or not self._verify_block(block):
+      return False
+    self._append_chain(block)
+    return True
 
 
   def _verify_block(self, block):
-    for tsn in block.transactions:
-      if not tsn.verify() or not self.verify_fund(tsn):
-        logging.debug('Miner - aborting... invalid transaction: {}'.format(tsn.Digest))
+    # transactions from our pool are already cached by the verifier
+    verified = self.verifier.verify_many(block.transactions)
+    # funds are checked in block order, so a sender can't spend its balance twice in one block
+    balances = self.balances.overlay()
+    for tsn, ok in zip(block.transactions, verified):
+      if not ok or not self.verify_fund(tsn, balances):
+        logging.debug('Miner - aborting... invalid transaction: {}'.format(b64encode(tsn.Digest).decode()))
         return False
+      balances.apply(tsn)
+    return True
 
 
   def _intercept_mining(self):
@@ -220,108 +706,148 @@ class Miner:
       self.new_block = None
 
 
-  def _handle_divergence(self, new_block):
-    last_block = self.chain[-1]
-
-    is_new_block_smaller = new_block.nonce < last_block.nonce
-    choose_smaller_block = (new_block.nonce + last_block.nonce) % 2 == 0
-
-    if is_new_block_smaller == choose_smaller_block:
-      # add back those transactions of the going-to-be-pruned block
-      for tsn in last_block.transactions:
-        self.tsn_pool[tsn.hashcode] = tsn
-      # attempt to replace it with new block
-      self.chain = self.chain[:-1]
-      if self._verify_block(new_block):
-          logging.debug('Miner - divergence: replaced with newly received block')
-          self._intercept_mining()
-          self._append_chain(new_block)
-          del last_block
-      else:
-        logging.debug('Miner - divergence: newly received block is invalid')
-        self._append_chain(last_block)
-    else:
-        logging.debug('Miner - divergence: keep unchanged')
-
-
-
-  def verify_fund(self, new_tsn):
+  # balances: BalanceIndex to check against, ours by default
+  def verify_fund(self, new_tsn, balances=None):
+    if balances is None:
+      balances = self.balances
     # ensure maximum of 2 receivers and they are unique
     receivers = new_tsn.Receivers
     if len(receivers) != 1 and (len(receivers) != 2 or receivers[0][1] == receivers[1][1]):
       return False
+    # a negative output would let the other one exceed what the senders hold
+    if not all(recv[0] > 0 for recv in receivers):
+      return False
 
     receiving = sum([recv[0] for recv in receivers])
 
     senders = set([sender[1] for sender in new_tsn.Senders])
     for sender in senders:
-      receiving -= self._get_latest_balance(sender)
+      receiving -= balances.balance(sender)
 
     return receiving == -100 or receiving <= 0
 
 
-  def _get_latest_balance(self, address):
-    balance = 0
-    # iterate backwards
-    for block in self.chain[::-1]:
-      for tsn in block.transactions:
-        # if they received money
-        for recv in tsn.Receivers:
-          if address == recv[1]:
-            balance += recv[0]
-        # and stop if they made this transaction
-        if address in tsn.Senders:
-          break
-    return balance
-
+  # what the senders spend beyond the outputs, used to rank the pool
+  def _fee(self, tsn):
+    spent = sum(self.balances.balance(address) for address in set(sender[1] for sender in tsn.Senders))
+    return spent - sum(recv[0] for recv in tsn.Receivers)
 
-  def _append_chain(self, block=None):
-    if block is None:
-      block = self.new_block
 
+  def _append_chain(self, block):
     self.chain.append(block)
-
-    # update pool
-    for tsn in block.transactions:
-      self.tsn_pool.pop(tsn.Digest, None)
+    if block.hashcode not in self.tree:
+      self.tree.add(block)
+    self.tree.set_main(block.hashcode)
+    self.tree.prune(len(self.chain) - 1)
+
+    # admission sees the balances and the pool either before or after the block
+    with self.pool_lock:
+      self.balances.connect(block)
+      for tsn in block.transactions:
+        self.tsn_pool.pop(tsn.Digest, None)
+        self.tsn_pool.remove_conflicts(tsn)
+    self._update_tip()
+    if self.data_dir and len(self.chain) % self.checkpoint_interval == 0:
+      self.balances.save(self._balances_path(), self.chain)
 
     logging.debug('Miner - new block added to chain. Chain now has {} blocks, and pool '
                    'has {} remaining transactions'.format(len(self.chain), len(self.tsn_pool)))
+    self._notify_work()
+
+
+  def _notify_work(self):
+    with self.work_changed:
+      self.work_changed.notify_all()
 
 
-  def _publish_block(self):
-    new_block = self.new_block
-    if self.new_block is None or not new_block.validate():
+  # drop every block above the given height, and their effect on balances
+  # the blocks stay in the tree as a side branch, and are returned
+  def _truncate_chain(self, height):
+    removed = self.chain[height:]
+    del self.chain[height:]
+    with self.pool_lock:
+      self.balances.rollback(height)
+    for block in removed:
+      self.tree.set_side(block)
+    self._update_tip()
+    return removed
+
+
+  # append a block we mined on tip, unless our chain changed since
+  def _publish_block(self, block, tip):
+    if not block.validate():
       return False
 
-    self.chain_lock.acquire()
-    # make sure that we still haven't received any new block
-    if self.new_block is not None:
-      logging.debug('Miner - broadcasting new block...')
-      self.on_block_added_listeners.fire(self.new_block)
-      self._append_chain(self.new_block)
+    with self.chain_lock:
+      published = self.tip is tip
+      if published:
+        logging.debug('Miner - broadcasting new block...')
+        self.on_block_added_listeners.fire(block)
+        self._append_chain(block)
+    return published
+
 
-    self.chain_lock.release()
+  def _can_mine(self):
+    return not self.need_to_sync and len(self.tsn_pool) >= self.block_capacity
 
 
   def mine(self):
     while True:
-      # print(str(self.chain_lock.locked()) + ' ' + str(self.need_to_sync))
+      # sleep until there is enough to mine, waking up only to retry an unanswered sync
+      with self.work_changed:
+        timeout = None
+        if self.need_to_sync:
+          timeout = max(0, self.last_sync + self.sync_timeout - self.clock())
+        self.work_changed.wait_for(self._can_mine, timeout)
+
+      # ask again if our sync request went unanswered
+      if self.need_to_sync and self.clock() - self.last_sync >= self.sync_timeout:
+        self.trigger_sync()
 
       # if we still don't have enough transactions
-      if self.chain_lock.locked() or self.need_to_sync or len(self.tsn_pool) < self.block_capacity:
-        time.sleep(1)
+      if not self._can_mine():
         continue
 
-      self.chain_lock.acquire()
-      # otherwise, take k random transactions from pool
-      transactions = random.sample(list(self.tsn_pool.values()), k=self.block_capacity)
-      # create a new block
-      prev_hash = self.chain[-1].hashcode if len(self.chain) > 0 else 0
-      self.new_block = Block(prev_hash, transactions)
-      self.chain_lock.release()
-      
-      # then start mining
-      if self.new_block and self.new_block.mine():
-        self._publish_block()
+      self.mine_once()
+
+
+  # mine one block on our tip, return it if it made it to the chain
+  def mine_once(self):
+    # the template is built and published under chain_lock, so the pool matches the tip
+    # and a block connected after it finds it in new_block and interrupts it
+    with self.chain_lock:
+      tip = self.tip
+      block = self.new_block = self._template(tip)
+
+    # then start mining
+    if block.mine() and self._publish_block(block, tip):
+      return block
+    self.template = block
+    return None
+
+
+  # a block of the k best transactions from pool on top of tip
+  # the last template keeps the transactions still selected in place, and takes the new
+  # ones in the slots that freed up, rehashing only their paths (see merkle.py)
+  def _template(self, tip):
+    transactions = self.tsn_pool.select(self.block_capacity)
+    block, self.template = self.template, None
+    if block is None or len(block.transactions) > len(transactions):
+      return Block(tip.hashcode, transactions)
+
+    selected = set(tsn.Digest for tsn in transactions)
+    kept = selected.intersection(tsn.Digest for tsn in block.transactions)
+    fresh = [tsn for tsn in transactions if tsn.Digest not in kept]
+    # each new transaction rehashes a path, past a few of them a new tree is cheaper
+    if len(fresh) * len(transactions).bit_length() > len(transactions):
+      return Block(tip.hashcode, transactions)
+
+    stale = [index for index, tsn in enumerate(block.transactions) if tsn.Digest not in selected]
+    for index, tsn in zip(stale, fresh):
+      block.replace_transaction(index, tsn)
+    for tsn in fresh[len(stale):]:
+      block.add_transaction(tsn)
+    block.prev_hash = tip.hashcode
+    block.stop_mining = False
+    return block
       
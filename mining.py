@@ -0,0 +1,117 @@
+'''
+mining.py
+proof-of-work backends used by Block.mine to search the nonce space
+
+A backend receives the serialized block header without its nonce (the nonce
+always occupies the last NONCE_SIZE bytes of the header) and returns the
+first nonce it finds that satisfies the difficulty, or None if the block
+was told to stop mining.
+'''
+import os
+import multiprocessing
+from collections import deque
+from hashlib import sha256
+from struct import Struct
+from threading import Lock
+
+_nonce = Struct('>q')
+
+# worker-side search generation, inherited from the pool initializer
+# a chunk is abandoned as soon as the generation it was queued for is over
+_generation = None
+
+
+def _init_worker(generation):
+  global _generation
+  _generation = generation
+
+
+# look for a valid nonce in [start, start + count)
+# return (nonce or None, number of tries)
+# the sha256 state of the prefix is computed once and copied for every nonce,
+# and the digest prefix is compared directly, as crypto.check_prefix would do
+def search_range(prefix, difficulty, start, count, stop=None, check_every=1024):
+  midstate = sha256(prefix)
+  zeros = bytes(difficulty)
+  pack = _nonce.pack
+  for nonce in range(start, start + count):
+    h = midstate.copy()
+    h.update(pack(nonce))
+    if sha256(h.digest()).digest()[:difficulty] == zeros:
+      return nonce, nonce - start + 1
+    if stop is not None and (nonce - start) % check_every == 0 and stop():
+      return None, nonce - start + 1
+  return None, count
+
+
+def _search_chunk(prefix, difficulty, start, count, generation):
+  return search_range(prefix, difficulty, start, count, stop=lambda: _generation.value != generation)
+
+
+class LocalBackend:
+  chunk_size = 1 << 12
+
+  def __init__(self):
+    self.tries = 0
+
+  def search(self, block, prefix, start):
+    self.tries = 0
+    while not block.stop_mining:
+      nonce, tries = search_range(prefix, block.difficulty, start, self.chunk_size)
+      self.tries += tries
+      if nonce is not None:
+        return nonce
+      start += self.chunk_size
+    return None
+
+
+class ProcessPoolBackend:
+  # nonces handed to a worker at once, and how many chunks each worker may have queued
+  chunk_size = 1 << 16
+  backlog = 2
+  # seconds between checks of block.stop_mining while waiting for workers
+  poll_interval = 0.05
+
+  def __init__(self, workers=None):
+    self.workers = workers or os.cpu_count() or 1
+    self.tries = 0
+    self._pool = None
+    self._generation = multiprocessing.Value('q', 0, lock=False)
+    self._lock = Lock()
+
+  def _get_pool(self):
+    if self._pool is None:
+      self._pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(self._generation,))
+    return self._pool
+
+  def close(self):
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool = None
+
+  def search(self, block, prefix, start):
+    with self._lock:
+      pool = self._get_pool()
+      generation = self._generation.value
+      self.tries = 0
+      pending = deque()
+      try:
+        while not block.stop_mining:
+          # keep every worker busy
+          while len(pending) < self.workers * self.backlog:
+            pending.append(pool.apply_async(_search_chunk, (prefix, block.difficulty, start, self.chunk_size, generation)))
+            start += self.chunk_size
+
+          result = pending[0]
+          result.wait(self.poll_interval)
+          if not result.ready():
+            continue
+          pending.popleft()
+          nonce, tries = result.get()
+          self.tries += tries
+          if nonce is not None:
+            return nonce
+        return None
+      finally:
+        # make outstanding chunks return early
+        self._generation.value = generation + 1
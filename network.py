@@ -2,91 +2,257 @@
 network.py
 handling p2p communication
 '''
-import socket
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue
+from struct import Struct
+from threading import Event
 import logging
-import time
 import random
-import pickle
+
+import metrics
 
 #Default Ports
 FLOODING_PORT = 18015
-SYN_PORT = 9898
+#Framing: 4-byte payload length, 1-byte tag, then the payload
+FRAME_HEADER = Struct('>IB')
+MAX_FRAME_SIZE = 64 << 20
+CONNECT_TIMEOUT = 5
 #Tags
-MAX_SIZE = 8196
 FIRST_BLOCK = 100
 REQUEST_IP_LIST = 0
 RETURN_IP_LIST = 1
 REQUEST_TO_CONNECT = 11
 ACCEPT_TO_CONNECT = 12
-REQUEST_LEDGER_SIZE = 13
-RETURN_LEDGER_SIZE = 14
 REQUEST_TO_SYNC = 15
 RETURN_TO_SYNC = 16
+REQUEST_TRANSACTIONS = 17
+RETURN_TRANSACTIONS = 18
+REQUEST_BLOCK = 19
+RETURN_BLOCK = 20
 NEW_TRANSACTION = 21
 NEW_BLOCK = 22
 INVALID_TRANSACTION = 23
 INVALID_BLOCK = 24
+NEW_COMPACT_BLOCK = 25
+REQUEST_BLOCK_TRANSACTIONS = 26
+RETURN_BLOCK_TRANSACTIONS = 27
+INVENTORY = 28
+GET_DATA = 29
+REQUEST_HEADERS = 30
+RETURN_HEADERS = 31
+REQUEST_BODIES = 32
+RETURN_BODIES = 33
+REQUEST_SNAPSHOT = 34
+RETURN_SNAPSHOT = 35
+REQUEST_PROOF = 36
+RETURN_PROOF = 37
+# tag -> name, for logs and profiles
+TAG_NAMES = {value: name for name, value in list(globals().items())
+             if name.isupper() and type(value) is int and name not in ('FLOODING_PORT', 'MAX_FRAME_SIZE', 'CONNECT_TIMEOUT')}
+
+# handling priorities of the tags above 14, each with its own queue, lowest handled first
+BLOCKS, REQUESTS, TRANSACTIONS = 0, 1, 2
+# anything not listed is a request or a reply
+PRIORITIES = {FIRST_BLOCK: BLOCKS, NEW_BLOCK: BLOCKS, RETURN_BLOCK: BLOCKS, INVALID_BLOCK: BLOCKS,
+              NEW_COMPACT_BLOCK: BLOCKS, RETURN_BLOCK_TRANSACTIONS: BLOCKS, RETURN_TRANSACTIONS: BLOCKS,
+              NEW_TRANSACTION: TRANSACTIONS, INVALID_TRANSACTION: TRANSACTIONS}
+
+SENT = metrics.counter('network_messages_sent_total', 'messages sent, by tag', ('tag',))
+SENT_BYTES = metrics.counter('network_bytes_sent_total', 'payload bytes sent, by tag', ('tag',))
+RECEIVED = metrics.counter('network_messages_received_total', 'messages received, by tag', ('tag',))
+RECEIVED_BYTES = metrics.counter('network_bytes_received_total', 'payload bytes received, by tag', ('tag',))
+HANDLER_SECONDS = metrics.histogram('network_handler_seconds', 'time to handle a message, by tag', ('tag',))
+PENDING = metrics.gauge('network_pending_messages', 'messages waiting for a handler, by priority', ('priority',))
+QUEUE_SECONDS = metrics.histogram('network_queue_seconds', 'time a message waited for a handler, by priority', ('priority',))
+DROPPED = metrics.counter('network_messages_dropped_total', 'messages dropped because their queue was full or nothing could take them, by tag', ('tag',))
 
 class Networking:
-    # BUFFER: FIFO Queue
+    # BUFFER: FIFO Queue, receives (address, tag, data) when no handler is given
     # PORT: Default is flooding port
-    def __init__(self, MY_IP:str, BUFFER: Queue, PORT=FLOODING_PORT): 
+    # handler: called as handler(address, tag, data) for every message tagged above 14
+    #   one of the two should be set before listening, messages arriving without either are dropped
+    #   coroutine functions run on the event loop, plain functions on a pool of max_concurrency threads
+    #   messages wait in one queue per priority (see PRIORITIES), blocks are handled first
+    # max_concurrency: number of messages handled at the same time, one of them only handling blocks
+    # max_pending: messages waiting in each queue; a full queue stops reading the connection it
+    #   would take a message from, except for the shed priorities whose new messages are dropped
+    # shed: priorities dropped rather than slowing down the peers, transactions by default
+    def __init__(self, MY_IP:str, BUFFER: Queue=None, PORT=FLOODING_PORT, handler=None,
+                 max_concurrency=8, max_pending=1024, shed=(TRANSACTIONS,)):
         self.MY_IP = MY_IP
         self.HOSTs = []
         self.PORT = PORT
         self.BUFFER = BUFFER
-        self.sync_ready = [False, None, None] # ready, address, ledger size of bytes
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.shed = shed
         self.stop = False
+        self.loop = None
+        self.ready = Event()
+        # outgoing connections kept open, one per host
+        self.connections = {}
+        self.connection_locks = {}
 
-    # Call after init in separated Thread
-    # listening for new connection
-    # and receiving data --> BUFFER
+    # Call after init in separated Thread, or as the last call of main
+    # runs the event loop: listening for new connection
+    # and receiving data --> handler / BUFFER
     def listening (self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind(('', self.PORT))
-            s.listen(5)
-            logging.info('Net - Start listening....')
+        asyncio.run(self.serve())
+        return 1
+
+    async def serve (self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        # one queue of (time queued, DAT) per priority, and a condition notified on every put and get
+        self.pending = [deque() for _ in range(TRANSACTIONS + 1)]
+        self.changed = asyncio.Condition()
+        self.executor = ThreadPoolExecutor(self.max_concurrency)
+        for priority, queue in enumerate(self.pending):
+            PENDING.set_function(queue.__len__, (priority,))
+        # the first worker only handles blocks, so they never wait behind transactions
+        priorities = [(BLOCKS,)] + [range(TRANSACTIONS + 1)] * (self.max_concurrency - 1)
+        if self.max_concurrency == 1:
+            priorities = [range(TRANSACTIONS + 1)]
+        workers = [asyncio.create_task(self.working(p)) for p in priorities]
+
+        server = await asyncio.start_server(self.receiving, port=self.PORT, reuse_address=True)
+        logging.info('Net - Start listening....')
+        self.ready.set()
+        async with server:
+            await self.stopped.wait()
+
+        for worker in workers:
+            worker.cancel()
+        for writer in self.connections.values():
+            writer.close()
+        self.executor.shutdown(wait=False)
+
+    def shutdown (self):
+        self.stop = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    # Read frames from one peer connection until it is closed
+    async def receiving (self, reader, writer):
+        address = writer.get_extra_info('peername')
+        try:
             while not self.stop:
-                conn, address = s.accept()
-                with conn:
-                    data = conn.recv(MAX_SIZE)
-                    if data:
-                        tag = data[-1]
-                        logging.debug(('receiving', tag, address[0]))
-                        DAT = (address, tag, data[:-1])
-                        if tag>14 or tag==13:
-                            self.BUFFER.put(DAT)
-                            continue
-                        if self.request(DAT=DAT) != 1:
-                            continue
-                        if self.reply(DAT) != 1:
-                            continue
-                        if self.sync_ledger_size(DAT) != 1:
-                            continue
-                        
+                size, tag = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                if size > MAX_FRAME_SIZE:
+                    logging.error('Net - Frame too large from %s....', address[0])
+                    break
+                data = await reader.readexactly(size)
+                logging.debug(('receiving', tag, address[0]))
+                RECEIVED.inc(labels=(tag,))
+                RECEIVED_BYTES.inc(size, (tag,))
+                await self.dispatch((address, tag, data))
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                logging.error('Net - Connection closed mid-frame by %s....', address[0])
+        except (ConnectionError, asyncio.CancelledError):
+            # peer gone, or the server is shutting down
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch (self, DAT):
+        tag = DAT[1]
+        if tag>14:
+            if self.handler is not None:
+                await self.enqueue(DAT)
+            elif self.BUFFER is not None:
+                self.BUFFER.put(DAT)
+            else:
+                # nothing to take it yet, the handler is usually set right after __init__
+                DROPPED.inc(labels=(tag,))
+                logging.error('Net - No handler or BUFFER, dropping message %d....', tag)
+            return
+        if self.request(DAT=DAT) != 1:
+            return
+        self.reply(DAT)
+
+    async def enqueue (self, DAT):
+        priority = PRIORITIES.get(DAT[1], REQUESTS)
+        queue = self.pending[priority]
+        async with self.changed:
+            if len(queue) >= self.max_pending:
+                if priority in self.shed:
+                    DROPPED.inc(labels=(DAT[1],))
+                    logging.debug('Net - Queue full, dropping message %d....', DAT[1])
+                    return
+                # waits while the queue is full, which stops reading from this peer
+                await self.changed.wait_for(lambda: len(queue) < self.max_pending)
+            queue.append((time.perf_counter(), DAT))
+            self.changed.notify_all()
+
+    # the oldest message of the most urgent non empty queue among priorities
+    def _next (self, priorities):
+        for priority in priorities:
+            queue = self.pending[priority]
+            if queue:
+                queued, DAT = queue.popleft()
+                QUEUE_SECONDS.observe(time.perf_counter() - queued, (priority,))
+                return DAT
+
+    # priorities: the queues this worker takes messages from
+    async def working (self, priorities):
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: any(self.pending[p] for p in priorities))
+                DAT = self._next(priorities)
+                # room freed for a waiting peer
+                self.changed.notify_all()
+            try:
+                with HANDLER_SECONDS.time((DAT[1],)):
+                    if asyncio.iscoroutinefunction(self.handler):
+                        await self.handler(*DAT)
                     else:
-                        logging.error('Net - Data receive NONE....')
-        return 1
+                        await self.loop.run_in_executor(self.executor, self.handler, *DAT)
+            except Exception:
+                logging.exception('Net - Handler failed for tag %d....', DAT[1])
 
-    # Send data
-    # set IS_SYN True to send data to SYNC_PORT
-    def sending (self, HOST:str, data:bytes, tag:int, IS_SYN=False):
+    # Send data to HOST, callable from any thread
+    # the frame is queued on the event loop, over the pooled connection to HOST
+    def sending (self, HOST:str, data:bytes, tag:int):
         if HOST==self.MY_IP:
             logging.debug('NET - Send to self....')
             return
         if HOST=='127.0.0.1':
             logging.debug('NET - Send to self....')
             return
-        PORT = self.PORT if not IS_SYN else SYN_PORT
-        data += tag.to_bytes(1, 'big')
-        # logging.debug(('sending', tag, data[-1], HOST))
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            try:
-                s.connect((HOST, PORT))
-                s.sendall(data)
-            except:
-                logging.error('NET - Connect error to %s....', HOST)
+        if not self.ready.wait(CONNECT_TIMEOUT):
+            logging.error('NET - Not listening yet, dropping message to %s....', HOST)
+            return
+        SENT.inc(labels=(tag,))
+        SENT_BYTES.inc(len(data), (tag,))
+        frame = FRAME_HEADER.pack(len(data), tag) + data
+        self.loop.call_soon_threadsafe(self.loop.create_task, self.send(HOST, frame))
+
+    # reconnect once if the pooled connection went stale
+    async def send (self, HOST:str, frame:bytes):
+        lock = self.connection_locks.setdefault(HOST, asyncio.Lock())
+        async with lock:
+            for _ in range(2):
+                try:
+                    writer = self.connections.get(HOST)
+                    if writer is None or writer.is_closing():
+                        _, writer = await asyncio.wait_for(asyncio.open_connection(HOST, self.PORT), CONNECT_TIMEOUT)
+                        self.connections[HOST] = writer
+                    writer.write(frame)
+                    await writer.drain()
+                    return
+                except (OSError, asyncio.TimeoutError):
+                    self.disconnect(HOST)
+            logging.error('NET - Connect error to %s....', HOST)
+
+    def disconnect (self, HOST:str):
+        writer = self.connections.pop(HOST, None)
+        if writer is not None:
+            writer.close()
 
     # Send data to servers specified in list HOSTs
     # If HOSTs not specified, broadcast to self.HOSTs
@@ -145,52 +311,7 @@ class Networking:
             return None
         return 1
 
-    # Internal used only, request size (in bytes) of current ledger
-    def sync_ledger_size(self, DAT=None, addr:list=None, **kwargs):
-        if not DAT:
-            logging.error('NET - SYNC start....')
-            data=pickle.dumps(kwargs)
-            self.broadcast(data, REQUEST_LEDGER_SIZE)
-            return 0
-
-        address, tag, sz = DAT
-        if tag==RETURN_LEDGER_SIZE and self.sync_ready[0]==False and address[0] not in addr:
-            self.sync_ready = (True, address[0], int(sz.decode()))
-            return None
-        
-        return 1
-
-    # Sync ledger, listen for new connection at SYNC_PORT to receive sync data
-    # timeout (in second): wait time before exit if no server accept to sync
-    # address: IP. If specified, don't receive sync data from this address
-    # kwargs: to specify what to sync
-    # returning (data, from_address)
-    def sync(self, timeout:float, address:list=None, **kwargs):
-        self.sync_ledger_size(address, kwargs)
-        start = time.time()
-        while not self.sync_ready[0]:
-            if time.time()-start > timeout:
-                logging.error('NET - SYNC timeout....')
-                return None
-            time.sleep(1)
-
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind(('', SYN_PORT))
-            s.listen(1)
-            conn, _ = s.accept()
-            with conn:
-                data = conn.recv(self.sync_ready[2]+MAX_SIZE)
-                if data:
-                    return data, self.sync_ready[1]
-        
-        logging.info('NET - SYNC done....')
-        self.sync_ready[0] = False
-        return None
-    
-# net = Networking(Buffer)
-# net.listening() #new thread
+# net = Networking(MY_IP, handler=handle_message)
+# net.listening() #new thread, or blocking in main
 # net.request(HOST='10.0.100.97')
-# data = net.sync(5, {}) #new thread, block
-# previous_sync_address = net.sync_ready[1]
-# client: last_block_hash
-# miner: ledger_size, pool
\ No newline at end of file
+# net.sending(HOST, locator, REQUEST_TO_SYNC) # blocks come back as RETURN_TO_SYNC
\ No newline at end of file
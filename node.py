@@ -0,0 +1,242 @@
+'''
+node.py
+a miner attached to a network: message handling and requests to peers
+
+network is a Networking, or anything offering the same MY_IP, HOSTs,
+ready, request() and sending(), such as the in-memory transport of
+simulator.py.
+'''
+import time
+import random
+import pickle
+import logging
+from threading import Lock, Timer
+
+from miner import Status
+from compact import encode_compact_block
+from codec import peek_digest
+from gossip import Gossip
+from ibd import BlockDownload, decode_bodies
+from snapshot import HistoryCheck
+from transaction import Transaction
+from network import *
+from EventHook import EventHook
+import profiler
+
+
+class Node:
+    # start an empty node from a peer's balance snapshot instead of replaying the whole chain
+    use_snapshot = True
+    # seconds to wait for a snapshot before downloading the chain instead
+    snapshot_timeout = 30
+
+    # rng: random.Random used to pick peers, for reproducible runs
+    def __init__(self, miner, network, rng=None):
+        self.miner = miner
+        self.network = network
+        self.random = rng or random.Random()
+        self.gossip = Gossip(network)
+        self.download = BlockDownload(miner)
+        self.history = HistoryCheck(miner)
+        # peer asked for a snapshot, None once it answered or timed out
+        self.snapshot_host = None
+        self.snapshot_lock = Lock()
+        # fired with every block received from a peer that we accepted
+        self.on_block_accepted_listeners = EventHook()
+
+        miner.on_block_added_listeners += self.broadcast_block
+        miner.on_sync_requested_listeners += self.request_sync
+        miner.on_transactions_requested_listeners += self.request_transactions
+        miner.on_block_requested_listeners += self.request_block
+        miner.on_block_transactions_requested_listeners += self.request_block_transactions
+        self.download.on_headers_requested_listeners += self.request_headers
+        self.download.on_bodies_requested_listeners += self.request_bodies
+        self.history.on_bodies_requested_listeners += self.request_bodies
+        network.handler = self.handle_message
+
+    # announced to peers, who pull it as a compact block and rebuild it from their own pool
+    def broadcast_block(self, block, exclude=[]):
+        self.gossip.announce(NEW_COMPACT_BLOCK, block.hashcode, encode_compact_block(block), exclude=exclude)
+
+    # join the network through host, then catch up with the peers we got
+    def join(self, host):
+        # wait for the event loop before sending anything
+        self.network.ready.wait()
+        self.network.request(HOST=host)
+        deadline = time.time() + CONNECT_TIMEOUT
+        while not self.network.HOSTs and time.time() < deadline:
+            time.sleep(0.1)
+        self.bootstrap()
+
+    def bootstrap(self):
+        host = self.pick_host()
+        if host is None:
+            return
+        if self.use_snapshot and len(self.miner.chain) == 0:
+            # the download starts once the snapshot is loaded, or without it if none comes back
+            with self.snapshot_lock:
+                self.snapshot_host = host
+            self.network.sending(host, b'', REQUEST_SNAPSHOT)
+            self.call_later(self.snapshot_timeout, self.snapshot_timed_out, host)
+            return
+        self.download.start(host)
+        if self.miner.snapshot is not None and not self.miner.snapshot_verified:
+            self.history.start(list(self.network.HOSTs))
+
+    # run fn(*args) after delay seconds, the simulator replaces it with its virtual clock
+    def call_later(self, delay, fn, *args):
+        timer = Timer(delay, fn, args)
+        timer.daemon = True
+        timer.start()
+
+    # True if we were waiting for a snapshot from host, which we no longer do
+    def _end_snapshot_wait(self, host):
+        with self.snapshot_lock:
+            if self.snapshot_host != host:
+                return False
+            self.snapshot_host = None
+            return True
+
+    def snapshot_timed_out(self, host):
+        if self._end_snapshot_wait(host):
+            logging.info('Node - no snapshot from {}, downloading the chain'.format(host))
+            self.download.start(self.pick_host(exclude=[host]) or host)
+
+    # a random peer, or None if there is none
+    def pick_host(self, exclude=[]):
+        hosts = [h for h in self.network.HOSTs if h not in exclude]
+        return self.random.choice(hosts) if hosts else None
+
+    # ask a peer (a random one by default) for the blocks following our locator
+    def request_sync(self, locator, host=None, exclude=[]):
+        host = host or self.pick_host(exclude)
+        if host is not None:
+            self.network.sending(host, pickle.dumps(locator), REQUEST_TO_SYNC)
+
+    # ask the peer that sent a block for the transactions it is waiting for
+    def request_transactions(self, hashcode, digests, host=None):
+        host = host or self.pick_host()
+        if host is not None:
+            self.network.sending(host, pickle.dumps({'block': hashcode, 'digests': digests}), REQUEST_TRANSACTIONS)
+
+    def request_headers(self, locator, host):
+        self.network.sending(host, pickle.dumps(locator), REQUEST_HEADERS)
+
+    def request_bodies(self, hashes, host):
+        self.network.sending(host, pickle.dumps(hashes), REQUEST_BODIES)
+
+    # ask the peer that sent a compact block for the transactions we don't have
+    def request_block_transactions(self, hashcode, indexes, host=None):
+        host = host or self.pick_host()
+        if host is not None:
+            self.network.sending(host, pickle.dumps({'block': hashcode, 'indexes': indexes}), REQUEST_BLOCK_TRANSACTIONS)
+
+    # ask the peer that sent an orphan block for its parent
+    def request_block(self, hashcode, host=None):
+        host = host or self.pick_host()
+        if host is not None:
+            self.network.sending(host, hashcode, REQUEST_BLOCK)
+
+    # time spent on a message is profiled under its tag, see profiler.py
+    def handle_message(self, addr, tag, data):
+        with profiler.context(TAG_NAMES.get(tag, str(tag))):
+            self._handle_message(addr, tag, data)
+
+    def _handle_message(self, addr, tag, data):
+        logging.debug('Node - ({}, {})'.format(addr, tag))
+        miner, network = self.miner, self.network
+        if tag == NEW_TRANSACTION:
+            # drop duplicates before decoding them
+            digest = peek_digest(data)
+            if not self.gossip.receive(addr[0], digest):
+                return
+            try:
+                tsn = Transaction(data)
+            except ValueError:
+                self.gossip.mark_seen(digest)
+                network.sending(addr[0], digest, INVALID_TRANSACTION)
+                return
+            status = miner.add_transaction(tsn)
+            self.gossip.mark_seen(digest)
+            if status == Status.INVALID:
+                network.sending(addr[0], tsn.Digest, INVALID_TRANSACTION)
+            elif status == Status.VALID:
+                self.gossip.announce(NEW_TRANSACTION, digest, data, exclude=[addr[0]])
+        elif tag == INVENTORY:
+            self.gossip.receive_inventory(addr[0], data)
+        elif tag == GET_DATA:
+            self.gossip.serve(addr[0], data)
+        elif tag == NEW_BLOCK or tag == RETURN_BLOCK:
+            status, block = miner.add_received_block(data, source=addr[0])
+            # orphans are only relayed once they connect
+            if status == Status.INVALID and block is not None:
+                network.sending(addr[0], block.hashcode, INVALID_BLOCK)
+            elif status == Status.VALID:
+                self.on_block_accepted_listeners.fire(block)
+                if tag == NEW_BLOCK:
+                    self.broadcast_block(block, exclude=[addr[0]])
+        elif tag == NEW_COMPACT_BLOCK or tag == RETURN_BLOCK_TRANSACTIONS:
+            if tag == NEW_COMPACT_BLOCK:
+                status, block = miner.add_compact_block(data, source=addr[0])
+            else:
+                status, block = miner.add_block_transactions(data)
+            if block is not None:
+                self.gossip.receive(addr[0], block.hashcode)
+                self.gossip.mark_seen(block.hashcode)
+            if status == Status.INVALID and block is not None:
+                network.sending(addr[0], block.hashcode, INVALID_BLOCK)
+            elif status == Status.VALID:
+                self.on_block_accepted_listeners.fire(block)
+                self.broadcast_block(block, exclude=[addr[0]])
+        elif tag == REQUEST_BLOCK_TRANSACTIONS:
+            reply = miner.get_block_transactions(data)
+            if reply is not None:
+                network.sending(addr[0], reply, RETURN_BLOCK_TRANSACTIONS)
+        elif tag == REQUEST_BLOCK:
+            block = miner.get_block(data)
+            if block is not None:
+                network.sending(addr[0], block, RETURN_BLOCK)
+        elif tag == REQUEST_PROOF:
+            reply = miner.get_proofs(data)
+            if reply is not None:
+                network.sending(addr[0], reply, RETURN_PROOF)
+        elif tag == REQUEST_TRANSACTIONS:
+            network.sending(addr[0], miner.get_transactions(data), RETURN_TRANSACTIONS)
+        elif tag == RETURN_TRANSACTIONS:
+            miner.add_missing_transactions(data)
+        elif tag == REQUEST_HEADERS:
+            network.sending(addr[0], miner.get_headers(data), RETURN_HEADERS)
+        elif tag == RETURN_HEADERS:
+            self.download.add_headers(addr[0], data, list(network.HOSTs))
+        elif tag == REQUEST_BODIES:
+            network.sending(addr[0], miner.get_bodies(data), RETURN_BODIES)
+        elif tag == RETURN_BODIES:
+            blocks = decode_bodies(data)
+            self.download.add_bodies(addr[0], blocks, list(network.HOSTs))
+            self.history.add_bodies(addr[0], blocks, list(network.HOSTs))
+        elif tag == REQUEST_SNAPSHOT:
+            # an empty reply when we have no chain yet, so the peer downloads from someone else
+            snapshot = miner.get_snapshot()
+            network.sending(addr[0], snapshot or b'', RETURN_SNAPSHOT)
+        elif tag == RETURN_SNAPSHOT:
+            # late replies are dropped, the download already started without them
+            if not self._end_snapshot_wait(addr[0]):
+                return
+            # mine on top of it right away, and check the history below it meanwhile
+            if data and miner.load_snapshot(data):
+                self.history.start(list(network.HOSTs))
+                self.download.start(addr[0])
+            else:
+                self.download.start(self.pick_host(exclude=[addr[0]]) or addr[0])
+        elif tag == INVALID_BLOCK:
+            miner.trigger_sync()
+        elif tag == REQUEST_TO_SYNC:
+            network.sending(addr[0], miner.get_blocks(data), RETURN_TO_SYNC)
+        elif tag == RETURN_TO_SYNC:
+            # keep pulling batches from the same peer, or move to another one
+            if miner.sync_data(data):
+                self.request_sync(miner.get_locator(), host=addr[0])
+            elif miner.need_to_sync:
+                self.request_sync(miner.get_locator(), exclude=[addr[0]])
+        elif tag == FIRST_BLOCK:
+            miner.add_first_block(data)
@@ -0,0 +1,133 @@
+'''
+orphans.py
+blocks received before what they depend on
+
+A block is parked here while its parent is unknown, or while some of its
+transactions are neither in our pool nor received yet. Parked blocks are
+indexed by the parent and by the transactions they wait for, so they are
+resumed as soon as the last missing item arrives. The pool is bounded,
+and blocks nobody completes expire after a while.
+'''
+import time
+from collections import OrderedDict
+
+
+class OrphanEntry:
+  __slots__ = ('hashcode', 'prev_hash', 'block', 'data', 'missing', 'found', 'source', 'depth', 'expires')
+
+  def __init__(self, hashcode, prev_hash, block, data, missing, source, depth, expires):
+    self.hashcode = hashcode
+    self.prev_hash = prev_hash
+    # a decoded block waiting for its parent, or the raw block waiting for transactions
+    self.block = block
+    self.data = data
+    self.missing = missing
+    # digest -> transaction received for this block
+    self.found = {}
+    # peer the block came from, which should have what is missing
+    self.source = source
+    # number of parked blocks in a row, this one included
+    self.depth = depth
+    self.expires = expires
+
+
+class OrphanPool:
+  max_blocks = 100
+  ttl = 120                   # seconds
+
+  # clock: source of the current time
+  def __init__(self, max_blocks=None, ttl=None, clock=time.time):
+    self.clock = clock
+    if max_blocks is not None:
+      self.max_blocks = max_blocks
+    if ttl is not None:
+      self.ttl = ttl
+    # hashcode -> entry, oldest first
+    self.entries = OrderedDict()
+    # prev_hash -> hashcodes of the blocks waiting for it
+    self.by_parent = {}
+    # transaction digest -> hashcodes of the blocks waiting for it
+    self.by_tsn = {}
+
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, hashcode):
+    return hashcode in self.entries
+
+
+  # park a block whose parent is unknown, return the entry
+  def add_block(self, block, source=None):
+    children = [self.entries[h].depth for h in self.by_parent.get(block.hashcode, ())]
+    entry = OrphanEntry(block.hashcode, block.prev_hash, block, None, set(), source,
+                        1 + max(children, default=0), self.clock() + self.ttl)
+    self._insert(entry)
+    return entry
+
+
+  # park the raw bytes of a block until the given transactions arrive, return the entry
+  def add_data(self, hashcode, data, missing, source=None):
+    entry = OrphanEntry(hashcode, None, None, data, set(missing), source, 1, self.clock() + self.ttl)
+    self._insert(entry)
+    for digest in entry.missing:
+      self.by_tsn.setdefault(digest, set()).add(hashcode)
+    return entry
+
+
+  def _insert(self, entry):
+    self.remove(entry.hashcode)
+    self.entries[entry.hashcode] = entry
+    if entry.prev_hash is not None:
+      self.by_parent.setdefault(entry.prev_hash, set()).add(entry.hashcode)
+    while len(self.entries) > self.max_blocks:
+      self.remove(next(iter(self.entries)))
+
+
+  def remove(self, hashcode):
+    entry = self.entries.pop(hashcode, None)
+    if entry is None:
+      return None
+    if entry.prev_hash is not None:
+      self._unindex(self.by_parent, entry.prev_hash, hashcode)
+    for digest in entry.missing:
+      self._unindex(self.by_tsn, digest, hashcode)
+    return entry
+
+
+  @staticmethod
+  def _unindex(index, key, hashcode):
+    waiting = index.get(key)
+    if waiting is not None:
+      waiting.discard(hashcode)
+      if not waiting:
+        del index[key]
+
+
+  # blocks that were waiting for the block hashcode, removed from the pool
+  def pop_children(self, hashcode):
+    return [self.remove(h).block for h in list(self.by_parent.get(hashcode, ()))]
+
+
+  # hand a transaction to the blocks waiting for it
+  # return the entries that have nothing missing anymore, removed from the pool
+  def resolve(self, tsn):
+    ready = []
+    for hashcode in list(self.by_tsn.pop(tsn.Digest, ())):
+      entry = self.entries[hashcode]
+      entry.missing.discard(tsn.Digest)
+      entry.found[tsn.Digest] = tsn
+      if not entry.missing:
+        ready.append(self.remove(hashcode))
+    return ready
+
+
+  # drop the blocks parked for longer than ttl, return how many
+  def expire(self, now=None):
+    now = self.clock() if now is None else now
+    count = 0
+    # entries are kept in the order they expire
+    while self.entries and next(iter(self.entries.values())).expires <= now:
+      self.remove(next(iter(self.entries)))
+      count += 1
+    return count
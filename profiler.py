@@ -0,0 +1,294 @@
+'''
+profiler.py
+sampling profiler, attributing time to message tags, methods and lock waits
+
+A background thread samples the stack of every thread at a fixed interval,
+and adds the interval (wall time) and the CPU time the thread used since
+the previous sample (on Linux) to the stack it is in. Stacks are rooted at
+the label of what the thread is handling, set with context() around each
+message, or at the thread name. Threads waiting on a ProfiledLock end
+their stack with [wait <lock>], and the waits are also timed one by one.
+
+Results are written as collapsed stacks, one file for wall and one for
+CPU time, that flamegraph.pl or speedscope read as they are, and a summary
+per label, per Miner method and per lock. Profiling can be turned on and
+off at runtime, for instance from a signal:
+
+  profiler.install(signal.SIGUSR2, 'miner-profile')
+  kill -USR2 <pid>    # start, and again to stop and write the results
+'''
+import os
+import sys
+import time
+import signal
+import logging
+from collections import Counter
+from threading import Lock, Thread, get_ident, enumerate as threads
+
+
+class Profiler:
+  interval = 0.005            # seconds between samples
+
+  def __init__(self):
+    self.active = False
+    self.lock = Lock()
+    self.thread = None
+    # thread ident -> label of what it is handling
+    self.contexts = {}
+    # thread ident -> name of the lock it waits for
+    self.waiting = {}
+    # code object -> frame name
+    self.names = {}
+    self._reset()
+
+  def _reset(self):
+    # stack, as a tuple from the root -> seconds
+    self.wall = Counter()
+    self.cpu = Counter()
+    # (label, lock name) -> seconds waited, and number of waits
+    self.lock_wait = Counter()
+    self.lock_waits = Counter()
+    self.samples = 0
+    self.started = None
+
+
+  # clear the previous results and start sampling
+  def start(self, interval=None):
+    with self.lock:
+      if self.active:
+        return
+      if interval is not None:
+        self.interval = interval
+      self._reset()
+      self.started = time.time()
+      self.active = True
+      self.thread = Thread(target=self._run, name='profiler', daemon=True)
+      self.thread.start()
+    logging.info('Profiler - started, sampling every {}s'.format(self.interval))
+
+  def stop(self):
+    with self.lock:
+      if not self.active:
+        return
+      self.active = False
+      thread = self.thread
+    thread.join()
+    logging.info('Profiler - stopped after {} samples'.format(self.samples))
+
+  # start, or stop and write the results to prefix-*, return True if started
+  def toggle(self, prefix='profile'):
+    if self.active:
+      self.stop()
+      self.dump(prefix)
+      return False
+    self.start()
+    return True
+
+
+  # attribute what the calling thread does to label, until the block exits
+  def context(self, label):
+    return _Context(self, label)
+
+  # fn running under context(label), as a thread target
+  def labelled(self, label, fn):
+    def run(*args, **kwargs):
+      with self.context(label):
+        return fn(*args, **kwargs)
+    return run
+
+  def add_lock_wait(self, lock_name, seconds):
+    key = (self.contexts.get(get_ident(), ''), lock_name)
+    with self.lock:
+      self.lock_wait[key] += seconds
+      self.lock_waits[key] += 1
+
+
+  def _name(self, frame):
+    code = frame.f_code
+    name = self.names.get(code)
+    if name is None:
+      qualname = getattr(code, 'co_qualname', None)
+      if qualname is None:
+        # before python 3.11, methods are named after the class of self the first time they are seen
+        owner = frame.f_locals.get('self') if code.co_argcount else None
+        qualname = code.co_name if owner is None else '{}.{}'.format(type(owner).__name__, code.co_name)
+      name = self.names[code] = '{}:{}'.format(os.path.basename(code.co_filename), qualname)
+    return name
+
+  def _stack(self, ident, frame, thread_names):
+    stack = []
+    while frame is not None:
+      stack.append(self._name(frame))
+      frame = frame.f_back
+    stack.append(self.contexts.get(ident) or 'thread:' + thread_names.get(ident, str(ident)))
+    stack.reverse()
+    waiting = self.waiting.get(ident)
+    if waiting is not None:
+      stack.append('[wait {}]'.format(waiting))
+    return tuple(stack)
+
+
+  def _run(self):
+    me = get_ident()
+    # thread ident -> (cpu clock, cpu time at the previous sample)
+    clocks = {}
+    last = time.perf_counter()
+    while self.active:
+      time.sleep(self.interval)
+      now = time.perf_counter()
+      elapsed, last = now - last, now
+      thread_names = {thread.ident: thread.name for thread in threads()}
+      frames = sys._current_frames()
+      samples = []
+      for ident, frame in frames.items():
+        if ident != me:
+          samples.append((self._stack(ident, frame, thread_names), self._cpu(ident, clocks)))
+      del frames
+      with self.lock:
+        self.samples += 1
+        for stack, cpu in samples:
+          self.wall[stack] += elapsed
+          if cpu:
+            self.cpu[stack] += cpu
+      for ident in set(clocks) - set(thread_names):
+        del clocks[ident]
+
+  # cpu seconds used by the thread since the previous sample, None where unsupported
+  @staticmethod
+  def _cpu(ident, clocks):
+    try:
+      if ident not in clocks:
+        clock = time.pthread_getcpuclockid(ident)
+        clocks[ident] = (clock, time.clock_gettime(clock))
+        return None
+      clock, previous = clocks[ident]
+      now = time.clock_gettime(clock)
+      clocks[ident] = (clock, now)
+      return now - previous
+    except (AttributeError, OSError):
+      return None
+
+
+  # collapsed stacks, one line per stack with its time in microseconds
+  @staticmethod
+  def collapsed(times):
+    lines = ['{} {}'.format(';'.join(stack), int(seconds * 1e6)) for stack, seconds in times.items()]
+    return '\n'.join(sorted(lines)) + '\n'
+
+  def summary(self):
+    with self.lock:
+      wall, cpu = Counter(self.wall), Counter(self.cpu)
+      lock_wait, lock_waits = Counter(self.lock_wait), Counter(self.lock_waits)
+
+    by_label, by_method = {}, {}
+    for times, column in ((wall, 0), (cpu, 1)):
+      for stack, seconds in times.items():
+        by_label.setdefault(stack[0], [0., 0.])[column] += seconds
+        # the outermost Miner method the thread is in
+        method = next((frame for frame in stack[1:] if frame.startswith('miner.py:Miner.')), None)
+        if method is not None:
+          by_method.setdefault(method[len('miner.py:'):], [0., 0.])[column] += seconds
+
+    lines = ['{} samples every {}s, started {}'.format(self.samples, self.interval, time.ctime(self.started or 0)), '']
+    for title, rows in (('label', by_label), ('Miner method', by_method)):
+      lines.append('{:<40}{:>12}{:>12}'.format(title, 'wall (s)', 'cpu (s)'))
+      for name, (w, c) in sorted(rows.items(), key=lambda row: -row[1][0]):
+        lines.append('{:<40}{:>12.3f}{:>12.3f}'.format(name, w, c))
+      lines.append('')
+    lines.append('{:<40}{:>12}{:>12}'.format('lock wait', 'waits', 'wait (s)'))
+    for (label, name), seconds in lock_wait.most_common():
+      lines.append('{:<40}{:>12}{:>12.3f}'.format('{} {}'.format(name, label or '-'), lock_waits[(label, name)], seconds))
+    return '\n'.join(lines) + '\n'
+
+
+  # write prefix-wall.folded, prefix-cpu.folded and prefix-summary.txt
+  def dump(self, prefix='profile'):
+    with self.lock:
+      wall, cpu = Counter(self.wall), Counter(self.cpu)
+    for suffix, text in (('-wall.folded', self.collapsed(wall)), ('-cpu.folded', self.collapsed(cpu)),
+                         ('-summary.txt', self.summary())):
+      with open(prefix + suffix, 'w') as f:
+        f.write(text)
+    logging.info('Profiler - results written to {}-*'.format(prefix))
+
+
+  # toggle profiling whenever signum is received, results go to prefix-<n>-*
+  def install(self, signum=getattr(signal, 'SIGUSR2', None), prefix='profile'):
+    runs = [0]
+    def handler(signum, frame):
+      # toggled off the handler, which may have interrupted a thread holding our lock
+      if not self.active:
+        runs[0] += 1
+      Thread(target=self.toggle, args=('{}-{}'.format(prefix, runs[0]),), daemon=True).start()
+    signal.signal(signum, handler)
+
+
+class _Context:
+  __slots__ = ('profiler', 'label', 'previous')
+
+  def __init__(self, profiler, label):
+    self.profiler = profiler
+    self.label = label
+
+  def __enter__(self):
+    contexts = self.profiler.contexts
+    ident = get_ident()
+    self.previous = contexts.get(ident)
+    contexts[ident] = self.label
+    return self
+
+  def __exit__(self, *exc):
+    contexts = self.profiler.contexts
+    if self.previous is None:
+      contexts.pop(get_ident(), None)
+    else:
+      contexts[get_ident()] = self.previous
+
+
+# a lock whose waits are timed while profiling, a plain lock otherwise
+class ProfiledLock:
+  def __init__(self, name, lock=None, profiler=None):
+    self.name = name
+    self.lock = lock or Lock()
+    self.profiler = profiler or PROFILER
+
+  def acquire(self, blocking=True, timeout=-1):
+    profiler = self.profiler
+    if not profiler.active:
+      return self.lock.acquire(blocking, timeout)
+    # not contended, nothing to time
+    if self.lock.acquire(False):
+      return True
+    if not blocking:
+      return False
+    ident = get_ident()
+    profiler.waiting[ident] = self.name
+    start = time.perf_counter()
+    try:
+      return self.lock.acquire(True, timeout)
+    finally:
+      profiler.waiting.pop(ident, None)
+      profiler.add_lock_wait(self.name, time.perf_counter() - start)
+
+  def release(self):
+    self.lock.release()
+
+  def locked(self):
+    return self.lock.locked()
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, *exc):
+    self.release()
+
+
+PROFILER = Profiler()
+start = PROFILER.start
+stop = PROFILER.stop
+toggle = PROFILER.toggle
+context = PROFILER.context
+labelled = PROFILER.labelled
+dump = PROFILER.dump
+install = PROFILER.install
@@ -0,0 +1,328 @@
+'''
+simulator.py
+many nodes in one process, on a virtual clock
+
+Every node is a Miner and a Node wired to an in-memory transport instead
+of sockets. A message reaches its peer after the latency of the link plus
+the time to push it through the link bandwidth, in order, unless it is
+lost. Mining is modelled as a Poisson process per node at difficulty 1,
+so no real time is spent on proofs of work. The workload comes from
+Transaction_Generator, and everything random is drawn from one seed.
+
+  python simulator.py --nodes 100 --duration 600 --seed 1
+'''
+import heapq
+import random
+import logging
+import argparse
+from threading import Event
+from statistics import median
+
+from miner import Miner
+from node import Node
+from block import Block
+from verifier import SignatureVerifier
+from WalletGenerator import Wallet_Generator, Transaction_Generator
+from network import *
+
+
+class VirtualClock:
+    def __init__(self, start=0.):
+        self.time = start
+        # (time, sequence number, function, arguments), the sequence number keeps ties in order
+        self.queue = []
+        self.count = 0
+
+    def now(self):
+        return self.time
+
+    def call_later(self, delay, fn, *args):
+        self.count += 1
+        heapq.heappush(self.queue, (self.time + delay, self.count, fn, args))
+
+    # run everything scheduled up to until, then move the clock there
+    def run(self, until):
+        while self.queue and self.queue[0][0] <= until:
+            self.time, _, fn, args = heapq.heappop(self.queue)
+            fn(*args)
+        self.time = max(self.time, until)
+
+
+class SimNetwork:
+    # latency: one way delay of every link, in seconds, plus up to jitter
+    # bandwidth: bytes per second of every link
+    # loss: probability that a message is dropped
+    def __init__(self, clock, rng, latency=0.05, jitter=0.02, bandwidth=1e6, loss=0.):
+        self.clock = clock
+        self.random = rng
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.transports = {}
+        # (src, dst) -> time the link is done sending, and time its last message arrives
+        self.busy = {}
+        self.arrival = {}
+        self.messages_sent = 0
+        self.messages_lost = 0
+        self.bytes_sent = 0
+        self.errors = 0
+
+    def attach(self, ip):
+        transport = SimTransport(self, ip)
+        self.transports[ip] = transport
+        return transport
+
+    def connect(self, a, b):
+        if b not in self.transports[a].HOSTs:
+            self.transports[a].HOSTs.append(b)
+            self.transports[b].HOSTs.append(a)
+
+    def send(self, src, dst, data, tag):
+        if dst not in self.transports:
+            return
+        self.messages_sent += 1
+        self.bytes_sent += len(data)
+        link = (src, dst)
+        now = self.clock.now()
+        done = max(now, self.busy.get(link, now)) + len(data) / self.bandwidth
+        self.busy[link] = done
+        if self.random.random() < self.loss:
+            self.messages_lost += 1
+            return
+        # messages on a link arrive in the order they were sent
+        arrival = max(done + self.latency + self.random.uniform(0, self.jitter), self.arrival.get(link, 0))
+        self.arrival[link] = arrival
+        self.clock.call_later(arrival - now, self.deliver, src, dst, tag, data)
+
+    def deliver(self, src, dst, tag, data):
+        try:
+            self.transports[dst].handler((src, FLOODING_PORT), tag, data)
+        except Exception:
+            self.errors += 1
+            logging.exception('SIM - {} failed on message {} from {}'.format(dst, tag, src))
+
+
+# stands in for Networking, see node.py
+class SimTransport:
+    def __init__(self, network, ip):
+        self.network = network
+        self.MY_IP = ip
+        self.HOSTs = []
+        self.handler = None
+        self.ready = Event()
+        self.ready.set()
+
+    def sending(self, HOST, data, tag):
+        if HOST != self.MY_IP:
+            self.network.send(self.MY_IP, HOST, data, tag)
+
+    def broadcast(self, data, tag, HOSTs=None, exclude=[]):
+        for HOST in (self.HOSTs if HOSTs is None else HOSTs):
+            if HOST not in exclude:
+                self.sending(HOST, data, tag)
+
+    # peers are chosen by the simulator
+    def request(self, HOST=None, DAT=None, thres_min=2):
+        return 0
+
+
+class Simulator:
+    # nodes: number of miners
+    # degree: average number of peers of a node
+    # wallets: number of wallets the workload sends between
+    # tx_rate: transactions submitted per second, to random nodes
+    # block_interval: mean time between two blocks over the whole network, in seconds
+    # difficulty: set on Block for the whole process
+    def __init__(self, nodes=10, degree=4, wallets=50, tx_rate=1., block_interval=10., seed=0,
+                 latency=0.05, jitter=0.02, bandwidth=1e6, loss=0., difficulty=1):
+        self.seed = seed
+        self.random = random.Random(seed)
+        Block.difficulty = difficulty
+        self.clock = VirtualClock()
+        self.network = SimNetwork(self.clock, random.Random(self.random.random()),
+                                  latency, jitter, bandwidth, loss)
+        self.tx_rate = tx_rate
+        self.mining_rate = 1. / (block_interval * nodes)
+        self.running = False
+
+        # signatures are checked once for the whole network
+        verifier = SignatureVerifier()
+        self.nodes = []
+        for i in range(nodes):
+            miner = Miner(verifier, clock=self.clock.now)
+            node = Node(miner, self.network.attach('10.{}.{}.{}'.format(i >> 16, (i >> 8) & 255, i & 255)),
+                        random.Random(self.random.random()))
+            node.gossip.clock = node.download.clock = node.history.clock = self.clock.now
+            node.call_later = self.clock.call_later
+            node.on_block_accepted_listeners += self._block_listener(node)
+            miner.on_block_added_listeners += self._block_listener(node)
+            miner.on_sync_requested_listeners += self._sync_listener(node)
+            self.nodes.append(node)
+        self._connect(degree)
+
+        W, B, _ = Wallet_Generator(wallets, 100.)
+        # Block.mine and Transaction_Generator draw from the global generator, which Wallet_Generator reseeds
+        random.seed(seed)
+        self.wallets = W
+        for node in self.nodes:
+            node.miner.add_first_block(B.to_bytes(tsn_hash_only=False))
+
+        # digest -> (transaction, sender, receiver) of the transactions not confirmed yet
+        self.pending = {}
+        self.submitted = 0
+        self.confirmed = 0
+        self.checked = 1
+        # hashcode -> (time mined, ip of the miner), and -> {ip: time received}
+        self.mined = {}
+        self.received = {}
+
+
+    # a random tree, so everyone is reachable, plus random links up to degree
+    def _connect(self, degree):
+        ips = [node.network.MY_IP for node in self.nodes]
+        for i in range(1, len(ips)):
+            self.network.connect(ips[i], ips[self.random.randrange(i)])
+        links = len(ips) - 1
+        while len(ips) > degree and links < len(ips) * degree // 2:
+            a, b = self.random.sample(ips, 2)
+            if b not in self.network.transports[a].HOSTs:
+                self.network.connect(a, b)
+                links += 1
+
+
+    def _block_listener(self, node):
+        def listener(block, *args):
+            self.received.setdefault(block.hashcode, {}).setdefault(node.network.MY_IP, self.clock.now())
+        return listener
+
+
+    # Miner.mine asks again when a sync goes unanswered, mining here goes through mine_once
+    # so the same retry is scheduled on the virtual clock after every sync request
+    def _sync_listener(self, node):
+        def listener(*args):
+            self.clock.call_later(node.miner.sync_timeout, self._retry_sync, node)
+        return listener
+
+    def _retry_sync(self, node):
+        miner = node.miner
+        if miner.need_to_sync and self.clock.now() - miner.last_sync >= miner.sync_timeout:
+            miner.trigger_sync()
+
+
+    def _mine(self, node):
+        if not self.running:
+            return
+        if node.miner._can_mine():
+            block = node.miner.mine_once()
+            if block is not None:
+                self.mined[block.hashcode] = (self.clock.now(), node.network.MY_IP)
+        self.clock.call_later(node.random.expovariate(self.mining_rate), self._mine, node)
+
+
+    def _submit(self):
+        if not self.running:
+            return
+        self._confirm()
+        m = Transaction_Generator(self.wallets)
+        if m is not None:
+            self.pending[m[0].Digest] = m
+            self.submitted += 1
+            node = self.random.choice(self.nodes)
+            node.network.handler(('client', FLOODING_PORT), NEW_TRANSACTION, m[0].to_bytes(compact=True))
+        self.clock.call_later(self.random.expovariate(self.tx_rate), self._submit)
+
+
+    # settle the wallets with what made it into the chain of the first node
+    def _confirm(self):
+        chain = self.nodes[0].miner.chain
+        self.checked = min(self.checked, len(chain))
+        for height in range(self.checked, len(chain)):
+            for tsn in chain[height].transactions:
+                if tsn.Digest in self.pending:
+                    t, s, r = self.pending.pop(tsn.Digest)
+                    s.confirm(t)
+                    r.receive(t)
+                    self.confirmed += 1
+        self.checked = len(chain)
+
+
+    # run the workload for duration seconds of virtual time, then let messages settle
+    def run(self, duration, settle=10.):
+        self.running = True
+        for node in self.nodes:
+            self.clock.call_later(node.random.expovariate(self.mining_rate), self._mine, node)
+        self.clock.call_later(self.random.expovariate(self.tx_rate), self._submit)
+        self.clock.run(duration)
+        self.running = False
+        self.clock.run(duration + settle)
+        self._confirm()
+        return self.results(duration)
+
+
+    # the tip with the most work, the one held by most nodes among equals
+    def best_node(self):
+        work = max(node.miner.tip.work for node in self.nodes)
+        tips = [node.miner.tip.hashcode for node in self.nodes if node.miner.tip.work == work]
+        tip = max(tips, key=tips.count)
+        return next(node for node in self.nodes if node.miner.tip.hashcode == tip)
+
+
+    # consensus and forks are measured against the heaviest chain, whatever node holds it
+    def results(self, duration):
+        chain = self.best_node().miner.chain
+        main = {chain.hash_at(height) for height in range(len(chain))}
+        tip = chain.hash_at(-1)
+
+        # delay from mining a block to each other node having it
+        delays, full = [], []
+        for hashcode, (mined_at, ip) in self.mined.items():
+            times = [t - mined_at for peer, t in self.received.get(hashcode, {}).items() if peer != ip]
+            delays.extend(times)
+            if len(times) == len(self.nodes) - 1:
+                full.append(max(times, default=0.))
+        delays.sort()
+        percentile = lambda values, p: values[min(len(values) - 1, int(p * len(values)))] if values else None
+
+        tsns = sum(len(chain[height].transactions) for height in range(1, len(chain)))
+        return {
+            'nodes': len(self.nodes),
+            'duration': duration,
+            'seed': self.seed,
+            'submitted': self.submitted,
+            'blocks_mined': len(self.mined),
+            'height': len(chain) - 1,
+            'fork_rate': sum(h not in main for h in self.mined) / len(self.mined) if self.mined else 0.,
+            'tps': tsns / duration,
+            'propagation_median': median(delays) if delays else None,
+            'propagation_p90': percentile(delays, .9),
+            'propagation_full_median': median(full) if full else None,
+            'in_consensus': sum(node.miner.chain.hash_at(-1) == tip for node in self.nodes) / len(self.nodes),
+            'messages': self.network.messages_sent,
+            'messages_lost': self.network.messages_lost,
+            'bytes': self.network.bytes_sent,
+            'errors': self.network.errors,
+        }
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulate a network of miners in one process.')
+    parser.add_argument('--nodes', type=int, default=10)
+    parser.add_argument('--degree', type=int, default=4)
+    parser.add_argument('--wallets', type=int, default=50)
+    parser.add_argument('--tx-rate', type=float, default=1., help='transactions per second')
+    parser.add_argument('--block-interval', type=float, default=10., help='seconds')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='seconds')
+    parser.add_argument('--bandwidth', type=float, default=1e6, help='bytes per second')
+    parser.add_argument('--loss', type=float, default=0.)
+    parser.add_argument('--duration', type=float, default=300., help='seconds of virtual time')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    sim = Simulator(args.nodes, args.degree, args.wallets, args.tx_rate, args.block_interval, args.seed,
+                    args.latency, args.jitter, args.bandwidth, args.loss)
+    for key, value in sim.run(args.duration).items():
+        print('{:<24}{}'.format(key, value))
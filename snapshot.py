@@ -0,0 +1,214 @@
+'''
+snapshot.py
+balance state of the chain at a given block
+
+Layout (version 1):
+  magic (4 bytes, 'SNAP') | version (1 byte)
+  number of blocks (varint) | hash of each block, the last one being the tip (32 bytes each)
+  number of balances (varint) | per balance: address (64 bytes) | amount in 1e-8 units (varint)
+  sha256 of everything above (32 bytes)
+
+A node starting from a snapshot keeps only the block hashes below it, in
+a SnapshotChain, and validates new blocks on top of the snapshot state
+right away. HistoryCheck then downloads the blocks below the snapshot in
+the background, replays them with full verification and compares the
+result with the snapshot.
+'''
+import os
+import logging
+from hashlib import sha256
+from base64 import b64encode, b64decode
+
+from codec import encode_varint, decode_varint, AMOUNT_SCALE, DIGEST_SIZE, KEY_SIZE
+from crypto import check_prefix
+from ledger import BalanceIndex
+from ibd import BlockDownload
+
+MAGIC = b'SNAP'
+VERSION = 1
+
+
+class Snapshot:
+  def __init__(self, hashes, balances):
+    # hashes of the blocks 0 .. height, the state is the one after the last
+    self.hashes = hashes
+    self.balances = balances
+
+  @property
+  def height(self):
+    return len(self.hashes) - 1
+
+  @property
+  def tip_hash(self):
+    return self.hashes[-1]
+
+
+  # the state of a miner at its tip, to be taken under its chain lock
+  @staticmethod
+  def from_miner(miner):
+    chain = miner.chain
+    return Snapshot([chain.hash_at(height) for height in range(len(chain))], dict(miner.balances.balances))
+
+
+  def to_bytes(self):
+    out = [MAGIC, bytes((VERSION,)), encode_varint(len(self.hashes))]
+    out.extend(self.hashes)
+    out.append(encode_varint(len(self.balances)))
+    for address, amount in sorted(self.balances.items()):
+      out.append(b64decode(address))
+      # balances are sums of amounts, rounded back to the 1e-8 units they are made of
+      out.append(encode_varint(round(amount * AMOUNT_SCALE)))
+    data = b''.join(out)
+    return data + sha256(data).digest()
+
+
+  @staticmethod
+  def from_bytes(data):
+    view = memoryview(data)
+    if bytes(view[:4]) != MAGIC or view[4] != VERSION:
+      raise ValueError('unsupported snapshot format')
+    if sha256(view[:-DIGEST_SIZE]).digest() != bytes(view[-DIGEST_SIZE:]):
+      raise ValueError('corrupted snapshot')
+
+    n, offset = decode_varint(view, 5)
+    hashes = [bytes(view[i:i + DIGEST_SIZE]) for i in range(offset, offset + n * DIGEST_SIZE, DIGEST_SIZE)]
+    offset += n * DIGEST_SIZE
+    if n == 0:
+      raise ValueError('empty snapshot')
+
+    n, offset = decode_varint(view, offset)
+    balances = {}
+    for _ in range(n):
+      address = b64encode(view[offset:offset + KEY_SIZE])
+      amount, offset = decode_varint(view, offset + KEY_SIZE)
+      balances[address] = amount / AMOUNT_SCALE
+    if offset != len(view) - DIGEST_SIZE:
+      raise ValueError('malformed snapshot')
+    return Snapshot(hashes, balances)
+
+
+  # written to a temporary file first, so a crash leaves the previous snapshot
+  def write(self, path):
+    with open(path + '.tmp', 'wb') as f:
+      f.write(self.to_bytes())
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+  @staticmethod
+  def read(path):
+    with open(path, 'rb') as f:
+      return Snapshot.from_bytes(f.read())
+
+
+  # amounts only survive with 1e-8 precision
+  def matches(self, balances):
+    rounded = lambda b: {a: round(v * AMOUNT_SCALE) for a, v in b.items() if round(v * AMOUNT_SCALE)}
+    return rounded(self.balances) == rounded(balances)
+
+
+# a chain whose blocks below the snapshot are only known by hash
+# blocks above it are kept in top, a MemoryChain or a BlockStore
+class SnapshotChain:
+  def __init__(self, snapshot, top):
+    self.snapshot = snapshot
+    self.top = top
+    self.base = len(snapshot.hashes)
+    self._heights = {hashcode: height for height, hashcode in enumerate(snapshot.hashes)}
+
+
+  def __len__(self):
+    return self.base + len(self.top)
+
+
+  def __iter__(self):
+    return iter(self.top)
+
+
+  # only blocks above the snapshot can be read, slices skip the others
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      start, stop, _ = key.indices(len(self))
+      return self.top[max(start - self.base, 0):max(stop - self.base, 0)]
+    if key < 0:
+      key += len(self)
+    if key < self.base:
+      raise IndexError('block below the snapshot')
+    return self.top[key - self.base]
+
+
+  def height_of(self, hashcode):
+    height = self._heights.get(hashcode)
+    if height is None:
+      height = self.top.height_of(hashcode)
+      if height is not None:
+        height += self.base
+    return height
+
+
+  def hash_at(self, height):
+    if height < 0:
+      height += len(self)
+    if height < self.base:
+      return self.snapshot.hashes[height]
+    return self.top.hash_at(height - self.base)
+
+
+  def append(self, block):
+    self.top.append(block)
+
+
+  def __delitem__(self, key):
+    start = (key.start or 0) if isinstance(key, slice) else key
+    if start < 0:
+      start += len(self)
+    if start < self.base:
+      raise ValueError('cannot remove blocks below the snapshot')
+    del self.top[start - self.base:]
+
+
+  def close(self):
+    self.top.close()
+
+
+# download the blocks below a snapshot and replay them with full verification
+class HistoryCheck(BlockDownload):
+  def start(self, hosts):
+    snapshot = self.miner.snapshot
+    with self.lock:
+      self._reset()
+      self.active = True
+      self.hashes = list(snapshot.hashes)
+      self.index = {hashcode: height for height, hashcode in enumerate(self.hashes)}
+      self.headers_done = True
+      self.balances = BalanceIndex()
+    logging.info('Snapshot - checking {} blocks of history in the background'.format(len(self.hashes)))
+    self._schedule(hosts)
+
+
+  def _apply(self, blocks):
+    verified = iter(self.miner.verifier.verify_many([tsn for block in blocks for tsn in block.transactions]))
+    for block in blocks:
+      height = len(self.balances)
+      # the first block is assumed correct, like in sync
+      if height > 0:
+        if block.prev_hash != self.hashes[height - 1] or not check_prefix(block.hashcode, block.difficulty):
+          return False
+        balances = self.balances.overlay()
+        for tsn in block.transactions:
+          if not next(verified) or not self.miner.verify_fund(tsn, balances):
+            return False
+          balances.apply(tsn)
+      else:
+        for tsn in block.transactions:
+          next(verified)
+      self.balances.connect(block)
+    return True
+
+
+  def _finish(self):
+    self.miner.finish_history_check(self.miner.snapshot.matches(self.balances.balances))
+
+  def _fail(self):
+    self.miner.finish_history_check(False)
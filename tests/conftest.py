@@ -0,0 +1,8 @@
+'''
+conftest.py
+the modules live at the root of the repository
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,57 @@
+'''
+test_block.py
+block header layout, and the merkle root and header prefix cached by Block
+'''
+from hashlib import sha256
+
+from block import Block
+from crypto import double_sha256, merkle_root_generation
+from mining import _nonce
+
+
+DIGESTS = [double_sha256(bytes([i])) for i in range(5)]
+
+
+def test_header_ends_with_the_nonce():
+  block = Block(b'p' * 32, list(DIGESTS), nonce=12345, timestamp=b'now')
+  header = block.to_bytes(block_head_only=True)
+  assert header == block.header_prefix() + _nonce.pack(12345)
+  assert Block.from_header(header) == block
+  assert block.hashcode == double_sha256(header)
+
+
+def test_midstate_matches_the_full_hash():
+  block = Block(b'p' * 32, list(DIGESTS), timestamp=b'now')
+  midstate = sha256(block.header_prefix())
+  for nonce in (0, 1, -7, 2**40):
+    h = midstate.copy()
+    h.update(_nonce.pack(nonce))
+    block.nonce = nonce
+    assert sha256(h.digest()).digest() == block.digest()
+
+
+def test_merkle_root_cached_until_transactions_change():
+  block = Block(b'p' * 32, list(DIGESTS), timestamp=b'now')
+  root = block.merkle_root
+  assert root == merkle_root_generation(list(DIGESTS))
+  prefix = block.header_prefix()
+  assert block.header_prefix() is prefix
+
+  block.transactions = DIGESTS[:3]
+  assert block.merkle_root == merkle_root_generation(DIGESTS[:3]) != root
+  assert block.header_prefix() != prefix
+
+
+def test_prefix_follows_header_fields():
+  block = Block(b'p' * 32, list(DIGESTS), timestamp=b'now')
+  prefix = block.header_prefix()
+  block.prev_hash = b'q' * 32
+  assert block.header_prefix() != prefix
+  block.prev_hash = b'p' * 32
+  assert block.header_prefix() == prefix
+
+
+def test_empty_block():
+  block = Block(b'', [], timestamp=b'now')
+  assert block.merkle_root is None
+  assert Block.from_header(block.to_bytes(block_head_only=True)).hashcode == block.hashcode
@@ -0,0 +1,152 @@
+'''
+test_blockstore.py
+on-disk chain storage: round trips, reopening, truncation, concurrent reads, restarts
+'''
+import os
+import threading
+
+import pytest
+
+from block import Block
+from blockstore import BlockStore, MemoryChain
+from ledger import BalanceIndex
+from miner import Miner
+from transaction import Transaction
+from wallet import Wallet
+from WalletGenerator import Wallet_Generator
+
+WALLETS = [Wallet() for _ in range(4)]
+
+
+def _chain(n, prev=b''):
+  blocks = []
+  for i in range(n):
+    s, r = WALLETS[i % 4], WALLETS[(i + 1) % 4]
+    tsn = Transaction(senders=[[b'', s.address]], receivers=[[float(i + 1), r.address]])
+    blocks.append(Block(prev, [tsn], nonce=i))
+    prev = blocks[-1].hashcode
+  return blocks
+
+
+def test_round_trip(tmp_path):
+  store = BlockStore(str(tmp_path))
+  blocks = _chain(5)
+  for block in blocks:
+    store.append(block)
+  assert len(store) == 5
+  assert [store.hash_at(h) for h in range(5)] == [b.hashcode for b in blocks]
+  assert store.hash_at(-1) == blocks[-1].hashcode
+  assert store.height_of(blocks[3].hashcode) == 3
+  assert store[2] == blocks[2] and store[-1] == blocks[-1]
+  assert [b.hashcode for b in store[1:3]] == [b.hashcode for b in blocks[1:3]]
+  with pytest.raises(IndexError):
+    store[5]
+  with pytest.raises(IndexError):
+    store.hash_at(5)
+  store.close()
+
+
+def test_reopen_and_partial_record(tmp_path):
+  store = BlockStore(str(tmp_path))
+  blocks = _chain(3)
+  for block in blocks:
+    store.append(block)
+  store.close()
+  # a record torn by a crash is dropped
+  with open(os.path.join(str(tmp_path), 'index.dat'), 'ab') as f:
+    f.write(b'\x00' * 10)
+
+  store = BlockStore(str(tmp_path))
+  assert len(store) == 3
+  # bypass the cache
+  store._cache.clear()
+  assert [store[h].hashcode for h in range(3)] == [b.hashcode for b in blocks]
+  store.close()
+
+
+def test_truncate_and_segments(tmp_path, monkeypatch):
+  monkeypatch.setattr(BlockStore, 'segment_size', 1000)
+  store = BlockStore(str(tmp_path))
+  blocks = _chain(8)
+  for block in blocks:
+    store.append(block)
+  assert len([f for f in os.listdir(str(tmp_path)) if f.startswith('blk')]) > 1
+
+  del store[3:]
+  assert len(store) == 3 and store.height_of(blocks[5].hashcode) is None
+  other = _chain(2, blocks[2].hashcode)
+  for block in other:
+    store.append(block)
+  store.close()
+
+  store = BlockStore(str(tmp_path))
+  assert [store.hash_at(h) for h in range(5)] == [b.hashcode for b in blocks[:3] + other]
+  assert store[4] == other[1]
+  store.close()
+
+
+def test_reads_while_appending(tmp_path, monkeypatch):
+  monkeypatch.setattr(BlockStore, 'segment_size', 4000)
+  monkeypatch.setattr(BlockStore, 'cache_size', 2)
+  store = BlockStore(str(tmp_path))
+  blocks = _chain(200)
+  store.append(blocks[0])
+  errors, done = [], threading.Event()
+
+  def read():
+    try:
+      while not done.is_set():
+        n = len(store)
+        for h in (0, n // 2, n - 1):
+          assert store.hash_at(h) == blocks[h].hashcode
+          assert store[h].hashcode == blocks[h].hashcode
+    except Exception as e:
+      errors.append(e)
+
+  readers = [threading.Thread(target=read) for _ in range(4)]
+  for t in readers:
+    t.start()
+  for block in blocks[1:]:
+    store.append(block)
+  done.set()
+  for t in readers:
+    t.join()
+  store.close()
+  assert errors == []
+
+
+def test_restart_from_balance_checkpoint(tmp_path, monkeypatch):
+  monkeypatch.setattr(Block, 'difficulty', 1)
+  monkeypatch.setattr(Miner, 'checkpoint_interval', 3)
+  W, genesis, _ = Wallet_Generator(4, 100.)
+  wallets = list(W.values())
+
+  miner = Miner(data_dir=str(tmp_path))
+  miner.add_first_block(genesis.to_bytes(tsn_hash_only=False))
+  prev = genesis
+  for i in range(4):
+    s, r = wallets[i], wallets[(i + 1) % 4]
+    tsn = s.send(10., r.address)
+    block = Block(prev.hashcode, [tsn])
+    block.mine()
+    miner.add_received_block(block.to_bytes(tsn_hash_only=False))
+    s.confirm(tsn)
+    r.receive(tsn)
+    prev = block
+  assert len(miner.chain) == 5
+  balances = dict(miner.balances.balances)
+  miner.chain.close()
+
+  # the checkpoint was taken at height 3, only the blocks above it are replayed
+  connected = []
+  connect = BalanceIndex.connect
+  monkeypatch.setattr(BalanceIndex, 'connect', lambda self, block: connected.append(block) or connect(self, block))
+  miner = Miner(data_dir=str(tmp_path))
+  assert len(connected) == 2
+  assert miner.balances.balances == balances
+  rebuilt = BalanceIndex()
+  rebuilt.rebuild(MemoryChain(list(miner.chain)))
+  assert rebuilt.balances == balances
+  # the undo records came along, a reorg can still roll back below the checkpoint
+  assert miner.balances.base == 0
+  miner.chain.close()
@@ -0,0 +1,127 @@
+'''
+test_blocktree.py
+the block tree, and the miner following the branch with the most work
+'''
+import pytest
+
+from block import Block
+from blocktree import BlockTree, block_work
+from blockstore import MemoryChain
+from miner import Miner, Status
+from WalletGenerator import Wallet_Generator
+
+
+def _block(prev, name):
+  return Block(prev.hashcode if prev is not None else b'', [name * 32], timestamp=name)
+
+
+def test_heights_and_work():
+  tree = BlockTree()
+  g = _block(None, b'g')
+  a1 = _block(g, b'a')
+  b1 = _block(g, b'b')
+  b2 = _block(b1, b'c')
+  nodes = [tree.add(block) for block in (g, a1, b1, b2)]
+  work = block_work(Block)
+  assert [(n.height, n.work) for n in nodes] == [(0, work), (1, 2 * work), (1, 2 * work), (2, 3 * work)]
+  assert tree.side == {n.hashcode for n in nodes}
+  assert tree.children[g.hashcode] == {a1.hashcode, b1.hashcode}
+
+  tree.set_main(g.hashcode)
+  assert g.hashcode not in tree.side and tree.get(g.hashcode).block is None
+  tree.set_side(g)
+  assert tree.get(g.hashcode).block is g
+
+
+def test_remove_takes_descendants():
+  tree = BlockTree()
+  g = _block(None, b'g')
+  b1 = _block(g, b'b')
+  b2 = _block(b1, b'c')
+  a1 = _block(g, b'a')
+  for block in (g, b1, b2, a1):
+    tree.add(block)
+  tree.remove(b1.hashcode)
+  assert b1.hashcode not in tree and b2.hashcode not in tree
+  assert a1.hashcode in tree and tree.children[g.hashcode] == {a1.hashcode}
+
+
+def test_prune_forgets_deep_side_branches():
+  tree = BlockTree()
+  tree.max_fork_depth = 1
+  g = _block(None, b'g')
+  side = _block(g, b's')
+  for block in (g, side):
+    tree.add(block)
+  tree.set_main(g.hashcode)
+  tree.prune(2)
+  assert side.hashcode in tree
+  tree.prune(3)
+  assert side.hashcode not in tree and g.hashcode in tree
+
+
+def test_rebuild_from_chain():
+  g = _block(None, b'g')
+  a1 = _block(g, b'a')
+  tree = BlockTree()
+  tree.rebuild(MemoryChain([g, a1]))
+  node = tree.get(a1.hashcode)
+  assert (node.prev_hash, node.height, node.work, node.block) == (g.hashcode, 1, 2 * block_work(Block), None)
+  assert tree.side == set()
+
+
+@pytest.fixture
+def miner(monkeypatch):
+  monkeypatch.setattr(Block, 'difficulty', 1)
+  W, genesis, _ = Wallet_Generator(4, 100.)
+  miner = Miner()
+  miner.add_first_block(genesis.to_bytes(tsn_hash_only=False))
+  return miner, list(W.values()), genesis
+
+
+def _mined(prev, *tsns):
+  block = Block(prev.hashcode, list(tsns))
+  block.mine()
+  return block
+
+
+def _receive(miner, block):
+  return miner.add_received_block(block.to_bytes(tsn_hash_only=False))[0]
+
+
+def test_switch_to_the_branch_with_most_work(miner):
+  miner, (a, b, c, d), genesis = miner
+  a1 = _mined(genesis, a.send(10., b.address))
+  assert _receive(miner, a1) == Status.VALID
+  tip = miner.tip
+
+  # as much work as ours: kept aside
+  b1 = _mined(genesis, c.send(10., d.address))
+  assert _receive(miner, b1) == Status.VALID
+  assert miner.tip is tip and b1.hashcode in miner.tree.side
+  assert miner.tree.get(b1.hashcode).block == b1
+
+  # more work: switch, and a1 becomes the side branch
+  b2 = _mined(b1)
+  assert _receive(miner, b2) == Status.VALID
+  assert [miner.chain.hash_at(h) for h in range(3)] == [genesis.hashcode, b1.hashcode, b2.hashcode]
+  assert miner.tip.work == 3 * block_work(Block) and miner.tip.height == 2
+  assert miner.tree.side == {a1.hashcode}
+  # what a1 confirmed waits in the pool again
+  assert a1.transactions[0].Digest in miner.tsn_pool
+
+  # and back, once a1's branch is the heaviest
+  a2 = _mined(a1)
+  a3 = _mined(a2)
+  for block in (a2, a3):
+    assert _receive(miner, block) == Status.VALID
+  assert miner.chain.hash_at(-1) == a3.hashcode
+  assert a1.transactions[0].Digest not in miner.tsn_pool
+  assert b1.transactions[0].Digest in miner.tsn_pool
+
+
+def test_duplicates(miner):
+  miner, (a, b, _, _), genesis = miner
+  a1 = _mined(genesis, a.send(10., b.address))
+  assert _receive(miner, a1) == Status.VALID
+  assert _receive(miner, a1) == Status.DUPLICATE
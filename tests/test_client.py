@@ -0,0 +1,71 @@
+'''
+test_client.py
+the WalletGenerator client following blocks relayed in compact form
+'''
+import pickle
+
+import pytest
+
+from block import Block
+from compact import encode_compact_block
+from network import INVENTORY, NEW_COMPACT_BLOCK, REQUEST_PROOF
+from transaction import Transaction
+from wallet import Wallet
+from WalletGenerator import Message_Handler
+from profiler import ProfiledLock
+
+
+class FakeNet:
+  def __init__(self):
+    self.sent = []
+
+  def sending(self, host, data, tag):
+    self.sent.append((host, data, tag))
+
+
+@pytest.fixture(autouse=True)
+def easy_blocks(monkeypatch):
+  monkeypatch.setattr(Block, 'difficulty', 1)
+
+
+def _client():
+  W = {}
+  T, C, P = {}, {}, {}
+  net = FakeNet()
+  handler = Message_Handler(W, T, C, P, ProfiledLock('lockT'), ProfiledLock('lockC'), net)
+  return handler, T, C, P, net
+
+
+def _block(prev, tsns):
+  block = Block(prev, tsns)
+  block.mine()
+  return block
+
+
+def test_compact_block_confirms_pending_transactions():
+  handler, T, C, P, _ = _client()
+  s, r = Wallet(), Wallet()
+  mine = Transaction(senders=[[b'', s.address]], receivers=[[1., r.address]])
+  other = Transaction(senders=[[b'', r.address]], receivers=[[2., s.address]])
+  T[mine.Digest] = (mine, s, r)
+
+  block = _block(b'p' * 32, [other, mine])
+  handler(('peer', 0), NEW_COMPACT_BLOCK, encode_compact_block(block))
+  assert C[block.prev_hash][block.hashcode] == block
+  assert P[block.hashcode] == {mine.Digest}
+
+
+def test_compact_block_with_bad_hash_ignored():
+  handler, T, C, P, _ = _client()
+  block = _block(b'p' * 32, [Transaction(senders=[[b'', Wallet().address]], receivers=[[1., Wallet().address]])])
+  data = pickle.loads(encode_compact_block(block))
+  data['hashcode'] = b'x' * 32
+  handler(('peer', 0), NEW_COMPACT_BLOCK, pickle.dumps(data))
+  assert C == {} and P == {}
+
+
+def test_inventory_requests_proofs():
+  handler, T, C, P, net = _client()
+  handler(('peer', 0), INVENTORY, pickle.dumps([(NEW_COMPACT_BLOCK, b'h' * 32)]))
+  assert [(host, tag) for host, _, tag in net.sent] == [('peer', REQUEST_PROOF)]
+  assert pickle.loads(net.sent[0][1])['block'] == b'h' * 32
@@ -0,0 +1,125 @@
+'''
+test_codec.py
+compact transaction format: round trips, and what is refused before reaching the encoder
+'''
+from base64 import b64encode
+
+import pytest
+
+from codec import (encode_varint, decode_varint, encode_transaction, check_transaction, peek_digest,
+                   is_compact, AMOUNT_SCALE)
+from transaction import Transaction
+from wallet import Wallet
+
+S, R = Wallet(), Wallet()
+
+
+def _signed(amount=4., change=6.):
+  tsn = Transaction(senders=[[b'd' * 32, S.address], [b'', S.address]],
+                    receivers=[[amount, R.address], [change, S.address]])
+  tsn.sign([S.key, S.key])
+  return tsn
+
+
+def _same(a, b):
+  return (a.Digest, a.Timestamp, a.Senders, a.Receivers, a.Signatures) == \
+         (b.Digest, b.Timestamp, b.Senders, b.Receivers, b.Signatures)
+
+
+@pytest.mark.parametrize('n', [0, 1, 127, 128, 300, 2**32, 10**18])
+def test_varint(n):
+  data = encode_varint(n) + b'\xff'
+  assert decode_varint(data, 0) == (n, len(data) - 1)
+
+
+def test_varint_negative():
+  with pytest.raises(ValueError):
+    encode_varint(-1)
+
+
+def test_round_trip_between_formats():
+  tsn = _signed()
+  compact, legacy = tsn.to_bytes(compact=True), tsn.to_bytes()
+  assert is_compact(compact) and not is_compact(legacy)
+  assert peek_digest(compact) == peek_digest(legacy) == tsn.Digest
+  assert len(compact) < len(legacy)
+
+  for data in (compact, legacy):
+    copy = Transaction(data)
+    assert _same(copy, tsn)
+    # the signed message is rebuilt identically, so the signatures still hold
+    assert copy.message() == tsn.message() and copy.verify()
+    assert copy.to_bytes(compact=True) == compact and copy.to_bytes() == legacy
+
+
+@pytest.mark.parametrize('amount', [0.25, 1e-8, 12.34567891, 0.3, 21e6, 0.])
+def test_exact_amounts(amount):
+  tsn = _signed(amount)
+  copy = Transaction(encode_transaction(tsn))
+  assert copy.Receivers[0][0] == amount and str(copy.Receivers[0][0]) == str(amount)
+  assert copy.verify()
+
+
+@pytest.mark.parametrize('amount', [-5., -0., 1 / 3, 0.1 + 0.2, 12.345678912, 5, float('nan'), float('inf'), 1e300])
+def test_unencodable_amounts(amount):
+  tsn = Transaction(senders=[[b'', S.address]], receivers=[[amount, R.address]])
+  assert not tsn.well_formed()
+  with pytest.raises(ValueError):
+    check_transaction(tsn)
+  with pytest.raises(ValueError):
+    tsn.to_bytes(compact=True)
+  # refused by the legacy parser as well, instead of failing later when it is relayed or stored
+  with pytest.raises(ValueError):
+    Transaction(tsn.to_bytes())
+
+
+@pytest.mark.parametrize('address', [b64encode(b'k' * 63), b64encode(b'k' * 65), b'short',
+                                     # same bytes, not written the canonical way
+                                     b64encode(b'k' * 64)[:-4] + b'\n' + b64encode(b'k' * 64)[-4:]])
+def test_malformed_addresses(address):
+  for tsn in (Transaction(senders=[[b'', address]], receivers=[[1., R.address]]),
+              Transaction(senders=[[b'', S.address]], receivers=[[1., address]])):
+    assert not tsn.well_formed()
+    with pytest.raises(ValueError):
+      Transaction(tsn.to_bytes())
+
+
+def test_malformed_digests_and_signatures():
+  tsn = Transaction(senders=[[b'x' * 31, S.address]], receivers=[[1., R.address]])
+  assert not tsn.well_formed()
+  tsn = _signed()
+  tsn.Signatures = [tsn.Signatures[0], b64encode(b's' * 63)]
+  assert not tsn.well_formed()
+
+
+def test_truncated_and_trailing_bytes():
+  data = _signed().to_bytes(compact=True)
+  for bad in (data[:-1], data[:40], data[:2], data + b'\x00'):
+    with pytest.raises(ValueError):
+      Transaction(bad)
+
+
+def test_non_canonical_amount():
+  tsn = _signed()
+  data = tsn.to_bytes(compact=True)
+  units = encode_varint(round(4. * AMOUNT_SCALE))
+  # 2**60 + 1 units has no exact float, it would not encode back to the same bytes
+  bad = data.replace(units, encode_varint(2**60 + 1), 1)
+  assert bad != data
+  with pytest.raises(ValueError):
+    Transaction(bad)
+
+
+def test_garbage_legacy():
+  for bad in (b'abc', b'a\nb', b'YQ==\nts\n!!\n!!\n'):
+    with pytest.raises(ValueError):
+      Transaction(bad)
+
+
+def test_encoding_is_cached_until_signed():
+  tsn = Transaction(senders=[[b'', S.address]], receivers=[[1., R.address]])
+  unsigned = tsn.to_bytes(compact=True)
+  assert tsn.to_bytes(compact=True) is unsigned
+  tsn.sign([S.key])
+  assert tsn.to_bytes(compact=True) != unsigned
+  assert Transaction(tsn.to_bytes(compact=True)).verify()
@@ -0,0 +1,111 @@
+'''
+test_compact.py
+compact blocks rebuilt from the pool, with one round trip for the rest
+'''
+import pickle
+
+import pytest
+
+import compact
+from block import Block
+from compact import PartialBlock, encode_compact_block, SHORT_ID_SIZE
+from miner import Miner, Status
+from WalletGenerator import Wallet_Generator
+
+
+@pytest.fixture
+def chain(monkeypatch):
+  monkeypatch.setattr(Block, 'difficulty', 1)
+  W, genesis, _ = Wallet_Generator(6, 100.)
+  wallets = list(W.values())
+  sender, receiver = Miner(), Miner()
+  for miner in (sender, receiver):
+    miner.add_first_block(genesis.to_bytes(tsn_hash_only=False))
+  return sender, receiver, wallets, genesis
+
+
+def _mined(prev, *tsns):
+  block = Block(prev.hashcode, list(tsns))
+  block.mine()
+  return block
+
+
+def test_short_ids_keyed_by_salt(chain):
+  _, _, (a, b, *_), genesis = chain
+  block = _mined(genesis, a.send(10., b.address))
+  one = pickle.loads(encode_compact_block(block, b'\x01' * 8))
+  two = pickle.loads(encode_compact_block(block, b'\x02' * 8))
+  assert len(one['short_ids']) == SHORT_ID_SIZE
+  assert one['short_ids'] != two['short_ids']
+  assert PartialBlock(encode_compact_block(block)).header == block.to_bytes(block_head_only=True)
+
+
+def test_rebuilt_from_pool(chain):
+  _, receiver, (a, b, c, d, *_), genesis = chain
+  tsns = [a.send(10., b.address), c.send(10., d.address)]
+  for tsn in tsns:
+    assert receiver.add_transaction(tsn)
+  block = _mined(genesis, *tsns)
+
+  status, rebuilt = receiver.add_compact_block(encode_compact_block(block), source='peer')
+  assert status == Status.VALID and rebuilt.hashcode == block.hashcode
+  assert receiver.chain.hash_at(-1) == block.hashcode
+
+
+def test_missing_transactions_fetched_by_position(chain):
+  sender, receiver, (a, b, c, d, e, f), genesis = chain
+  tsns = [a.send(10., b.address), c.send(10., d.address), e.send(10., f.address)]
+  receiver.add_transaction(tsns[1])
+  block = _mined(genesis, *tsns)
+  sender.add_received_block(block.to_bytes(tsn_hash_only=False))
+  requested = []
+  receiver.on_block_transactions_requested_listeners += lambda *args: requested.append(args)
+
+  assert receiver.add_compact_block(encode_compact_block(block), source='peer')[0] == Status.ORPHAN
+  assert requested == [(block.hashcode, [0, 2], 'peer')]
+  # the same block announced again is not rebuilt twice
+  assert receiver.add_compact_block(encode_compact_block(block))[0] == Status.DUPLICATE
+
+  reply = sender.get_block_transactions(pickle.dumps({'block': block.hashcode, 'indexes': [0, 2, 9]}))
+  assert pickle.loads(reply)['indexes'] == [0, 2]
+  status, rebuilt = receiver.add_block_transactions(reply)
+  assert status == Status.VALID and rebuilt.hashcode == block.hashcode
+  assert receiver.partial_blocks == {}
+
+
+def test_incomplete_reply_requests_full_block(chain):
+  _, receiver, (a, b, c, d, *_), genesis = chain
+  tsns = [a.send(10., b.address), c.send(10., d.address)]
+  block = _mined(genesis, *tsns)
+  requested = []
+  receiver.on_block_requested_listeners += lambda *args: requested.append(args)
+  receiver.add_compact_block(encode_compact_block(block), source='peer')
+
+  reply = pickle.dumps({'block': block.hashcode, 'indexes': [0], 'tsns': [tsns[0].to_bytes(compact=True)]})
+  assert receiver.add_block_transactions(reply) == (Status.ORPHAN, None)
+  assert requested == [(block.hashcode, 'peer')] and receiver.partial_blocks == {}
+
+
+def test_ambiguous_short_id_left_missing(chain, monkeypatch):
+  _, _, (a, b, c, d, *_), genesis = chain
+  block = _mined(genesis, a.send(10., b.address))
+  theirs, other = block.transactions[0], c.send(10., d.address)
+  # the other transaction shares the short id of the one in the block
+  monkeypatch.setattr(compact, 'short_id', lambda key, digest: b'\0' * SHORT_ID_SIZE)
+  partial = PartialBlock(encode_compact_block(block))
+  assert partial.fill({theirs.Digest: theirs, other.Digest: other}) == [0]
+  assert partial.fill({theirs.Digest: theirs}) == []
+
+
+def test_wrong_match_requests_full_block(chain, monkeypatch):
+  _, receiver, (a, b, c, d, *_), genesis = chain
+  # every transaction gets the same short id
+  monkeypatch.setattr(compact, 'short_id', lambda key, digest: b'\0' * SHORT_ID_SIZE)
+  receiver.add_transaction(c.send(10., d.address))
+  block = _mined(genesis, a.send(10., b.address))
+  requested = []
+  receiver.on_block_requested_listeners += lambda *args: requested.append(args)
+
+  assert receiver.add_compact_block(encode_compact_block(block), source='peer') == (Status.ORPHAN, None)
+  assert requested == [(block.hashcode, 'peer')]
+  assert receiver.chain.hash_at(-1) == genesis.hashcode
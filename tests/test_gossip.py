@@ -0,0 +1,124 @@
+'''
+test_gossip.py
+inventory announcements and GET_DATA between peers
+'''
+import pickle
+
+import pytest
+
+from gossip import Gossip, SeenCache
+from network import INVENTORY, GET_DATA, NEW_TRANSACTION, NEW_BLOCK
+
+
+class Network:
+  def __init__(self, hosts):
+    self.HOSTs = list(hosts)
+    self.sent = []
+
+  def sending(self, host, data, tag):
+    self.sent.append((host, tag, data))
+
+
+class Clock:
+  def __init__(self):
+    self.now = 0.
+
+  def __call__(self):
+    return self.now
+
+
+@pytest.fixture
+def gossip():
+  gossip = Gossip(Network(['a', 'b', 'c']))
+  gossip.clock = Clock()
+  return gossip
+
+
+def test_seen_cache_evicts_least_recent():
+  cache = SeenCache(2)
+  assert cache.add(1) and cache.add(2)
+  assert not cache.add(1)
+  cache.add(3)
+  assert 1 in cache and 2 not in cache and len(cache) == 2
+
+
+def test_announce_skips_peers_that_have_it(gossip):
+  gossip.receive('a', b'h1')
+  gossip.announce(NEW_BLOCK, b'h1', b'block', exclude=['b'])
+  assert gossip.network.sent == [('c', INVENTORY, pickle.dumps([(NEW_BLOCK, b'h1')]))]
+  # announced once per peer
+  gossip.announce(NEW_BLOCK, b'h1', b'block')
+  assert [host for host, _, _ in gossip.network.sent] == ['c', 'b']
+
+
+def test_only_unseen_items_requested(gossip):
+  gossip.mark_seen(b'old')
+  gossip.receive_inventory('a', pickle.dumps([(NEW_TRANSACTION, b'old'), (NEW_TRANSACTION, b'new')]))
+  assert gossip.network.sent == [('a', GET_DATA, pickle.dumps([b'new']))]
+  # nothing to ask for, nothing sent
+  gossip.receive_inventory('b', pickle.dumps([(NEW_TRANSACTION, b'old')]))
+  assert len(gossip.network.sent) == 1
+
+
+def test_unanswered_request_goes_to_another_peer(gossip):
+  inventory = pickle.dumps([(NEW_TRANSACTION, b'h')])
+  gossip.receive_inventory('a', inventory)
+  # still waiting for a
+  gossip.clock.now = gossip.request_timeout - 1
+  gossip.receive_inventory('b', inventory)
+  assert [host for host, _, _ in gossip.network.sent] == ['a']
+  gossip.clock.now = gossip.request_timeout
+  gossip.receive_inventory('b', inventory)
+  assert [host for host, _, _ in gossip.network.sent] == ['a', 'b']
+  # once received it is not requested again
+  assert gossip.receive('b', b'h')
+  gossip.mark_seen(b'h')
+  gossip.clock.now *= 3
+  gossip.receive_inventory('c', inventory)
+  assert len(gossip.network.sent) == 2
+
+
+def test_serve_sends_stored_payloads(gossip):
+  gossip.announce(NEW_TRANSACTION, b'h', b'tsn', exclude=['a', 'b', 'c'])
+  gossip.serve('a', pickle.dumps([b'h', b'unknown']))
+  assert gossip.network.sent == [('a', NEW_TRANSACTION, b'tsn')]
+  # a has it now, so it is not announced to a
+  gossip.announce(NEW_TRANSACTION, b'h', b'tsn')
+  assert [host for host, _, _ in gossip.network.sent[1:]] == ['b', 'c']
+
+
+def test_duplicates_dropped(gossip):
+  assert gossip.receive('a', b'h')
+  gossip.mark_seen(b'h')
+  assert not gossip.receive('b', b'h')
+  # what we announced ourselves counts as seen
+  gossip.announce(NEW_BLOCK, b'mine', b'block')
+  assert not gossip.receive('a', b'mine')
+
+
+def test_item_relayed_between_nodes():
+  one, two = Gossip(Network(['two'])), Gossip(Network(['one']))
+  nodes = {'one': one, 'two': two}
+  delivered = []
+
+  # deliver everything sent so far, as the node's handlers would
+  def flush():
+    while one.network.sent or two.network.sent:
+      for name, node in nodes.items():
+        sent, node.network.sent = node.network.sent, []
+        for host, tag, data in sent:
+          peer = nodes[host]
+          if tag == INVENTORY:
+            peer.receive_inventory(name, data)
+          elif tag == GET_DATA:
+            peer.serve(name, data)
+          elif peer.receive(name, b'h'):
+            peer.mark_seen(b'h')
+            delivered.append((host, tag, data))
+
+  one.announce(NEW_TRANSACTION, b'h', b'tsn')
+  flush()
+  assert delivered == [('two', NEW_TRANSACTION, b'tsn')]
+  # announcing it back finds one already has it
+  two.announce(NEW_TRANSACTION, b'h', b'tsn')
+  assert two.network.sent == []
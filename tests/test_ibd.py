@@ -0,0 +1,140 @@
+'''
+test_ibd.py
+headers-first download between two miners
+'''
+import pickle
+
+import pytest
+
+from block import Block
+from ibd import BlockDownload, decode_bodies
+from miner import Miner
+from WalletGenerator import Wallet_Generator
+
+
+class Clock:
+  def __init__(self):
+    self.now = 0.
+
+  def __call__(self):
+    return self.now
+
+
+# requests kept until delivered, every host is served by the same miner
+class Transport:
+  def __init__(self, download, source, hosts):
+    self.download = download
+    self.source = source
+    self.hosts = hosts
+    self.pending = []
+    download.on_headers_requested_listeners += lambda locator, host: self.pending.append(('headers', locator, host))
+    download.on_bodies_requested_listeners += lambda hashes, host: self.pending.append(('bodies', hashes, host))
+
+  def deliver(self, count=None):
+    while self.pending and count != 0:
+      kind, request, host = self.pending.pop(0)
+      if kind == 'headers':
+        self.download.add_headers(host, self.source.get_headers(pickle.dumps(request)), self.hosts)
+      else:
+        blocks = decode_bodies(self.source.get_bodies(pickle.dumps(request)))
+        self.download.add_bodies(host, blocks, self.hosts)
+      count = None if count is None else count - 1
+
+
+@pytest.fixture
+def chain(monkeypatch):
+  monkeypatch.setattr(Block, 'difficulty', 1)
+  W, genesis, _ = Wallet_Generator(20, 100.)
+  wallets = list(W.values())
+  source = Miner()
+  source.add_first_block(genesis.to_bytes(tsn_hash_only=False))
+  blocks, prev = [], genesis
+  for i in range(10):
+    block = Block(prev.hashcode, [wallets[2 * i].send(10., wallets[2 * i + 1].address)])
+    block.mine()
+    source.add_received_block(block.to_bytes(tsn_hash_only=False))
+    blocks.append(block)
+    prev = block
+  assert source.chain.hash_at(-1) == prev.hashcode
+
+  miner = Miner()
+  miner.add_first_block(genesis.to_bytes(tsn_hash_only=False))
+  download = BlockDownload(miner)
+  download.window = 2
+  download.max_requests_per_peer = 1
+  download.clock = Clock()
+  return source, miner, download, blocks
+
+
+def test_download_from_several_peers(chain):
+  source, miner, download, blocks = chain
+  # headers come in pages
+  source.max_headers = miner.max_headers = 4
+  transport = Transport(download, source, ['a', 'b'])
+  download.start('a')
+  assert miner.need_to_sync
+  transport.deliver()
+
+  assert miner.chain.hash_at(-1) == blocks[-1].hashcode
+  assert not download.active and not miner.need_to_sync
+  assert download.connected == len(blocks)
+
+
+def test_bodies_spread_over_peers(chain):
+  source, miner, download, blocks = chain
+  transport = Transport(download, source, ['a', 'b'])
+  download.start('a')
+  transport.deliver(1)
+  # every peer has one window in flight
+  assert [(kind, len(hashes), host) for kind, hashes, host in transport.pending] == \
+    [('bodies', 2, 'a'), ('bodies', 2, 'b')]
+  assert transport.pending[0][1] == [block.hashcode for block in blocks[:2]]
+
+
+def test_invalid_header_stops_headers(chain):
+  source, miner, download, blocks = chain
+  download.start('a')
+  headers = [blocks[0], blocks[1], blocks[3]]
+  reply = pickle.dumps({'height': 11, 'headers': [b.to_bytes(block_head_only=True) for b in headers]})
+  requested = []
+  download.on_headers_requested_listeners += lambda *args: requested.append(args)
+  download.on_bodies_requested_listeners += lambda hashes, host: requested.append(hashes)
+  miner.max_headers = 3
+  download.add_headers('a', reply, ['a'])
+  # the headers before the gap are still downloaded, nothing more is asked of a
+  assert download.hashes == [blocks[0].hashcode, blocks[1].hashcode]
+  assert requested == [[blocks[0].hashcode, blocks[1].hashcode]]
+
+  download.add_bodies('a', blocks[:2], ['a'])
+  assert miner.chain.hash_at(-1) == blocks[1].hashcode and not download.active
+
+
+def test_unanswered_window_asked_again(chain):
+  source, miner, download, blocks = chain
+  download.max_requests_per_peer = 5
+  transport = Transport(download, source, ['a'])
+  download.start('a')
+  transport.deliver(1)
+  assert len(transport.pending) == 5
+  transport.pending = []
+
+  # a went away, b is asked only once the requests to a timed out
+  download.add_bodies('b', [], ['b'])
+  assert transport.pending == []
+  download.clock.now = download.request_timeout + 1
+  download.add_bodies('b', [], ['b'])
+  assert [host for _, _, host in transport.pending] == ['b'] * 5
+  transport.hosts = ['b']
+  transport.deliver()
+  assert miner.chain.hash_at(-1) == blocks[-1].hashcode
+
+
+def test_blocks_outside_download_ignored(chain):
+  source, miner, download, blocks = chain
+  transport = Transport(download, source, ['a'])
+  download.start('a')
+  transport.deliver(1)
+  stranger = Block(blocks[0].hashcode, list(blocks[5].transactions))
+  stranger.mine()
+  download.add_bodies('a', [stranger], ['a'])
+  assert stranger.hashcode not in miner.tree and download.bodies == {}
@@ -0,0 +1,142 @@
+'''
+test_ledger.py
+balance index: connect, disconnect and rollback, on its own and through a reorg of the miner
+'''
+import pytest
+
+from block import Block
+from ledger import BalanceIndex
+from miner import Miner, Status
+from transaction import Transaction
+from blockstore import MemoryChain
+from WalletGenerator import Wallet_Generator
+
+A, B, C = b'a' * 88, b'b' * 88, b'c' * 88
+
+
+def _tsn(senders, receivers):
+  return Transaction(senders=[[b'', s] for s in senders], receivers=[[v, r] for v, r in receivers])
+
+
+def _block(*tsns):
+  return Block(b'', list(tsns))
+
+
+def test_connect_resets_senders_and_credits_receivers():
+  index = BalanceIndex()
+  index.connect(_block(_tsn([A], [(100., A)]), _tsn([B], [(50., B)])))
+  index.connect(_block(_tsn([A], [(30., B), (70., A)])))
+  assert (index.balance(A), index.balance(B), index.balance(C)) == (70., 80., 0)
+  assert len(index) == 2
+
+
+def test_send_drops_receipts_of_the_same_block():
+  index = BalanceIndex()
+  index.connect(_block(_tsn([A], [(100., A)])))
+  # B's change does not count the 100 it received just before
+  index.connect(_block(_tsn([A], [(100., B)]), _tsn([B], [(5., C)])))
+  assert (index.balance(A), index.balance(B), index.balance(C)) == (0, 0, 5.)
+
+
+def test_disconnect_restores_previous_balances():
+  index = BalanceIndex()
+  index.connect(_block(_tsn([A], [(100., A)])))
+  before = dict(index.balances)
+  index.connect(_block(_tsn([A], [(40., C), (60., A)])))
+  index.disconnect()
+  assert index.balances == before
+  index.disconnect()
+  assert index.balances == {} and len(index) == 0
+
+
+def test_rollback_then_connect_another_branch():
+  genesis = _block(_tsn([A], [(100., A)]), _tsn([B], [(100., B)]))
+  a1 = _block(_tsn([A], [(10., B), (90., A)]))
+  b1 = _block(_tsn([A], [(20., C), (80., A)]))
+  b2 = _block(_tsn([C], [(5., B), (15., C)]))
+
+  index = BalanceIndex()
+  for block in (genesis, a1):
+    index.connect(block)
+  index.rollback(1)
+  for block in (b1, b2):
+    index.connect(block)
+
+  rebuilt = BalanceIndex()
+  rebuilt.rebuild(MemoryChain([genesis, b1, b2]))
+  assert index.balances == rebuilt.balances
+  assert (index.balance(A), index.balance(B), index.balance(C)) == (80., 105., 15.)
+
+
+def test_rollback_below_snapshot():
+  index = BalanceIndex()
+  chain = MemoryChain([_block(_tsn([A], [(100., A)]))])
+  chain.base = 1
+  index.rebuild(chain, {A: 100.})
+  with pytest.raises(ValueError):
+    index.rollback(0)
+
+
+@pytest.fixture
+def miner(monkeypatch):
+  monkeypatch.setattr(Block, 'difficulty', 1)
+  W, genesis, _ = Wallet_Generator(3, 100.)
+  miner = Miner()
+  miner.add_first_block(genesis.to_bytes(tsn_hash_only=False))
+  return miner, list(W.values()), genesis
+
+
+def _mined(prev, *tsns):
+  block = Block(prev.hashcode, list(tsns))
+  block.mine()
+  return block
+
+
+def test_reorg_rolls_balances_back(miner):
+  miner, (a, b, c), genesis = miner
+  a1 = _mined(genesis, a.send(10., b.address))
+  assert miner.add_received_block(a1.to_bytes(tsn_hash_only=False))[0] == Status.VALID
+  assert miner.balances.balance(b.address) == 110.
+
+  # a longer branch from the first block replaces a1
+  t = a.send(20., c.address)
+  b1 = _mined(genesis, t)
+  c.receive(t)
+  b2 = _mined(b1, c.send(5., b.address))
+  for block in (b1, b2):
+    miner.add_received_block(block.to_bytes(tsn_hash_only=False))
+
+  assert miner.chain.hash_at(-1) == b2.hashcode
+  rebuilt = BalanceIndex()
+  rebuilt.rebuild(miner.chain)
+  assert miner.balances.balances == rebuilt.balances
+  assert [miner.balances.balance(w.address) for w in (a, b, c)] == [80., 105., 115.]
+
+
+def test_fund_check_rejects_non_positive_outputs(miner):
+  miner, (a, b, _), _ = miner
+  assert miner.verify_fund(a.send(10., b.address))
+  for amount in (-5., 0.):
+    tsn = Transaction(senders=[[b'', a.address]], receivers=[[amount, b.address], [100. - amount, a.address]])
+    assert not miner.verify_fund(tsn)
+  # more than the sender holds
+  assert not miner.verify_fund(Transaction(senders=[[b'', a.address]], receivers=[[101., b.address]]))
+
+
+def test_block_spending_a_balance_twice(miner):
+  miner, (a, b, c), genesis = miner
+  # both sends spend all of a, naming different inputs
+  to_b = Transaction(senders=[[b'x' * 32, a.address]], receivers=[[100., b.address]])
+  to_c = Transaction(senders=[[b'y' * 32, a.address]], receivers=[[100., c.address]])
+  for tsn in (to_b, to_c):
+    tsn.sign([a.key])
+    assert miner.verify_fund(tsn)
+
+  block = _mined(genesis, to_b, to_c)
+  assert miner.add_received_block(block.to_bytes(tsn_hash_only=False))[0] == Status.INVALID
+  assert miner.chain.hash_at(-1) == genesis.hashcode
+  assert [miner.balances.balance(w.address) for w in (a, b, c)] == [100., 100., 100.]
+
+  # the overlay leaves the index alone, and each send on its own is still fine
+  block = _mined(genesis, to_b)
+  assert miner.add_received_block(block.to_bytes(tsn_hash_only=False))[0] == Status.VALID
@@ -0,0 +1,132 @@
+'''
+test_mempool.py
+admission, eviction order, the byte cap and conflicts of the mempool
+'''
+import pytest
+
+from mempool import Mempool
+from transaction import Transaction
+from wallet import Wallet
+
+W = [Wallet() for _ in range(10)]
+
+
+def _tsn(n, amount=1.):
+  # n picks the sender, so transactions with different n never conflict
+  return Transaction(senders=[[bytes([n]) * 32, W[n].address]], receivers=[[amount, W[0].address]])
+
+
+def _size(tsn):
+  return len(tsn.to_bytes(compact=True))
+
+
+def test_add_and_select_age():
+  pool = Mempool()
+  tsns = [_tsn(i) for i in range(5)]
+  for tsn in tsns:
+    assert pool.add(tsn)
+  assert not pool.add(tsns[0])
+  assert len(pool) == 5 and pool.size == sum(map(_size, tsns))
+  assert pool.select(3) == tsns[:3]
+  # select leaves the pool as it was
+  assert pool.select(10) == tsns
+
+
+def test_select_fee():
+  pool = Mempool(policy=Mempool.FEE)
+  fees = [3, 1, 5, 1, 4]
+  tsns = [_tsn(i) for i in range(5)]
+  for tsn, fee in zip(tsns, fees):
+    pool.add(tsn, fee)
+  assert pool.select(5) == [tsns[2], tsns[4], tsns[0], tsns[1], tsns[3]]
+
+
+def test_byte_cap_age_keeps_oldest():
+  tsns = [_tsn(i) for i in range(4)]
+  pool = Mempool(max_bytes=3 * _size(tsns[0]))
+  assert all(pool.add(tsn) for tsn in tsns[:3])
+  # the newcomer ranks last, so it is refused rather than evicting older entries
+  assert not pool.add(tsns[3])
+  assert pool.select(4) == tsns[:3] and pool.size <= pool.max_bytes
+
+
+def test_byte_cap_fee_evicts_worst():
+  tsns = [_tsn(i) for i in range(5)]
+  pool = Mempool(max_bytes=3 * _size(tsns[0]), policy=Mempool.FEE)
+  pool.add(tsns[0], 2)
+  pool.add(tsns[1], 1)
+  pool.add(tsns[2], 3)
+  # lowest fee goes first
+  assert pool.add(tsns[3], 5)
+  assert tsns[1].Digest not in pool
+  # among equal fees the newest ranks last, so it does not evict an older entry
+  assert not pool.add(tsns[4], 2)
+  assert tsns[0].Digest in pool and len(pool) == 3
+  assert pool.select(3) == [tsns[3], tsns[2], tsns[0]]
+  assert pool.add(tsns[4], 4)
+  assert tsns[0].Digest not in pool
+  assert pool.select(3) == [tsns[3], tsns[4], tsns[2]]
+  assert pool.size <= pool.max_bytes
+
+
+def test_larger_than_cap():
+  tsn = _tsn(1)
+  pool = Mempool(max_bytes=_size(tsn) - 1, policy=Mempool.FEE)
+  assert not pool.add(tsn, 100)
+  assert len(pool) == 0 and pool.size == 0
+
+
+def test_readded_entry_ranked_by_new_fee():
+  tsns = [_tsn(i) for i in range(3)]
+  pool = Mempool(max_bytes=2 * _size(tsns[0]), policy=Mempool.FEE)
+  pool.add(tsns[0], 1)
+  pool.add(tsns[1], 5)
+  pool.pop(tsns[0].Digest)
+  pool.add(tsns[0], 9)
+  # the stale fee 1 entry of tsns[0] must not make it the eviction target
+  assert pool.add(tsns[2], 7)
+  assert tsns[1].Digest not in pool
+  assert pool.select(2) == [tsns[0], tsns[2]]
+
+
+def test_conflicts():
+  pool = Mempool()
+  first = _tsn(1, 1.)
+  double = _tsn(1, 2.)
+  assert pool.add(first)
+  assert pool.conflicts(double) == {first.Digest}
+  assert not pool.add(double)
+
+  # first replaced by a transaction confirmed in a block
+  pool.remove_conflicts(double)
+  assert len(pool) == 0 and pool.size == 0
+  assert pool.add(double)
+  assert pool.conflicts(first) == {double.Digest}
+
+
+def test_sends_from_one_address_conflict():
+  # a send spends the whole balance, whatever inputs it names
+  pool = Mempool()
+  a, b, c = W[1].address, W[2].address, W[3].address
+  to_b = Transaction(senders=[[b'x' * 32, a]], receivers=[[100., b]])
+  to_c = Transaction(senders=[[b'y' * 32, a]], receivers=[[100., c]])
+  assert pool.add(to_b)
+  assert pool.conflicts(to_c) == {to_b.Digest}
+  assert not pool.add(to_c)
+  assert pool.select(2) == [to_b]
+
+
+def test_pop_releases_inputs():
+  pool = Mempool()
+  first = _tsn(1, 1.)
+  pool.add(first)
+  assert pool.pop(first.Digest) is first
+  assert pool.pop(first.Digest) is None
+  assert pool.add(_tsn(1, 2.))
+
+
+@pytest.mark.parametrize('receivers', [[[-1., W[0].address]], [[1 / 3, W[0].address]], [[1., b'not a key']]])
+def test_malformed_refused(receivers):
+  pool = Mempool()
+  assert not pool.add(Transaction(senders=[[b'', W[0].address]], receivers=receivers))
+  assert len(pool) == 0 and pool.size == 0
@@ -0,0 +1,60 @@
+'''
+test_merkle.py
+merkle tree updates and inclusion proofs
+'''
+import pytest
+
+from crypto import double_sha256, merkle_root_generation
+from merkle import MerkleTree, verify_proof
+
+
+def _leaves(n):
+  return [double_sha256(bytes([i])) for i in range(n)]
+
+
+@pytest.mark.parametrize('n', range(1, 10))
+def test_root_and_proofs(n):
+  leaves = _leaves(n)
+  tree = MerkleTree(leaves)
+  assert tree.root == merkle_root_generation(leaves)
+  for index, leaf in enumerate(leaves):
+    assert tree.proof(leaf)[0] == index
+    assert verify_proof(leaf, *tree.proof(leaf), tree.root)
+
+
+def test_empty_and_unknown():
+  assert MerkleTree().root is None
+  assert MerkleTree(_leaves(3)).proof(b'x' * 32) is None
+
+
+@pytest.mark.parametrize('n', [3, 5, 6, 7, 9])
+def test_index_bound_to_position(n):
+  leaves = _leaves(n)
+  tree = MerkleTree(leaves)
+  for leaf in leaves:
+    index, path = tree.proof(leaf)
+    # the last leaf of an odd level is hashed alone, the next index must not pass for it
+    for other in (index + 1, index - 1, index ^ 1, index + (1 << len(path)), -1, 1 << len(path)):
+      if other != index:
+        assert not verify_proof(leaf, other, path, tree.root)
+
+
+def test_wrong_leaf_or_root():
+  tree = MerkleTree(_leaves(4))
+  index, path = tree.proof(_leaves(4)[1])
+  assert not verify_proof(_leaves(4)[2], index, path, tree.root)
+  assert not verify_proof(_leaves(4)[1], index, path, b'r' * 32)
+
+
+@pytest.mark.parametrize('n', range(0, 9))
+def test_incremental_updates(n):
+  tree = MerkleTree(_leaves(n))
+  extra = _leaves(n + 3)[n:]
+  for leaf in extra:
+    tree.add(leaf)
+  assert tree.root == MerkleTree(_leaves(n) + extra).root
+  new = double_sha256(b'new')
+  tree.replace(0, new)
+  leaves = [new] + (_leaves(n) + extra)[1:]
+  assert tree.root == merkle_root_generation(leaves)
+  assert verify_proof(new, *tree.proof(new), tree.root)
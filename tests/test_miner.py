@@ -0,0 +1,190 @@
+'''
+test_miner.py
+chain_lock around the block writers, and the chain replies sent to peers
+'''
+import pickle
+from threading import Thread
+
+import pytest
+
+from block import Block
+from compact import encode_compact_block
+from miner import Miner, Status
+from transaction import Transaction
+from WalletGenerator import Wallet_Generator
+
+
+@pytest.fixture
+def miner(monkeypatch):
+  monkeypatch.setattr(Block, 'difficulty', 1)
+  W, genesis, _ = Wallet_Generator(3, 100.)
+  miner = Miner()
+  miner.add_first_block(genesis.to_bytes(tsn_hash_only=False))
+  a, b, _ = W.values()
+  blocks = [genesis]
+  for amount in (10., 20.):
+    block = Block(blocks[-1].hashcode, [a.send(amount, b.address)])
+    block.mine()
+    a.confirm(block.transactions[0])
+    miner.add_received_block(block.to_bytes(tsn_hash_only=False))
+    blocks.append(block)
+  assert miner.chain.hash_at(-1) == blocks[-1].hashcode
+  return miner, blocks
+
+
+# True if another thread can take lock right now
+def _free(lock):
+  result = []
+  def probe():
+    got = lock.acquire(False)
+    if got:
+      lock.release()
+    result.append(got)
+  thread = Thread(target=probe)
+  thread.start()
+  thread.join()
+  return result[0]
+
+
+def _fail(*args, **kwargs):
+  raise RuntimeError('writer failed')
+
+
+def test_writers_release_the_lock_on_error(miner, monkeypatch):
+  miner, blocks = miner
+  monkeypatch.setattr(miner, '_add_block_data', _fail)
+  with pytest.raises(RuntimeError):
+    miner.add_received_block(b'')
+  assert _free(miner.chain_lock)
+
+  monkeypatch.setattr(miner, '_add_partial_block', _fail)
+  with pytest.raises(RuntimeError):
+    miner.add_compact_block(encode_compact_block(Block(blocks[-1].hashcode, [])))
+  assert _free(miner.chain_lock)
+
+  empty = Miner()
+  monkeypatch.setattr(Block, 'from_bytes', _fail)
+  with pytest.raises(RuntimeError):
+    empty.add_first_block(b'')
+  assert _free(empty.chain_lock)
+
+
+def test_readers_wait_for_the_writer(miner):
+  miner, blocks = miner
+  replies = []
+  reader = Thread(target=lambda: replies.append(miner.get_headers(pickle.dumps([blocks[0].hashcode]))))
+  with miner._acquire_chain():
+    reader.start()
+    reader.join(0.2)
+    assert reader.is_alive()
+  reader.join(5)
+  assert [Block.from_header(h).hashcode for h in pickle.loads(replies[0])['headers']] == \
+         [b.hashcode for b in blocks[1:]]
+
+
+def test_sync_triggered_by_the_writer(miner):
+  miner, blocks = miner
+  locators = []
+  miner.on_sync_requested_listeners += locators.append
+  # the writer reads the locator while holding chain_lock
+  def write():
+    with miner._acquire_chain():
+      miner.trigger_sync()
+  thread = Thread(target=write, daemon=True)
+  thread.start()
+  thread.join(5)
+  assert not thread.is_alive()
+  assert locators == [[b.hashcode for b in reversed(blocks)]]
+
+
+def test_replies(miner):
+  miner, blocks = miner
+  reply = pickle.loads(miner.get_blocks(pickle.dumps([blocks[1].hashcode])))
+  assert reply['height'] == 3
+  assert [Block.from_bytes(b).hashcode for b in reply['blocks']] == [blocks[2].hashcode]
+
+  reply = pickle.loads(miner.get_bodies(pickle.dumps([blocks[1].hashcode, b'x' * 32])))
+  assert [Block.from_bytes(b).hashcode for b in reply['blocks']] == [blocks[1].hashcode]
+  assert miner.get_block(b'x' * 32) is None
+
+  digest = blocks[2].transactions[0].Digest
+  reply = pickle.loads(miner.get_proofs(pickle.dumps({'block': blocks[2].hashcode, 'digests': [digest]})))
+  assert reply['height'] == 2 and reply['proofs'][digest] == blocks[2].proof(digest)
+
+  reply = pickle.loads(miner.get_block_transactions(pickle.dumps({'block': blocks[2].hashcode, 'indexes': [0, 5]})))
+  assert reply['indexes'] == [0] and reply['tsns'] == [blocks[2].transactions[0].to_bytes(compact=True)]
+
+
+def test_template_reused_until_published(monkeypatch):
+  monkeypatch.setattr(Block, 'difficulty', 1)
+  W, genesis, _ = Wallet_Generator(4, 100.)
+  a, b, c, d = W.values()
+  miner = Miner()
+  miner.block_capacity = 2
+  miner.add_first_block(genesis.to_bytes(tsn_hash_only=False))
+  to_b, to_d = a.send(10., b.address), c.send(10., d.address)
+  for tsn in (to_b, to_d):
+    assert miner.add_transaction(tsn) == Status.VALID
+
+  # mining is interrupted, as by a block from a peer
+  mine = Block.mine
+  monkeypatch.setattr(Block, 'mine', lambda block: False)
+  assert miner.mine_once() is None
+  template = miner.template
+  assert [t.Digest for t in template.transactions] == [to_b.Digest, to_d.Digest]
+
+  # to_b leaves the pool, the next template takes a new transaction in its slot
+  miner.tsn_pool.pop(to_b.Digest)
+  to_a = d.send(10., a.address)
+  assert miner.add_transaction(to_a) == Status.VALID
+  template.stop_mining = True
+  assert miner.mine_once() is None
+  assert miner.template is template
+  assert [t.Digest for t in template.transactions] == [to_a.Digest, to_d.Digest]
+  assert template.merkle_root == Block(b'', list(template.transactions)).merkle_root
+  assert not template.stop_mining
+
+  # once published, the template is not touched again
+  monkeypatch.setattr(Block, 'mine', mine)
+  block = miner.mine_once()
+  assert block is template and miner.template is None
+  assert miner.chain.hash_at(-1) == block.hashcode
+
+
+def test_failed_reorg_puts_branch_transactions_back(monkeypatch):
+  monkeypatch.setattr(Block, 'difficulty', 1)
+  W, genesis, _ = Wallet_Generator(4, 100.)
+  a, b, c, d = W.values()
+  miner = Miner()
+  miner.add_first_block(genesis.to_bytes(tsn_hash_only=False))
+  ours = Block(genesis.hashcode, [a.send(10., b.address)])
+  ours.mine()
+  assert miner.add_received_block(ours.to_bytes(tsn_hash_only=False))[0] == Status.VALID
+
+  pooled = c.send(10., d.address)
+  assert miner.add_transaction(pooled) == Status.VALID
+  # a longer branch whose second block carries a transaction nobody signed
+  b1 = Block(genesis.hashcode, [pooled])
+  b1.mine()
+  b2 = Block(b1.hashcode, [Transaction(senders=[[b'', d.address]], receivers=[[5., a.address]])])
+  b2.mine()
+  assert miner.add_received_block(b1.to_bytes(tsn_hash_only=False))[0] == Status.VALID
+  assert miner.add_received_block(b2.to_bytes(tsn_hash_only=False))[0] == Status.INVALID
+
+  assert miner.chain.hash_at(-1) == ours.hashcode
+  assert pooled.Digest in miner.tsn_pool
+  # what went back on our chain is not pooled twice
+  assert ours.transactions[0].Digest not in miner.tsn_pool
+
+
+def test_template_built_under_chain_lock(miner, monkeypatch):
+  miner, blocks = miner
+  held = []
+  template = miner._template
+  def checked(tip):
+    held.append(not _free(miner.chain_lock))
+    return template(tip)
+  monkeypatch.setattr(miner, '_template', checked)
+  monkeypatch.setattr(Block, 'mine', lambda block: False)
+  miner.mine_once()
+  assert held == [True]
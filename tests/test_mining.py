@@ -0,0 +1,73 @@
+'''
+test_mining.py
+proof-of-work backends searching the nonce space of a block
+'''
+import threading
+
+import pytest
+
+from block import Block
+from crypto import double_sha256, check_prefix
+from mining import search_range, LocalBackend, ProcessPoolBackend, _nonce
+
+
+PREFIX = b'header without its nonce'
+
+
+def test_search_range_finds_the_first_nonce():
+  nonce, tries = search_range(PREFIX, 1, 0, 1 << 16)
+  expected = next(n for n in range(1 << 16) if check_prefix(double_sha256(PREFIX + _nonce.pack(n)), 1))
+  assert (nonce, tries) == (expected, expected + 1)
+
+
+def test_search_range_exhausted_and_stopped():
+  assert search_range(PREFIX, 32, 0, 100) == (None, 100)
+  nonce, tries = search_range(PREFIX, 32, 0, 1 << 20, stop=lambda: True, check_every=10)
+  assert nonce is None and tries == 1
+
+
+@pytest.fixture(params=['local', 'pool'])
+def backend(request):
+  backend = LocalBackend() if request.param == 'local' else ProcessPoolBackend(2)
+  backend.chunk_size = 1 << 10
+  yield backend
+  if request.param == 'pool':
+    backend.close()
+
+
+def test_backend_mines_a_valid_block(backend, monkeypatch):
+  monkeypatch.setattr(Block, 'backend', backend)
+  monkeypatch.setattr(Block, 'difficulty', 1)
+  block = Block(b'p' * 32, [])
+  assert block.mine()
+  assert block.validate()
+  assert block.hashcode == double_sha256(block.to_bytes(block_head_only=True))
+  assert backend.tries > 0
+
+
+def test_backend_stops_when_told(backend, monkeypatch):
+  monkeypatch.setattr(Block, 'backend', backend)
+  # no nonce can satisfy 32 zero bytes
+  monkeypatch.setattr(Block, 'difficulty', 32)
+  block = Block(b'p' * 32, [])
+  timer = threading.Timer(0.3, setattr, (block, 'stop_mining', True))
+  timer.start()
+  assert not block.mine()
+  timer.join()
+
+
+def test_pool_backend_searches_again_after_a_stop(monkeypatch):
+  backend = ProcessPoolBackend(2)
+  backend.chunk_size = 1 << 10
+  monkeypatch.setattr(Block, 'backend', backend)
+  try:
+    monkeypatch.setattr(Block, 'difficulty', 32)
+    stopped = Block(b'p' * 32, [])
+    stopped.stop_mining = True
+    assert not stopped.mine()
+    # chunks queued for the stopped search don't leak into the next one
+    monkeypatch.setattr(Block, 'difficulty', 1)
+    block = Block(b'q' * 32, [])
+    assert block.mine() and block.validate()
+  finally:
+    backend.close()
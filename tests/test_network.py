@@ -0,0 +1,194 @@
+'''
+test_network.py
+framing, connections and dispatching of received messages
+'''
+import asyncio
+import socket
+import threading
+import time
+from queue import Queue
+
+import pytest
+
+from network import Networking, FRAME_HEADER, MAX_FRAME_SIZE, PRIORITIES, NEW_BLOCK, NEW_TRANSACTION
+
+
+def test_dispatch_without_handler_or_buffer():
+  net = Networking('127.0.0.1')
+  # dropped, instead of failing on the missing BUFFER
+  asyncio.run(net.dispatch((('peer', 0), NEW_BLOCK, b'data')))
+
+
+def test_dispatch_to_buffer():
+  buffer = Queue()
+  net = Networking('127.0.0.1', buffer)
+  asyncio.run(net.dispatch((('peer', 0), NEW_BLOCK, b'data')))
+  assert buffer.get_nowait() == (('peer', 0), NEW_BLOCK, b'data')
+
+
+def _free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+
+@pytest.fixture
+def listen():
+  started = []
+  def start(handler, **kwargs):
+    net = Networking('127.0.0.2', PORT=_free_port(), handler=handler, **kwargs)
+    thread = threading.Thread(target=net.listening, daemon=True)
+    thread.start()
+    assert net.ready.wait(5)
+    started.append((net, thread))
+    return net
+  yield start
+  for net, thread in started:
+    net.shutdown()
+    thread.join(5)
+
+
+@pytest.fixture
+def server(listen):
+  received = Queue()
+  return listen(lambda *m: received.put(m)), received
+
+
+def _frame(tag, data):
+  return FRAME_HEADER.pack(len(data), tag) + data
+
+
+def test_frames_split_and_joined(server):
+  net, received = server
+  with socket.create_connection(('127.0.0.2', net.PORT)) as conn:
+    # one frame a byte at a time, then two frames in one write
+    for byte in _frame(NEW_BLOCK, b'first'):
+      conn.sendall(bytes([byte]))
+    conn.sendall(_frame(NEW_TRANSACTION, b'') + _frame(NEW_BLOCK, b'x' * 100000))
+    messages = [received.get(timeout=5) for _ in range(3)]
+  assert sorted((tag, data) for _, tag, data in messages) == \
+         sorted([(NEW_BLOCK, b'first'), (NEW_TRANSACTION, b''), (NEW_BLOCK, b'x' * 100000)])
+
+
+def test_oversized_frame_closes_the_connection(server):
+  net, received = server
+  with socket.create_connection(('127.0.0.2', net.PORT)) as conn:
+    conn.sendall(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1, NEW_BLOCK))
+    conn.settimeout(5)
+    assert conn.recv(1) == b''
+  assert received.empty()
+
+
+def test_connection_kept_for_later_frames(server):
+  net, received = server
+  client = Networking('127.0.0.3', PORT=net.PORT)
+
+  async def send_twice():
+    await client.send('127.0.0.2', _frame(NEW_BLOCK, b'one'))
+    first = client.connections['127.0.0.2']
+    await client.send('127.0.0.2', _frame(NEW_BLOCK, b'two'))
+    assert client.connections['127.0.0.2'] is first
+    # a closed connection is opened again on the next send
+    client.disconnect('127.0.0.2')
+    await client.send('127.0.0.2', _frame(NEW_BLOCK, b'three'))
+    client.disconnect('127.0.0.2')
+
+  asyncio.run(send_twice())
+  messages = [received.get(timeout=5) for _ in range(3)]
+  assert sorted(data for _, _, data in messages) == [b'one', b'three', b'two']
+  # the first two came over the same connection
+  ports = {data: addr[1] for addr, _, data in messages}
+  assert ports[b'one'] == ports[b'two'] != ports[b'three']
+
+
+def test_handlers_bounded_by_max_concurrency(listen):
+  lock, running, peak, done = threading.Lock(), [0], [0], Queue()
+  def handler(addr, tag, data):
+    with lock:
+      running[0] += 1
+      peak[0] = max(peak[0], running[0])
+    time.sleep(0.05)
+    with lock:
+      running[0] -= 1
+    done.put(data)
+  net = listen(handler, max_concurrency=3)
+  with socket.create_connection(('127.0.0.2', net.PORT)) as conn:
+    conn.sendall(b''.join(_frame(NEW_TRANSACTION, bytes([i])) for i in range(12)))
+    assert sorted(done.get(timeout=5) for _ in range(12)) == [bytes([i]) for i in range(12)]
+  # one of the three workers only takes blocks
+  assert peak[0] == 2
+
+
+def test_coroutine_handler_and_failures(listen):
+  done = Queue()
+  async def handler(addr, tag, data):
+    if data == b'fail':
+      raise ValueError('handler failed')
+    done.put(data)
+  net = listen(handler)
+  with socket.create_connection(('127.0.0.2', net.PORT)) as conn:
+    conn.sendall(_frame(NEW_BLOCK, b'fail') + _frame(NEW_BLOCK, b'ok'))
+    # a failing handler doesn't stop the worker or the connection
+    assert done.get(timeout=5) == b'ok'
+
+
+# a single worker held on its first message until the gate opens
+def _held(listen, **kwargs):
+  started, gate, done = threading.Event(), threading.Event(), Queue()
+  def handler(addr, tag, data):
+    started.set()
+    gate.wait(5)
+    done.put((tag, data))
+  net = listen(handler, max_concurrency=1, **kwargs)
+  return net, started, gate, done
+
+
+def _wait_for(condition):
+  deadline = time.time() + 5
+  while not condition() and time.time() < deadline:
+    time.sleep(0.01)
+  assert condition()
+
+
+def _drain(done, n):
+  return [done.get(timeout=5) for _ in range(n)]
+
+
+def test_blocks_handled_before_transactions(listen):
+  net, started, gate, done = _held(listen)
+  with socket.create_connection(('127.0.0.2', net.PORT)) as conn:
+    conn.sendall(_frame(NEW_TRANSACTION, b'held'))
+    assert started.wait(5)
+    conn.sendall(b''.join(_frame(NEW_TRANSACTION, bytes([i])) for i in range(3)) + _frame(NEW_BLOCK, b'block'))
+    _wait_for(lambda: sum(map(len, net.pending)) == 4)
+    gate.set()
+    assert [data for _, data in _drain(done, 5)] == [b'held', b'block', b'\x00', b'\x01', b'\x02']
+
+
+def test_transactions_shed_when_their_queue_is_full(listen):
+  net, started, gate, done = _held(listen, max_pending=2)
+  with socket.create_connection(('127.0.0.2', net.PORT)) as conn:
+    conn.sendall(_frame(NEW_TRANSACTION, b'held'))
+    assert started.wait(5)
+    conn.sendall(b''.join(_frame(NEW_TRANSACTION, bytes([i])) for i in range(5)) + _frame(NEW_BLOCK, b'block'))
+    # the block behind the dropped transactions was still read
+    _wait_for(lambda: len(net.pending[PRIORITIES[NEW_BLOCK]]) == 1)
+    assert len(net.pending[PRIORITIES[NEW_TRANSACTION]]) == 2
+    gate.set()
+    assert [data for _, data in _drain(done, 4)] == [b'held', b'block', b'\x00', b'\x01']
+    time.sleep(0.1)
+    assert done.empty()
+
+
+def test_blocks_wait_for_room_instead(listen):
+  net, started, gate, done = _held(listen, max_pending=1)
+  with socket.create_connection(('127.0.0.2', net.PORT)) as conn:
+    conn.sendall(_frame(NEW_BLOCK, b'held'))
+    assert started.wait(5)
+    conn.sendall(b''.join(_frame(NEW_BLOCK, bytes([i])) for i in range(4)))
+    # reading stops at a full queue
+    _wait_for(lambda: len(net.pending[PRIORITIES[NEW_BLOCK]]) == 1)
+    time.sleep(0.1)
+    assert len(net.pending[PRIORITIES[NEW_BLOCK]]) == 1
+    gate.set()
+    assert [data for _, data in _drain(done, 5)] == [b'held'] + [bytes([i]) for i in range(4)]
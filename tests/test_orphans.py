@@ -0,0 +1,129 @@
+'''
+test_orphans.py
+blocks parked until their parent or their transactions arrive
+'''
+import pickle
+
+import pytest
+
+from block import Block
+from miner import Miner, Status
+from orphans import OrphanPool
+from WalletGenerator import Wallet_Generator
+
+
+class Clock:
+  def __init__(self):
+    self.now = 0.
+
+  def __call__(self):
+    return self.now
+
+
+def _block(prev_hash, name):
+  return Block(prev_hash, [name * 32], timestamp=name)
+
+
+class Tsn:
+  def __init__(self, digest):
+    self.Digest = digest
+
+
+def test_parked_blocks_by_parent():
+  pool = OrphanPool()
+  b1 = _block(b'p' * 32, b'1')
+  b2 = _block(b1.hashcode, b'2')
+  b3 = _block(b2.hashcode, b'3')
+  # parked from the top down, as they come while fetching parents one by one
+  assert pool.add_block(b3).depth == 1
+  assert pool.add_block(b2).depth == 2
+  assert pool.add_block(b1).depth == 3
+  assert pool.pop_children(b'p' * 32) == [b1]
+  assert pool.pop_children(b1.hashcode) == [b2]
+  assert len(pool) == 1 and pool.pop_children(b'x' * 32) == []
+
+
+def test_parked_data_resolved_by_transactions():
+  pool = OrphanPool()
+  pool.add_data(b'h' * 32, b'raw', [b'a', b'b'], source='peer')
+  assert pool.resolve(Tsn(b'a')) == []
+  ready = pool.resolve(Tsn(b'b'))
+  assert [(e.hashcode, e.data, e.source, set(e.found)) for e in ready] == [(b'h' * 32, b'raw', 'peer', {b'a', b'b'})]
+  assert len(pool) == 0 and pool.by_tsn == {}
+
+
+def test_bounded_and_expiring():
+  clock = Clock()
+  pool = OrphanPool(max_blocks=2, ttl=10, clock=clock)
+  blocks = [_block(b'p' * 32, bytes([i])) for i in range(3)]
+  for block in blocks:
+    pool.add_block(block)
+    clock.now += 4
+  # the oldest was evicted, its index with it
+  assert blocks[0].hashcode not in pool and len(pool) == 2
+  assert pool.expire() == 0
+  clock.now = 14
+  assert pool.expire() == 1 and blocks[2].hashcode in pool
+  assert pool.expire(100) == 1 and pool.by_parent == {}
+
+
+@pytest.fixture
+def miner(monkeypatch):
+  monkeypatch.setattr(Block, 'difficulty', 1)
+  W, genesis, _ = Wallet_Generator(4, 100.)
+  clock = Clock()
+  miner = Miner(clock=clock)
+  miner.add_first_block(genesis.to_bytes(tsn_hash_only=False))
+  return miner, list(W.values()), genesis, clock
+
+
+def _mined(prev, *tsns):
+  block = Block(prev.hashcode, list(tsns))
+  block.mine()
+  return block
+
+
+def test_parent_requested_then_connected(miner):
+  miner, (a, b, c, d), genesis, _ = miner
+  requested = []
+  miner.on_block_requested_listeners += lambda hashcode, source: requested.append((hashcode, source))
+  a1 = _mined(genesis, a.send(10., b.address))
+  a2 = _mined(a1, c.send(10., d.address))
+
+  status, block = miner.add_received_block(a2.to_bytes(tsn_hash_only=False), source='peer')
+  assert status == Status.ORPHAN and a2.hashcode in miner.orphans
+  assert requested == [(a1.hashcode, 'peer')]
+  # a second copy is not parked or requested again
+  assert miner.add_received_block(a2.to_bytes(tsn_hash_only=False))[0] == Status.DUPLICATE
+
+  assert miner.add_received_block(a1.to_bytes(tsn_hash_only=False))[0] == Status.VALID
+  assert miner.chain.hash_at(-1) == a2.hashcode and len(miner.orphans) == 0
+
+
+def test_missing_transactions_requested_then_resumed(miner):
+  miner, (a, b, _, _), genesis, _ = miner
+  requested, added = [], []
+  miner.on_transactions_requested_listeners += lambda *args: requested.append(args)
+  miner.on_block_added_listeners += added.append
+  tsn = a.send(10., b.address)
+  a1 = _mined(genesis, tsn)
+
+  # only the digests, and the transaction is not in our pool
+  status, _ = miner.add_received_block(a1.to_bytes(), source='peer')
+  assert status == Status.ORPHAN
+  assert requested == [(a1.hashcode, [tsn.Digest], 'peer')]
+
+  miner.add_missing_transactions(pickle.dumps([tsn.to_bytes(compact=True)]))
+  assert miner.chain.hash_at(-1) == a1.hashcode
+  assert added == [a1] and len(miner.orphans) == 0
+
+
+def test_parked_blocks_expire(miner):
+  miner, (a, b, c, d), genesis, clock = miner
+  a1 = _mined(genesis, a.send(10., b.address))
+  a2 = _mined(a1, c.send(10., d.address))
+  miner.add_received_block(a2.to_bytes(tsn_hash_only=False))
+  clock.now += miner.orphans.ttl + 1
+  # dropped when the next block comes in, so a1 alone connects
+  assert miner.add_received_block(a1.to_bytes(tsn_hash_only=False))[0] == Status.VALID
+  assert miner.chain.hash_at(-1) == a1.hashcode and len(miner.orphans) == 0
@@ -0,0 +1,52 @@
+'''
+test_simulator.py
+what the simulator reports, and the sync retry of its nodes
+'''
+from block import Block
+from network import REQUEST_TO_SYNC
+from simulator import Simulator
+
+
+def _isolate(node):
+  node.network.sending = lambda host, data, tag: None
+  node.network.handler = lambda addr, tag, data: None
+
+
+def test_consensus_measured_against_the_heaviest_tip():
+  difficulty = Block.difficulty
+  try:
+    sim = Simulator(nodes=4, degree=2, wallets=10, block_interval=5., seed=1)
+    # node 0 neither sends nor receives, it falls behind the other three
+    _isolate(sim.nodes[0])
+    results = sim.run(300, settle=5.)
+  finally:
+    Block.difficulty = difficulty
+  best = sim.best_node()
+  assert best is not sim.nodes[0]
+  assert best.miner.tip.work > sim.nodes[0].miner.tip.work
+  assert results['in_consensus'] == 0.75
+  assert results['height'] == len(best.miner.chain) - 1
+
+
+def test_unanswered_sync_is_retried():
+  difficulty = Block.difficulty
+  try:
+    sim = Simulator(nodes=2, degree=1, wallets=4, seed=2)
+  finally:
+    Block.difficulty = difficulty
+  node = sim.nodes[0]
+  sent = []
+  sending = node.network.sending
+  # sync requests are lost, everything else goes through
+  def lossy(host, data, tag):
+    if tag == REQUEST_TO_SYNC:
+      sent.append(sim.clock.now())
+    else:
+      sending(host, data, tag)
+  node.network.sending = lossy
+
+  node.miner.trigger_sync()
+  timeout = node.miner.sync_timeout
+  sim.clock.run(3 * timeout + 1)
+  assert sent == [0., timeout, 2 * timeout, 3 * timeout]
+  assert node.miner.need_to_sync
@@ -0,0 +1,97 @@
+'''
+test_snapshot.py
+snapshot encoding, and a node bootstrapping from a peer's snapshot
+'''
+import pytest
+
+from block import Block
+from miner import Miner, Status
+from node import Node
+from snapshot import Snapshot
+from network import REQUEST_SNAPSHOT, RETURN_SNAPSHOT, REQUEST_HEADERS
+from wallet import Wallet
+from WalletGenerator import Wallet_Generator
+
+
+A, B = Wallet().address, Wallet().address
+
+
+def test_round_trip():
+  snapshot = Snapshot([b'a' * 32, b'b' * 32], {A: 0., B: 0.1 + 0.2})
+  copy = Snapshot.from_bytes(snapshot.to_bytes())
+  assert copy.hashes == snapshot.hashes
+  assert copy.balances == {A: 0., B: 0.3}
+  assert copy.matches(snapshot.balances)
+
+
+def test_corrupted():
+  data = bytearray(Snapshot([b'a' * 32], {A: 1.}).to_bytes())
+  data[10] ^= 1
+  with pytest.raises(ValueError):
+    Snapshot.from_bytes(bytes(data))
+
+
+@pytest.fixture
+def miner(monkeypatch):
+  monkeypatch.setattr(Block, 'difficulty', 1)
+  W, genesis, _ = Wallet_Generator(2, 100.)
+  miner = Miner()
+  miner.add_first_block(genesis.to_bytes(tsn_hash_only=False))
+  return miner, list(W.values()), genesis
+
+
+def test_snapshot_after_full_balance_send(miner):
+  miner, (a, b), genesis = miner
+  block = Block(genesis.hashcode, [a.send(100., b.address)])
+  block.mine()
+  assert miner.add_received_block(block.to_bytes(tsn_hash_only=False))[0] == Status.VALID
+  assert miner.balances.balance(a.address) == 0
+
+  fresh = Miner()
+  assert fresh.load_snapshot(miner.get_snapshot())
+  assert fresh.tip.hashcode == block.hashcode
+  assert fresh.balances.balances == {a.address: 0., b.address: 200.}
+
+
+class FakeNetwork:
+  def __init__(self, hosts):
+    self.HOSTs = hosts
+    self.sent = []
+
+  def sending(self, host, data, tag):
+    self.sent.append((host, tag))
+
+
+def _node():
+  node = Node(Miner(), FakeNetwork(['peer']))
+  node.timers = []
+  node.call_later = lambda delay, fn, *args: node.timers.append((fn, args))
+  node.bootstrap()
+  assert node.network.sent == [('peer', REQUEST_SNAPSHOT)]
+  return node
+
+
+def test_bootstrap_falls_back_after_timeout():
+  node = _node()
+  fn, args = node.timers[0]
+  fn(*args)
+  assert node.network.sent[-1] == ('peer', REQUEST_HEADERS)
+  # a snapshot arriving now is ignored
+  node.handle_message(('peer', 0), RETURN_SNAPSHOT, Snapshot([b'a' * 32], {}).to_bytes())
+  assert len(node.miner.chain) == 0 and node.network.sent[-1] == ('peer', REQUEST_HEADERS)
+
+
+def test_bootstrap_falls_back_on_empty_reply():
+  node = _node()
+  node.handle_message(('peer', 0), RETURN_SNAPSHOT, b'')
+  assert node.network.sent[-1] == ('peer', REQUEST_HEADERS)
+  # the timeout has nothing left to do
+  fn, args = node.timers[0]
+  fn(*args)
+  assert [tag for _, tag in node.network.sent].count(REQUEST_HEADERS) == 1
+
+
+def test_empty_peer_answers_with_nothing():
+  node = Node(Miner(), FakeNetwork(['peer']))
+  node.handle_message(('peer', 0), REQUEST_SNAPSHOT, b'')
+  assert node.network.sent == [('peer', RETURN_SNAPSHOT)]
@@ -0,0 +1,68 @@
+'''
+test_verifier.py
+signature checks through SignatureVerifier
+'''
+from base64 import b64encode
+
+import pytest
+
+from wallet import Wallet
+from verifier import SignatureVerifier, VERIFY_SECONDS
+
+
+def _signed():
+  s, r = Wallet(), Wallet()
+  s.transactions[b'x' * 32] = {'hash': b'x' * 32, 'amount': 10., 'time': '', 'balance': 10.}
+  return s.send(4., r.address)
+
+
+def test_valid_signature():
+  assert SignatureVerifier().verify(_signed())
+
+
+def test_tampered_signature():
+  tsn = _signed()
+  sig = bytearray(tsn.Signatures[0])
+  sig[5] = ord('A') if sig[5] != ord('A') else ord('B')
+  tsn.Signatures = [bytes(sig)]
+  assert not SignatureVerifier().verify(tsn)
+
+
+def test_malformed_signature_and_key():
+  tsn = _signed()
+  tsn.Signatures = [b'not base64!']
+  assert not SignatureVerifier().verify(tsn)
+
+  tsn = _signed()
+  # a key that is not a point of the curve
+  tsn.Senders = [[digest, b64encode(b'\x01' * 64)] for digest, _ in tsn.Senders]
+  tsn._message = None
+  assert not SignatureVerifier().verify(tsn)
+
+
+def test_results_are_cached():
+  verifier = SignatureVerifier()
+  tsn = _signed()
+  assert not verifier.is_verified(tsn)
+  assert verifier.verify_many([tsn, tsn]) == [True, True]
+  assert verifier.is_verified(tsn)
+
+
+@pytest.fixture
+def verify_seconds():
+  registry = VERIFY_SECONDS.registry
+  enabled, registry.enabled = registry.enabled, True
+  VERIFY_SECONDS.values.clear()
+  yield lambda: sum(VERIFY_SECONDS.values.get((), [0])[:-1])
+  registry.enabled = enabled
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_verify_time_recorded(verify_seconds, workers):
+  verifier = SignatureVerifier(workers)
+  verifier.min_batch = 2
+  try:
+    assert verifier.verify_many([_signed(), _signed(), _signed()]) == [True] * 3
+  finally:
+    verifier.close()
+  assert verify_seconds() == 3
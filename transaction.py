@@ -6,28 +6,42 @@ create transaction for blockchain
 import time
 from util import *
 from crypto import *
+from codec import is_compact, encode_transaction, decode_transaction, check_transaction
+from verifier import VERIFY_SECONDS
+import metrics
+
 
 # senders list of tuple(hash of transaction, address)
 # receivers list of tuple(amount, address)
 class Transaction:
   def __init__(self, T=None, senders = list(), receivers = list()):
     if T == None:
+      self._compact = None
       self.Timestamp = time.asctime().encode()
       self.Senders = senders
       self.Receivers = receivers
+      self.Signatures = []
       self.Digest = double_sha256(self.to_bytes(nohash=True, nosign=True))
     else:
       self.from_bytes(T)
   
   def __str__(self):
     return "Created Time: " + self.Timestamp.decode() + \
-           "\nHash: " + str(self.Digest) + \
+           "\nHash: " + b64encode(self.Digest).decode() + \
            "\nSenders: " + str(self.Senders) + \
            "\nReceivers: " + str(self.Receivers) +\
            "\nSignatures: " + str(self.Signatures)
   
-  def to_bytes(self, nosign = False, nohash=False):
-    senders = [b64encode(digest + b'\n' + address) 
+  # compact: the binary format of codec.py, always carrying hash and signatures,
+  # built once like message(), or kept from the bytes the transaction was decoded from
+  # otherwise the legacy text format, where digests are written in base64
+  def to_bytes(self, nosign = False, nohash=False, compact=False):
+    if compact:
+      if self._compact is None:
+        self._compact = encode_transaction(self)
+      return self._compact
+
+    senders = [b64encode(b64encode(digest) + b'\n' + address) 
                   for digest, address in self.Senders]
 
     receivers = [b64encode(str(amount).encode() + b'\n' + address)
@@ -38,32 +52,67 @@ class Transaction:
             b64encode(b'\n'.join(receivers))]
 
     if not nohash:
-      s.insert(0, self.Digest)
+      s.insert(0, b64encode(self.Digest))
 
     if not nosign:
       s.append(b64encode(b'\n'.join(self.Signatures)))
 
     return b'\n'.join(s)
 
+  # accepts both the compact and the legacy text format
+  # raise ValueError on malformed data, or on a transaction the compact format can't carry
   def from_bytes(self, T):
+    self._message = None
+    self._compact = None
+    if is_compact(T):
+      decode_transaction(T, self)
+      self._compact = bytes(T)
+      return
+
+    try:
+      self._from_legacy(T)
+    except IndexError:
+      raise ValueError('malformed transaction')
+    check_transaction(self)
+
+  def _from_legacy(self, T):
     T = T.splitlines()
-    self.Digest = T[0]
+    self.Digest = b64decode(T[0])
     self.Timestamp = T[1]
     self.Signatures = b64decode(T[-1]).splitlines()
 
     senders = b64decode(T[2]).splitlines()
-    self.Senders = [b64decode(s).splitlines() for s in senders]
+    senders = [b64decode(s).splitlines() for s in senders]
+    self.Senders = [[b64decode(s[0]), s[1]] for s in senders]
 
     receivers = b64decode(T[3]).splitlines()
     receivers = [b64decode(r).splitlines() for r in receivers]
     self.Receivers = [[float(r[0].decode()), r[1]] for r in receivers]
 
+  # the signed part of the transaction, built once
+  def message(self):
+    if getattr(self, '_message', None) is None:
+      self._message = self.to_bytes(nosign=True)
+    return self._message
+
   def sign(self, PRs):
-    m = self.to_bytes(nosign = True)
+    m = self.message()
     self.Signatures = [sign(m, PR) for PR in PRs]
+    self._compact = None
+
+  # whether the transaction can be relayed unchanged, see codec.check_transaction
+  def well_formed(self):
+    try:
+      check_transaction(self)
+    except ValueError:
+      return False
+    return True
 
+  @metrics.timed(VERIFY_SECONDS)
   def verify(self):
-    m = self.to_bytes(nosign=True)
+    m = self.message()
+    if len(self.Signatures) != len(self.Senders):
+      return False
     for sig, address in zip(self.Signatures, self.Senders):
       if not verify(sig, m, address[1]):
         return False
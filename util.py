@@ -45,4 +45,7 @@ def u2a (n):
 
 #from base64 to int tuple
 def a2u (n):
-  return b2u(b64decode(n))
\ No newline at end of file
+  return b2u(b64decode(n))
+#from signed int to bytes (len: 8), used for the block nonce
+def n2b (n):
+  return pack('>q', n)
@@ -0,0 +1,118 @@
+'''
+verifier.py
+bulk verification of transaction signatures
+
+Results are cached by a hash of the signed message and its signatures,
+so a transaction verified when it entered the pool is not verified again
+when it shows up in a block.
+'''
+import time
+import multiprocessing
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+
+from crypto import verify, VERIFY_ERRORS
+import metrics
+
+BATCH_SECONDS = metrics.histogram('verifier_batch_seconds', 'time to check a batch of signatures not in the cache')
+SIGNATURES = metrics.counter('verifier_transactions_total', 'transactions checked, by result', ('result',))
+VERIFY_SECONDS = metrics.histogram('transaction_verify_seconds', 'time to check the signatures of one transaction')
+
+
+# job: (message, [(signature, address), ...])
+# return (valid, seconds), the time is recorded by the caller as pool workers have their own metrics
+def _verify_job(job):
+  m, pairs = job
+  start = time.perf_counter()
+  try:
+    ok = all(verify(sig, m, address) for sig, address in pairs)
+  except VERIFY_ERRORS:
+    # malformed signature or key
+    ok = False
+  return ok, time.perf_counter() - start
+
+
+class SignatureVerifier:
+  cache_size = 100000
+  # batches smaller than this are verified in the calling thread, since a round trip
+  # to the pool costs more than a few signatures: single admissions stay in-thread,
+  # the pool takes the transactions of blocks and sync batches
+  min_batch = 16
+
+  # workers: size of the process pool, 0 to verify everything in the calling thread
+  def __init__(self, workers=0):
+    self.workers = workers
+    self._pool = None
+    self._cache = OrderedDict()
+    self._lock = Lock()
+
+
+  def _get_pool(self):
+    if self._pool is None:
+      self._pool = multiprocessing.Pool(self.workers)
+    return self._pool
+
+
+  def close(self):
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool = None
+
+
+  @staticmethod
+  def _key(tsn):
+    return sha256(tsn.message() + b''.join(tsn.Signatures)).digest()
+
+
+  def is_verified(self, tsn):
+    with self._lock:
+      return self._key(tsn) in self._cache
+
+
+  def verify(self, tsn):
+    return self.verify_many([tsn])[0]
+
+
+  # return a list of booleans, one per transaction
+  def verify_many(self, tsns):
+    results = [False] * len(tsns)
+    keys, jobs, indices = [], [], []
+
+    with self._lock:
+      for i, tsn in enumerate(tsns):
+        key = self._key(tsn)
+        if key in self._cache:
+          self._cache.move_to_end(key)
+          results[i] = True
+        elif len(tsn.Signatures) == len(tsn.Senders):
+          keys.append(key)
+          jobs.append((tsn.message(), [(sig, sender[1]) for sig, sender in zip(tsn.Signatures, tsn.Senders)]))
+          indices.append(i)
+
+    SIGNATURES.inc(sum(results), ('cached',))
+    if not jobs:
+      return results
+
+    with BATCH_SECONDS.time():
+      if self.workers > 0 and len(jobs) >= self.min_batch:
+        chunksize = max(1, len(jobs) // (self.workers * 4))
+        done = self._get_pool().map(_verify_job, jobs, chunksize)
+      else:
+        done = [_verify_job(job) for job in jobs]
+    verified = [ok for ok, _ in done]
+    for _, seconds in done:
+      VERIFY_SECONDS.observe(seconds)
+    valid = sum(verified)
+    SIGNATURES.inc(valid, ('valid',))
+    SIGNATURES.inc(len(verified) - valid, ('invalid',))
+
+    with self._lock:
+      for i, key, ok in zip(indices, keys, verified):
+        results[i] = ok
+        if ok:
+          self._cache[key] = True
+      while len(self._cache) > self.cache_size:
+        self._cache.popitem(last=False)
+
+    return results
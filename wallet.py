@@ -3,6 +3,7 @@ wallet.py
 managing address and transaction associate with it
 '''
 import time
+from base64 import b64encode
 from transaction import Transaction
 from crypto import get_keypair
 
@@ -20,7 +21,7 @@ class Wallet:
     s = 'Address: %s\n'%self.address.decode()
     s += 'Total Balance: %f\n\n'%(T[-1]['balance'])
     for t in T[:-11:-1]:
-      s += '%s%50s%20f\n'%(t['time'], t['hash'].decode(), t['amount'])
+      s += '%s%50s%20f\n'%(t['time'], b64encode(t['hash']).decode(), t['amount'])
 
     return s
 